@@ -7,23 +7,73 @@ Streamlitを使用したシンプルなUI
 """
 
 import os
+import re
 import json
 import time
-import requests
+import uuid
+from functools import partial
 from datetime import datetime
 import streamlit as st
-import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
-from openai import OpenAI
 from dotenv import load_dotenv
 
+import metrics_exporter
+import model_cache
+from conversation_store import (DEFAULT_PAGE_SIZE, DEFAULT_RESUME_MESSAGES, get_conversation_store,
+                                rendered_markdown)
+from endpoints import get_api_bases, get_endpoint_pool
+from gpustack_client import auth_headers, get_openai_client, get_session
+from history_manager import HistoryManager, get_context_window, message_tokens, strip_summary_prefix
+from metrics_store import get_metrics_store
+from model_race import DEFAULT_POLICY as DEFAULT_RACE_POLICY, POLICIES as RACE_POLICIES, ModelRace, order_by_size
+from model_router import AUTO_MODEL, get_router
+from prompt_builder import (PrefixCacheStats, canonical_message, canonical_system_prompt, inject_context,
+                            prompt_cache_extra_body)
+from resilience import classify_error, classify_status, resilient_call
+from request_scheduler import QueueFullError, QueueTimeoutError, get_scheduler
+from response_cache import get_response_cache, is_cacheable
+from singleflight import get_group, request_key
+from token_counter import count_tokens, resolve_token_usage, usage_to_dict
+
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
 # GPUStackの設定
 GPUSTACK_API_BASE = os.getenv("GPUSTACK_API_BASE", "http://localhost:8000/v1")
 GPUSTACK_API_KEY = os.getenv("GPUSTACK_API_KEY", "")
+# 同じモデルを提供する複数ノードに振り分ける場合は GPUSTACK_API_BASES にカンマ区切りで指定する
+GPUSTACK_API_BASES = get_api_bases(GPUSTACK_API_BASE)
+
+# METRICS_PORT が設定されていればPrometheus向けの /metrics を公開する
+metrics_exporter.start_exporter()
+
+# 応答キャッシュの設定（埋め込みモデルを指定すると類似の質問にもヒットする）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "")
+
+# 資料を参照した回答（RAG）。埋め込みモデルを指定すると、サイドバーから資料を登録できる
+RAG_EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL") or RESPONSE_CACHE_EMBEDDING_MODEL
+# プロンプトに入れる資料の最大トークン数と、検索するチャンク数
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1024"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "4"))
+
+# 会話をSQLiteに保存して、ブラウザを閉じても再開できるようにする
+CONVERSATION_STORE_ENABLED = os.getenv("CONVERSATION_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+# 一度に描画するメッセージ数（長い会話では古いメッセージを必要になるまで描画しない）
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", DEFAULT_PAGE_SIZE))
+# 会話の持ち主の識別子（推測されないよう十分な長さのランダムな16進文字列だけを受け付ける）
+OWNER_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# 順番待ちの最大時間（秒）。これを超えたら諦めてユーザーに再送を促す
+QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", "120"))
+# 履歴の要約が実行枠を待つ最大時間（秒）。対話が途切れない混雑時は、これを超えたら要約せずに古いターンを捨てる
+SUMMARY_QUEUE_TIMEOUT = min(QUEUE_TIMEOUT, float(os.getenv("SCHEDULER_SUMMARY_TIMEOUT", "10")))
+
+# レースモードで大きいモデルが負けたときの扱い
+RACE_POLICY_LABELS = {
+    "cancel": "打ち切る",
+    "offer": "完了後に候補として表示する",
+    "swap": "完了後に差し替える",
+}
 
 # アプリケーションのタイトルと説明
 st.set_page_config(
@@ -37,82 +87,527 @@ st.sidebar.title("GPUStack ローカルLLMチャットボット")
 st.sidebar.image("https://raw.githubusercontent.com/sambanova/gpustack/main/docs/assets/GPUStack_Logo.png", width=200)
 st.sidebar.markdown("---")
 
+def get_model_cache():
+    """プロセス全体で共有するモデル一覧キャッシュを取得する"""
+    return model_cache.get_model_cache(GPUSTACK_API_BASES, GPUSTACK_API_KEY)
+
+def get_pool():
+    """プロセス全体で共有するエンドポイントのプールを取得する"""
+    return get_endpoint_pool(GPUSTACK_API_BASES, GPUSTACK_API_KEY)
+
 def check_gpustack_connection():
-    """GPUStackとの接続を確認する"""
-    try:
-        response = requests.get(f"{GPUSTACK_API_BASE}/models", timeout=5)
-        return response.status_code == 200
-    except requests.exceptions.ConnectionError:
-        return False
-    except requests.exceptions.Timeout:
-        return False
-    except Exception as e:
-        st.error(f"GPUStackサーバーとの接続中にエラーが発生しました: {str(e)}")
-        return False
+    """GPUStackとの接続を確認する（キャッシュ済みのヘルス状態を返す）"""
+    return get_model_cache().get().connected
 
 def get_available_models():
-    """デプロイされているモデルのリストを取得する"""
-    headers = {}
-    if GPUSTACK_API_KEY:
-        headers["Authorization"] = f"Bearer {GPUSTACK_API_KEY}"
-    
-    try:
-        response = requests.get(f"{GPUSTACK_API_BASE}/models", headers=headers)
-        if response.status_code == 200:
-            models_data = response.json()
-            # アクティブなモデルのみをフィルタリング
-            models = [model["id"] for model in models_data["data"] if model["status"] == "RUNNING"]
-            return models
-        return []
-    except:
-        return []
+    """デプロイされているモデルのリストを取得する（キャッシュ済みの一覧を返す）"""
+    # アクティブなモデルのみをフィルタリング
+    return get_model_cache().get().running_models
 
 def get_model_usage():
-    """モデルの使用状況を取得する"""
-    headers = {}
-    if GPUSTACK_API_KEY:
-        headers["Authorization"] = f"Bearer {GPUSTACK_API_KEY}"
+    """モデルの使用状況を取得する（失敗した場合は分類したエラーを返す）"""
+    headers = auth_headers(GPUSTACK_API_KEY)
+    
+    def fetch():
+        return resilient_call(
+            lambda: get_pool().call(
+                lambda endpoint: get_session().get(f"{endpoint.url}/metrics", headers=headers)
+            )
+        )
     
     try:
-        response = requests.get(f"{GPUSTACK_API_BASE}/metrics", headers=headers)
+        # 複数のセッションが同時に表示しても、問い合わせは1回にまとめる
+        response, _ = get_group("metrics").do(request_key(GPUSTACK_API_BASES), fetch)
         if response.status_code == 200:
-            return response.json()
-        return None
-    except:
-        return None
+            return response.json(), None
+        return None, classify_status(response.status_code)
+    except Exception as e:
+        return None, classify_error(e)
 
-def chat_with_model(model, messages, max_tokens=500, temperature=0.7, top_p=0.95):
-    """モデルとチャットする"""
-    client = OpenAI(
-        api_key=GPUSTACK_API_KEY or "dummy_key",
-        base_url=GPUSTACK_API_BASE
+def embed_text(text):
+    """埋め込みモデルでテキストのベクトルを取得する"""
+    response = resilient_call(
+        lambda: get_pool().call(
+            lambda endpoint: get_openai_client(endpoint.url, GPUSTACK_API_KEY).embeddings.create(
+                model=RESPONSE_CACHE_EMBEDDING_MODEL, input=text
+            ),
+            model=RESPONSE_CACHE_EMBEDDING_MODEL
+        ),
+        model=RESPONSE_CACHE_EMBEDDING_MODEL
     )
-    
+    return response.data[0].embedding
+
+def get_cache():
+    """プロセス全体で共有する応答キャッシュを取得する"""
+    return get_response_cache(embed=embed_text if RESPONSE_CACHE_EMBEDDING_MODEL else None)
+
+def embed_texts(texts):
+    """RAG用の埋め込みモデルで複数のテキストのベクトルを1回のリクエストで取得する"""
+    response = resilient_call(
+        lambda: get_pool().call(
+            lambda endpoint: get_openai_client(endpoint.url, GPUSTACK_API_KEY).embeddings.create(
+                model=RAG_EMBEDDING_MODEL, input=texts
+            ),
+            model=RAG_EMBEDDING_MODEL
+        ),
+        model=RAG_EMBEDDING_MODEL
+    )
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def get_document_index(namespace=None, create=False):
+    """文書インデックスを取得する（省略時はこのブラウザの利用者がアップロードした資料のインデックス）
+
+    訪問者ごとにディレクトリと接続を作らないよう、create=False では資料が登録されていなければ None を返す。
+    """
+    # numpyの読み込みで起動が遅くならないよう、RAGを使うときに読み込む
+    import rag
+    return rag.get_document_index(embed=embed_texts, namespace=namespace or st.session_state.owner_id,
+                                  create=create)
+
+def get_shared_index():
+    """scripts/rag_index.py で登録した、全員が参照できる資料のインデックス（未登録なら None）"""
+    import rag
+    return get_document_index(rag.SHARED_NAMESPACE)
+
+def add_documents(files):
+    """アップロードされた資料をこの利用者のインデックスに登録する（登録済みの内容は埋め込み直さない）"""
+    index = get_document_index(create=True)
+    for file in files:
+        key = (file.name, file.size)
+        if key in st.session_state.rag_documents:
+            continue
+        try:
+            with st.spinner(f"{file.name} を登録しています..."):
+                added = index.add_document(file.name, file.getvalue().decode("utf-8", errors="replace"))
+        except Exception as e:
+            st.warning(f"{file.name} を登録できませんでした: {classify_error(e)}")
+            continue
+        st.session_state.rag_documents.add(key)
+        if added:
+            st.caption(f"{file.name} を {added} チャンクに分けて登録しました")
+
+def retrieve_context(query, model):
+    """質問に関係する資料のチャンクを検索し、(プロンプトに入れる文章, チャンクのリスト) を返す"""
+    import rag
+    # 資料で履歴が押し出されすぎないよう、コンテキスト長の1/4までにする
+    budget = min(RAG_CONTEXT_TOKENS, get_context_window(model) // 4)
+    # アップロードした資料は本人の質問にだけ使い、共有の資料は選んだ場合だけ加える
+    indexes = [get_document_index()]
+    if st.session_state.rag_shared:
+        indexes.append(get_shared_index())
+    indexes = [index for index in indexes if index is not None]
     try:
-        response = client.chat.completions.create(
+        chunks = rag.retrieve(indexes, query, budget, k=RAG_TOP_K)
+    except Exception as e:
+        st.warning(f"資料を検索できなかったため、資料なしで回答します: {classify_error(e)}")
+        return None, []
+    if not chunks:
+        return None, []
+    return rag.format_context(chunks), chunks
+
+def report_chat_error(model, error, prefix=""):
+    """チャットの失敗を分類し、メトリクスに記録してUIに表示する"""
+    info = classify_error(error)
+    metrics_exporter.observe_error(model, info.kind)
+    if info.kind in ("connection", "timeout", "server", "not_found"):
+        # 接続断やモデルの停止・削除の可能性があるため一覧を取り直す
+        get_model_cache().invalidate()
+    if "模倣" in info.detail or "imitating" in info.detail:
+        st.warning("モデルがレスポンスの生成を停止しました。別の質問を試してみてください。")
+    elif info.kind in ("overloaded", "circuit_open"):
+        st.warning(f"{prefix}{info}")
+    else:
+        st.error(f"{prefix}{info}")
+    return info
+
+def chat_key(model, messages, max_tokens, temperature, top_p, stream):
+    """同じ生成に合流するためのキー（temperature=0 以外は毎回結果が変わるため合流しない）"""
+    if not is_cacheable({"temperature": temperature}):
+        return None
+    return request_key(GPUSTACK_API_BASES, model, messages, max_tokens, temperature, top_p, stream,
+                       prompt_cache_extra_body())
+
+def join_chat(model, messages, max_tokens, temperature, top_p, stream):
+    """同じ質問を生成中ならその生成に合流した Flight を返す（生成中でなければ None）
+
+    合流した生成は実行枠を使わないため、順番待ちせずに chat_with_model / stream_chat_with_model に渡せる。
+    """
+    key = chat_key(model, messages, max_tokens, temperature, top_p, stream)
+    return get_group("chat").join(key) if key is not None else None
+
+class ChatResult:
+    """非ストリーミング応答の本文とトークン使用量"""
+
+    def __init__(self, text, usage=None, shared=False):
+        self.text = text
+        self.usage = usage
+        # 同時に届いた同じ質問の生成を共有した場合は True
+        self.shared = shared
+
+def chat_with_model(model, messages, max_tokens=500, temperature=0.7, top_p=0.95, flight=None):
+    """モデルとチャットする（接続できないノードがあれば別のノードで再試行する）
+
+    flight に join_chat() の結果を渡すと、新たに送信せずに合流した生成の応答を待つ。
+    """
+    def create(endpoint):
+        return get_openai_client(endpoint.url, GPUSTACK_API_KEY).chat.completions.create(
             model=model,
             messages=messages,
             max_tokens=max_tokens,
             temperature=temperature,
-            top_p=top_p
+            top_p=top_p,
+            extra_body=prompt_cache_extra_body()
         )
-        return response.choices[0].message.content
-    except requests.exceptions.ConnectionError:
-        st.error("GPUStackサーバーとの接続が切断されました。サーバーが実行中か確認してください。")
+    
+    def generate():
+        with metrics_exporter.track_in_flight(model):
+            # 生成は冪等ではないため、サーバーが処理していない失敗のみ再試行する
+            return resilient_call(
+                lambda: get_pool().call(create, idempotent=False, model=model),
+                idempotent=False,
+                model=model
+            )
+    
+    try:
+        key = chat_key(model, messages, max_tokens, temperature, top_p, stream=False)
+        if flight is not None:
+            response, shared = flight.wait(), True
+        elif key is None:
+            response, shared = generate(), False
+        else:
+            # 同じ質問を生成中なら新たに送信せず、その応答を共有する
+            response, shared = get_group("chat").do(key, generate)
+        return ChatResult(response.choices[0].message.content, usage_to_dict(response.usage), shared)
+    except Exception as e:
+        report_chat_error(model, e)
         return None
+
+class ChatStream:
+    """ストリーミング応答を逐次受け取り、TTFTとトークン間レイテンシを計測する"""
+
+    def __init__(self, response, start_time, model=None, on_close=None, report_errors=True, shared=False):
+        self._response = response
+        self.start_time = start_time
+        self.model = model
+        self._on_close = on_close
+        # 他のセッションが開いた同じ質問のストリームを購読している場合は True
+        self.shared = shared
+        # UIを持たないスレッドで読む場合はエラーを表示せず self.error に残す
+        self.report_errors = report_errors
+        self.cancelled = False
+        self.first_token_time = None
+        self.last_token_time = None
+        self.inter_token_latencies = []
+        self.text = ""
+        self.usage = None
+        self.error = None
+
+    def __iter__(self):
+        try:
+            with metrics_exporter.track_in_flight(self.model):
+                yield from self._iter_deltas()
+        except Exception as e:
+            # close() で打ち切った場合の読み込みエラーは失敗として扱わない
+            if not self.cancelled:
+                self.error = e
+                if self.report_errors:
+                    report_chat_error(self.model, e, prefix="ストリーミング中にエラーが発生しました: ")
+        finally:
+            # 読み終えたらエンドポイントを解放し、TTFTをレイテンシとして記録する
+            if self._on_close is not None:
+                self._on_close(latency=self.ttft, error=self.error)
+                self._on_close = None
+
+    def _iter_deltas(self):
+        for chunk in self._response:
+            # include_usage指定時は最後のチャンクにusageが含まれる
+            if getattr(chunk, "usage", None):
+                self.usage = usage_to_dict(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            now = time.perf_counter()
+            if self.first_token_time is None:
+                self.first_token_time = now
+            else:
+                self.inter_token_latencies.append(now - self.last_token_time)
+            self.last_token_time = now
+            self.text += delta
+            yield delta
+
+    def close(self):
+        """生成を途中で打ち切る（接続を閉じるとサーバー側の生成も止まる）"""
+        self.cancelled = True
+        try:
+            self._response.close()
+        except Exception:
+            pass
+
+    @property
+    def ttft(self):
+        """最初のトークンが届くまでの時間（秒）"""
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.start_time
+
+    @property
+    def mean_itl(self):
+        """トークン間レイテンシの平均（秒）"""
+        if not self.inter_token_latencies:
+            return None
+        return sum(self.inter_token_latencies) / len(self.inter_token_latencies)
+
+def open_chat_stream(model, messages, max_tokens=500, temperature=0.7, top_p=0.95, report_errors=True,
+                     coalesce=False, flight=None):
+    """ストリーミング応答を開始する（応答の開始前に失敗したら別のノードで再試行し、失敗は例外で返す）
+
+    coalesce=True の場合、同じ質問のストリームを生成中ならそれを購読し、届いたチャンクを最初から受け取る。
+    flight に join_chat() の結果を渡すと、新たに送信せずに合流したストリームを購読する。
+    """
+    def create(endpoint):
+        return get_openai_client(endpoint.url, GPUSTACK_API_KEY).chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stream=True,
+            stream_options={"include_usage": True},
+            extra_body=prompt_cache_extra_body()
+        )
+    
+    pool = get_pool()
+    start_time = time.perf_counter()
+    if flight is not None:
+        return ChatStream(flight.wait().subscribe(), start_time, model, report_errors=report_errors, shared=True)
+    
+    def open_response():
+        return resilient_call(
+            lambda: pool.call(create, idempotent=False, model=model, keep_lease=True),
+            idempotent=False,
+            model=model
+        )
+    
+    key = chat_key(model, messages, max_tokens, temperature, top_p, stream=True) if coalesce else None
+    if key is None:
+        response, endpoint = open_response()
+        return ChatStream(response, start_time, model, on_close=partial(pool.release, endpoint),
+                          report_errors=report_errors)
+    
+    leases = []
+    
+    def open_shared():
+        response, endpoint = open_response()
+        leases.append(endpoint)
+        return response
+    
+    def release(broadcast):
+        # 購読者ではなく上流のストリームを読み終えた時点でエンドポイントを解放する
+        pool.release(leases[0], latency=broadcast.latency, error=broadcast.error)
+    
+    subscription, shared = get_group("chat").stream(key, open_shared, on_finish=release)
+    return ChatStream(subscription, start_time, model, report_errors=report_errors, shared=shared)
+
+def stream_chat_with_model(model, messages, max_tokens=500, temperature=0.7, top_p=0.95, flight=None):
+    """モデルとストリーミングでチャットする（失敗したらエラーを表示して None を返す）"""
+    try:
+        return open_chat_stream(model, messages, max_tokens, temperature, top_p, coalesce=True, flight=flight)
     except Exception as e:
-        error_msg = str(e)
-        if "模倣" in error_msg or "imitating" in error_msg:
-            st.warning("モデルがレスポンスの生成を停止しました。別の質問を試してみてください。")
-        else:
-            st.error(f"エラーが発生しました: {error_msg}")
+        report_chat_error(model, e)
         return None
 
+def render_stream(stream, placeholder, refresh_interval=0.05):
+    """ストリームのトークンを到着順にプレースホルダーへ描画し、全文を返す"""
+    text = ""
+    last_render = 0.0
+    for delta in stream:
+        text += delta
+        now = time.perf_counter()
+        # 再描画の頻度を抑えてブラウザへの送信量を減らす
+        if now - last_render >= refresh_interval:
+            placeholder.markdown(text + "▌")
+            last_render = now
+    if text:
+        placeholder.markdown(text)
+    return text or None
+
+def start_race(models, messages):
+    """同じ履歴を複数のモデルに同時に送るレースを開始する"""
+    session_id = st.session_state.session_id
+    
+    def open_stream(model):
+        # ワーカースレッドではUIに触れないため、エラーはレースの結果として受け取る
+        return open_chat_stream(
+            model,
+            messages,
+            max_tokens=st.session_state.max_tokens,
+            temperature=st.session_state.temperature,
+            top_p=st.session_state.top_p,
+            report_errors=False
+        )
+    
+    return ModelRace(
+        models,
+        open_stream,
+        slot=lambda model: get_scheduler().slot(model, session_id, timeout=QUEUE_TIMEOUT),
+        policy=st.session_state.race_policy,
+        store=get_metrics_store()
+    ).start()
+
+def report_race_failure(race):
+    """どのモデルも応答を始められなかった場合のエラーを表示する"""
+    for racer in race.racers:
+        if isinstance(racer.error, (QueueFullError, QueueTimeoutError)):
+            st.warning(f"{racer.model}: リクエストが混み合っています。しばらく待ってから再度送信してください。")
+        elif racer.error is not None:
+            report_chat_error(racer.model, racer.error, prefix=f"{racer.model}: ")
+    if all(racer.error is None for racer in race.racers):
+        st.error("どのモデルからも応答がありませんでした。")
+
+def finish_race(race, placeholder):
+    """勝者の回答の後も生成を続けている大きいモデルの回答を、差し替えるか候補として残す"""
+    pending = race.pending
+    if pending is None:
+        return
+    index = len(st.session_state.messages) - 1
+    if race.policy == "swap":
+        with st.spinner(f"{pending.model} の回答を待っています..."):
+            pending.done.wait()
+        if pending.completed:
+            message = canonical_message("assistant", pending.text)
+            replace_message(index, message, pending.model)
+            placeholder.markdown(rendered_markdown(message))
+            st.caption(f"🔄 {pending.model} の回答に差し替えました")
+    else:
+        st.session_state.race_alternatives[index] = pending
+        st.caption(f"⏳ {pending.model} も回答を生成しています。完了すると候補として表示されます")
+
+def display_race_alternative(index, racer):
+    """レースで負けた大きいモデルの回答を候補として表示し、切り替えられるようにする"""
+    if not racer.done.is_set():
+        st.caption(f"⏳ {racer.model} が回答を生成中です（画面を更新すると表示されます）")
+        return
+    if not racer.completed:
+        del st.session_state.race_alternatives[index]
+        return
+    with st.expander(f"{racer.model} の回答"):
+        message = canonical_message("assistant", racer.text)
+        st.markdown(rendered_markdown(message))
+        if st.button("この回答に切り替える", key=f"race_swap_{index}"):
+            replace_message(index, message, racer.model)
+            del st.session_state.race_alternatives[index]
+            st.rerun()
+
+def summarize_messages(model, messages, previous_summary=None):
+    """履歴からあふれた古いターンを要約する"""
+    transcript = "\n".join(
+        f"{'ユーザー' if msg['role'] == 'user' else 'アシスタント'}: {msg['content']}"
+        for msg in messages
+    )
+    if previous_summary:
+        transcript = f"これまでの要約: {previous_summary}\n{transcript}"
+    # 要約は対話より優先度を下げて実行し、混雑時は諦めて古いターンを捨てる
+    try:
+        with get_scheduler().slot(model, st.session_state.session_id, priority="background",
+                                  timeout=SUMMARY_QUEUE_TIMEOUT):
+            result = chat_with_model(
+                model,
+                [
+                    {"role": "system", "content": "会話の要点を、後続の会話に必要な事実・決定事項を残して日本語で簡潔に要約してください。"},
+                    {"role": "user", "content": transcript},
+                ],
+                max_tokens=256,
+                temperature=0.0,
+                top_p=1.0
+            )
+    except (QueueFullError, QueueTimeoutError):
+        result = None
+    return strip_summary_prefix(result.text) if result else previous_summary
+
+def add_message(message, model=None):
+    """メッセージを会話の末尾に追加し、会話ストアに追記する"""
+    st.session_state.messages.append(message)
+    if CONVERSATION_STORE_ENABLED:
+        store = get_conversation_store()
+        if st.session_state.conversation_id is None:
+            st.session_state.conversation_id = store.create(st.session_state.owner_id)
+        seq = st.session_state.message_offset + len(st.session_state.messages) - 1
+        store.append(st.session_state.conversation_id, seq, message, model)
+
+def replace_message(index, message, model=None):
+    """メッセージを差し替える（会話ストアには新しい版として追記する）"""
+    st.session_state.messages[index] = message
+    if CONVERSATION_STORE_ENABLED and st.session_state.conversation_id is not None:
+        get_conversation_store().append(
+            st.session_state.conversation_id, st.session_state.message_offset + index, message, model
+        )
+
+def open_conversation(conversation_id):
+    """会話を切り替える（保存済みの会話は直近のメッセージだけをメモリに読み込む）"""
+    st.session_state.conversation_id = conversation_id
+    st.session_state.messages = []
+    st.session_state.message_offset = 0
+    if conversation_id is not None:
+        store = get_conversation_store()
+        if not store.is_owner(conversation_id, st.session_state.owner_id):
+            # 他のブラウザの会話は開かない
+            st.session_state.conversation_id = None
+            return
+        count = store.count(conversation_id)
+        offset = max(0, count - DEFAULT_RESUME_MESSAGES)
+        st.session_state.messages = [
+            {"role": message["role"], "content": message["content"], "rendered": message["rendered"]}
+            for message in store.load(conversation_id, offset, count)
+        ]
+        st.session_state.message_offset = offset
+    st.session_state.history_manager = HistoryManager()
+    st.session_state.race_alternatives = {}
+    st.session_state.history_window = HISTORY_PAGE_SIZE
+
+def display_conversations():
+    """保存済みの会話の一覧を表示し、選んだ会話を再開できるようにする"""
+    if st.button("新しい会話", disabled=not st.session_state.messages):
+        open_conversation(None)
+        st.rerun()
+    conversations = get_conversation_store().conversations(st.session_state.owner_id, limit=20)
+    if not conversations:
+        return
+    with st.expander("保存した会話"):
+        for conversation_id, title, updated_at in conversations:
+            label = f"{datetime.fromtimestamp(updated_at).strftime('%m/%d %H:%M')} {title or '（無題）'}"
+            current = conversation_id == st.session_state.conversation_id
+            if st.button(label, key=f"conversation_{conversation_id}", disabled=current):
+                open_conversation(conversation_id)
+                st.rerun()
+
 def init_session_state():
     """セッション状態を初期化する"""
+    if "session_id" not in st.session_state:
+        # スケジューラーがセッション間で公平に順番を回すための識別子
+        st.session_state.session_id = uuid.uuid4().hex
+    
+    if "owner_id" not in st.session_state:
+        # 保存した会話の持ち主を表すブラウザの識別子。URLの ?owner= に保持し、同じURLを開けば会話を再開できる
+        owner = st.query_params.get("owner", "")
+        st.session_state.owner_id = owner if OWNER_ID_PATTERN.fullmatch(owner) else uuid.uuid4().hex
+    if st.query_params.get("owner") != st.session_state.owner_id:
+        st.query_params["owner"] = st.session_state.owner_id
+    
     if "messages" not in st.session_state:
         st.session_state.messages = []
     
+    if "conversation_id" not in st.session_state:
+        st.session_state.conversation_id = None
+    
+    if "message_offset" not in st.session_state:
+        # messages[0] の会話内での位置（再開した長い会話では古いメッセージを読み込まない）
+        st.session_state.message_offset = 0
+    
+    if "history_window" not in st.session_state:
+        st.session_state.history_window = HISTORY_PAGE_SIZE
+    
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
     
@@ -128,64 +623,188 @@ def init_session_state():
     if "top_p" not in st.session_state:
         st.session_state.top_p = 0.95
     
+    if "stream" not in st.session_state:
+        st.session_state.stream = True
+    
+    if "summarize_history" not in st.session_state:
+        st.session_state.summarize_history = True
+    
+    if "race_mode" not in st.session_state:
+        st.session_state.race_mode = False
+    
+    if "race_partner" not in st.session_state:
+        st.session_state.race_partner = None
+    
+    if "race_policy" not in st.session_state:
+        st.session_state.race_policy = DEFAULT_RACE_POLICY
+    
+    if "race_alternatives" not in st.session_state:
+        # メッセージの位置 -> 生成を続けている大きいモデル
+        st.session_state.race_alternatives = {}
+    
+    if "history_manager" not in st.session_state:
+        st.session_state.history_manager = HistoryManager()
+    
+    if "response_cache" not in st.session_state:
+        st.session_state.response_cache = RESPONSE_CACHE_ENABLED
+    
+    if "rag" not in st.session_state:
+        st.session_state.rag = bool(RAG_EMBEDDING_MODEL)
+    
+    if "rag_shared" not in st.session_state:
+        st.session_state.rag_shared = False
+    
+    if "rag_documents" not in st.session_state:
+        # このセッションで登録済みのアップロード（再実行のたびに読み込み直さない）
+        st.session_state.rag_documents = set()
+    
+    if "prefix_stats" not in st.session_state:
+        st.session_state.prefix_stats = PrefixCacheStats()
+    
     if "request_count" not in st.session_state:
         st.session_state.request_count = 0
     
     if "token_count" not in st.session_state:
         st.session_state.token_count = 0
     
-    if "token_history" not in st.session_state:
-        st.session_state.token_history = []
+    if "prompt_token_count" not in st.session_state:
+        st.session_state.prompt_token_count = 0
+    
+    if "completion_token_count" not in st.session_state:
+        st.session_state.completion_token_count = 0
+    
+    if "local_usage_count" not in st.session_state:
+        st.session_state.local_usage_count = 0
 
 def display_chat_history():
-    """チャット履歴を表示する"""
-    for message in st.session_state.messages:
+    """チャット履歴を表示する（直近のメッセージだけを描画し、古いものは求められたら読み込む）"""
+    messages = st.session_state.messages
+    offset = st.session_state.message_offset
+    start = max(0, offset + len(messages) - st.session_state.history_window)
+    if start > 0 and st.button(f"さらに古いメッセージを表示（残り {start} 件）"):
+        st.session_state.history_window += HISTORY_PAGE_SIZE
+        st.rerun()
+    if start < offset:
+        # メモリに読み込んでいない古いメッセージは、保存済みの整形結果を会話ストアから読む
+        for message in get_conversation_store().load(st.session_state.conversation_id, start, offset):
+            with st.chat_message(message["role"]):
+                st.markdown(message["rendered"])
+    for index in range(max(0, start - offset), len(messages)):
+        message = messages[index]
         with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+            st.markdown(rendered_markdown(message))
+            racer = st.session_state.race_alternatives.get(index)
+            if racer is not None:
+                display_race_alternative(index, racer)
 
 def display_metrics():
-    """メトリクスをグラフで表示する"""
-    token_history = st.session_state.token_history
-    
-    if token_history:
-        df = pd.DataFrame(token_history)
-        
-        # トークン使用量のグラフ
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.plot(df["timestamp"], df["tokens"], marker="o", linestyle="-", color="blue")
-        ax.set_title("トークン使用量の推移")
-        ax.set_xlabel("時間")
-        ax.set_ylabel("トークン数")
-        ax.tick_params(axis="x", rotation=45)
-        ax.grid(True)
-        st.pyplot(fig)
-        
-        # 統計情報
+    """メトリクスをグラフで表示する（全セッションで共有する集計済みの値を使う）"""
+    store = get_metrics_store()
+    
+    if store.request_count() or st.session_state.request_count:
+        windows = store.windows("tokens")
+        
+        # トークン使用量のグラフ（1分ごとの集計値）
+        # 再実行のたびに図を作らないよう、matplotlibではなくStreamlitのネイティブのグラフで描く
+        if windows:
+            st.caption("トークン使用量の推移（1分ごと・全セッション）")
+            st.line_chart(
+                {
+                    "時間": [datetime.fromtimestamp(start) for start, _, _, _ in windows],
+                    "トークン数": [total for _, _, total, _ in windows],
+                },
+                x="時間",
+                y="トークン数",
+                height=220
+            )
+        
+        # 統計情報（このセッション）
         st.markdown(f"**総リクエスト数:** {st.session_state.request_count}")
         st.markdown(f"**総トークン使用量:** {st.session_state.token_count}")
+        st.markdown(
+            f"**内訳:** プロンプト {st.session_state.prompt_token_count} / "
+            f"生成 {st.session_state.completion_token_count}"
+        )
+        if st.session_state.local_usage_count:
+            st.caption("※ usageを返さなかった応答はローカルのトークナイザーで計測しています")
+        
+        # 統計情報（全セッション）
+        tokens = store.summary("tokens")
+        if tokens["count"] > 1:
+            st.markdown(f"**平均トークン使用量/リクエスト:** {tokens['mean']:.2f}")
+        
+        tokens_per_sec = store.summary("tokens_per_sec")
+        if tokens_per_sec["count"]:
+            st.markdown(f"**平均生成速度:** {tokens_per_sec['mean']:.1f} tokens/秒")
         
-        if len(df) > 1:
-            avg_tokens = df["tokens"].mean()
-            st.markdown(f"**平均トークン使用量/リクエスト:** {avg_tokens:.2f}")
+        elapsed = store.summary("elapsed_time")
+        if elapsed["count"]:
+            st.markdown(f"**応答時間:** p50 {elapsed['p50']:.2f} 秒 / p95 {elapsed['p95']:.2f} 秒")
+        
+        queue_wait = store.summary("queue_wait")
+        if queue_wait["count"] and queue_wait["max"] > 0:
+            st.markdown(f"**順番待ち時間:** p50 {queue_wait['p50']:.2f} 秒 / p95 {queue_wait['p95']:.2f} 秒")
+        active, waiting, limit = get_scheduler().stats(st.session_state.model)
+        if active or waiting:
+            st.caption(f"現在のモデルの実行中: {active} / {limit}、順番待ち: {waiting} 件")
+        
+        prefix_stats = st.session_state.prefix_stats
+        if prefix_stats.hit_rate is not None:
+            st.markdown(
+                f"**プレフィックスキャッシュヒット率:** {prefix_stats.hit_rate * 100:.1f}% "
+                f"({prefix_stats.cached_tokens} / {prefix_stats.reported_prompt_tokens} トークン)"
+            )
+        else:
+            st.markdown("**プレフィックスキャッシュヒット率:** サーバー未報告")
+        if prefix_stats.stable_rate is not None:
+            st.caption(f"前回のプロンプトを再利用できたリクエスト: {prefix_stats.stable_rate * 100:.1f}%")
+        
+        if st.session_state.response_cache:
+            cache = get_cache()
+            hit_rate = cache.hit_rate
+            st.markdown(
+                f"**応答キャッシュ:** 完全一致 {cache.exact_hits} / 類似 {cache.semantic_hits} / "
+                f"ミス {cache.misses}" + (f"（ヒット率 {hit_rate * 100:.1f}%）" if hit_rate is not None else "")
+            )
+        
+        calls, shared, _ = get_group("chat").stats()
+        if shared:
+            st.markdown(f"**同じ質問の合流:** {shared} / {calls} 件（生成を共有し、GPUでの重複した生成を省略）")
+        
+        ttft = store.summary("ttft")
+        if ttft["count"]:
+            st.markdown(f"**TTFT:** p50 {ttft['p50']:.2f} 秒 / p95 {ttft['p95']:.2f} 秒")
+            itl = store.summary("itl")
+            if itl["count"]:
+                st.markdown(f"**平均トークン間レイテンシ:** {itl['mean'] * 1000:.1f} ms")
+        
+        race_results = [
+            (model, store.counter("race_wins", model), store.counter("race_losses", model))
+            for model in store.models()
+        ]
+        if any(wins or losses for _, wins, losses in race_results):
+            st.markdown("**レースの勝敗:**")
+            for model, wins, losses in race_results:
+                if wins or losses:
+                    ttft = store.summary("ttft", model)
+                    median = f"、TTFT p50 {ttft['p50']:.2f} 秒" if ttft["count"] else ""
+                    st.caption(f"{model}: {wins} 勝 {losses} 敗{median}")
 
 def main():
     """メイン関数"""
     init_session_state()
     
-    # GPUStackとの接続を確認（リトライ機能付き）
-    connected = False
-    for i in range(3):  # 最大3回リトライ
-        if check_gpustack_connection():
-            connected = True
-            break
-        if i < 2:  # 最後のリトライではメッセージを表示しない
-            st.info(f"GPUStackサーバーへの接続を試みています... ({i+1}/3)")
-            time.sleep(2)
-    
-    if not connected:
+    # GPUStackとの接続状態とモデル一覧はキャッシュから取得する（バックグラウンドで更新）
+    if not check_gpustack_connection():
         st.error("GPUStackサーバーに接続できません。サーバーが実行中であることを確認してください。")
+        error = get_model_cache().get().error
+        if error:
+            st.caption(f"詳細: {error}")
         st.info("以下のコマンドを実行してGPUStackを起動してください:")
         st.code("gpustack start")
+        if st.button("再接続"):
+            get_model_cache().invalidate(wait=True)
+            st.rerun()
         return
     
     # 利用可能なモデルを取得
@@ -195,18 +814,65 @@ def main():
         st.warning("デプロイされているモデルが見つかりません。モデルをデプロイしてください。")
         st.info("以下のコマンドを実行してモデルをデプロイしてください:")
         st.code("python ../scripts/model_setup.py")
+        if st.button("モデル一覧を更新"):
+            get_model_cache().invalidate(wait=True)
+            st.rerun()
         return
     
     # サイドバーにパラメータ設定
     with st.sidebar:
+        if CONVERSATION_STORE_ENABLED:
+            st.header("会話")
+            display_conversations()
+            st.markdown("---")
+        
         st.header("モデル設定")
         
+        # 複数のモデルがあれば、プロンプトごとにモデルを選ぶ「自動選択」を選べる
+        model_options = [AUTO_MODEL] + available_models if len(available_models) > 1 else available_models
         selected_model = st.selectbox(
             "モデルを選択",
-            available_models,
-            index=0 if available_models else None
+            model_options,
+            index=model_options.index(available_models[0]) if available_models else None,
+            format_func=lambda model: "自動選択（質問の難しさと混雑状況で選ぶ）" if model == AUTO_MODEL else model
         )
         
+        race_models = None
+        if selected_model == AUTO_MODEL:
+            store = get_metrics_store()
+            routed = [(model, store.counter("router_selected", model)) for model in available_models]
+            if any(count for _, count in routed):
+                st.caption("自動選択の内訳: " + " / ".join(f"{model} {count} 回" for model, count in routed if count))
+        elif len(available_models) > 1:
+            st.session_state.race_mode = st.checkbox(
+                "レースモード",
+                value=st.session_state.race_mode,
+                help="選択したモデルともう1つのモデルに同時に送信し、先に応答し始めたモデルの回答を表示します（常にストリーミングで送信します）"
+            )
+            if st.session_state.race_mode:
+                partners = order_by_size([model for model in available_models if model != selected_model])
+                partner = st.selectbox(
+                    "同時に送信するモデル",
+                    partners,
+                    # 既定では最も大きいモデルと競わせる
+                    index=partners.index(st.session_state.race_partner)
+                    if st.session_state.race_partner in partners else len(partners) - 1
+                )
+                st.session_state.race_policy = st.selectbox(
+                    "大きいモデルが負けた場合",
+                    RACE_POLICIES,
+                    index=RACE_POLICIES.index(st.session_state.race_policy),
+                    format_func=RACE_POLICY_LABELS.get
+                )
+                st.session_state.race_partner = partner
+                race_models = [selected_model, partner]
+        
+        snapshot = get_model_cache().get()
+        st.caption(f"モデル一覧の最終更新: {int(snapshot.age)} 秒前")
+        if st.button("モデル一覧を更新"):
+            get_model_cache().invalidate(wait=True)
+            st.rerun()
+        
         temperature = st.slider(
             "Temperature",
             min_value=0.0,
@@ -234,10 +900,76 @@ def main():
             help="トークン選択の確率閾値"
         )
         
+        stream = st.checkbox(
+            "ストリーミング表示",
+            value=st.session_state.stream,
+            help="生成されたトークンを到着順に表示します"
+        )
+        
+        summarize_history = st.checkbox(
+            "古い履歴を要約する",
+            value=st.session_state.summarize_history,
+            help="コンテキスト長を超えた古いターンを削除せず要約して残します"
+        )
+        
         st.session_state.model = selected_model
         st.session_state.temperature = temperature
         st.session_state.max_tokens = max_tokens
         st.session_state.top_p = top_p
+        st.session_state.stream = stream
+        st.session_state.summarize_history = summarize_history
+        
+        st.session_state.response_cache = st.checkbox(
+            "応答キャッシュ",
+            value=st.session_state.response_cache,
+            help="Temperatureが0のとき、同じ（または類似の）質問には保存済みの応答を返します"
+        )
+        
+        if RAG_EMBEDDING_MODEL:
+            st.session_state.rag = st.checkbox(
+                "資料を参照する（RAG）",
+                value=st.session_state.rag,
+                help="登録した資料から質問に関係する部分だけを検索し、プロンプトに入れて回答させます"
+            )
+            if st.session_state.rag:
+                files = st.file_uploader(
+                    "資料を登録",
+                    type=["txt", "md", "csv", "json", "py", "html"],
+                    accept_multiple_files=True,
+                    help="長い資料はチャンクに分けて埋め込みます。同じ内容の資料は埋め込み直しません"
+                )
+                if files:
+                    add_documents(files)
+                index = get_document_index()
+                documents = index.documents() if index is not None else []
+                if documents:
+                    st.caption(f"登録済みの資料: {len(documents)} 件（{sum(chunks for _, chunks, _ in documents)} チャンク）")
+                shared_index = get_shared_index()
+                shared_documents = shared_index.documents() if shared_index is not None else []
+                if shared_documents:
+                    st.session_state.rag_shared = st.checkbox(
+                        f"共有の資料も参照する（{len(shared_documents)} 件）",
+                        value=st.session_state.rag_shared,
+                        help="管理者が scripts/rag_index.py で登録した、全員が参照できる資料も検索します"
+                    )
+        
+        if len(GPUSTACK_API_BASES) > 1:
+            with st.expander("エンドポイント"):
+                for status in get_pool().status():
+                    latency = f"{status['ewma_latency']:.2f} 秒" if status["ewma_latency"] is not None else "-"
+                    st.caption(
+                        f"{'🟢' if status['healthy'] else '🔴'} {status['url']} "
+                        f"処理中 {status['outstanding']} / EWMA {latency} / "
+                        f"失敗 {status['failures']}（切り離し {status['ejections']} 回）"
+                        + (" / ⛔ ブレーカー遮断中" if status["breaker"] == "open" else "")
+                    )
+        
+        history_manager = st.session_state.history_manager
+        if history_manager.last_budget:
+            st.caption(
+                f"直近のプロンプト: {history_manager.last_prompt_tokens} / "
+                f"{history_manager.last_budget} トークン"
+            )
         
         st.markdown("---")
         
@@ -254,10 +986,17 @@ def main():
         # メトリクスの表示
         st.subheader("使用状況")
         display_metrics()
+        
+        if st.checkbox("GPUStackサーバーのメトリクスを表示"):
+            usage, error = get_model_usage()
+            if usage:
+                st.json(usage)
+            else:
+                st.caption(f"サーバーのメトリクスを取得できませんでした: {error}")
     
     # メインエリアのタイトル
     st.title("GPUStack ローカルLLMチャットボット")
-    st.caption(f"現在のモデル: {st.session_state.model}")
+    st.caption(f"現在のモデル: {'自動選択' if st.session_state.model == AUTO_MODEL else st.session_state.model}")
     
     # チャット履歴を表示
     display_chat_history()
@@ -266,8 +1005,8 @@ def main():
     user_input = st.chat_input("メッセージを入力してください...")
     
     if user_input:
-        # ユーザーメッセージを追加
-        st.session_state.messages.append({"role": "user", "content": user_input})
+        # ユーザーメッセージを追加（正規化は追加時の一度だけ行い、以降は変更しない）
+        add_message(canonical_message("user", user_input))
         
         with st.chat_message("user"):
             st.markdown(user_input)
@@ -277,41 +1016,202 @@ def main():
             message_placeholder = st.empty()
             message_placeholder.markdown("考え中...")
             
-            # チャットの履歴を作成
-            history = [{"role": "system", "content": system_prompt}]
-            for msg in st.session_state.messages:
-                history.append({"role": msg["role"], "content": msg["content"]})
+            # 自動選択ではプロンプトの難しさ・履歴の長さ・各モデルの混雑状況から送信先を決める
+            model = st.session_state.model
+            if model == AUTO_MODEL:
+                context_tokens = st.session_state.max_tokens + sum(
+                    message_tokens(message) for message in st.session_state.messages
+                )
+                decision = get_router().route(user_input, available_models, context_tokens)
+                model = decision.model
+                get_metrics_store().increment("router_selected", model)
+                st.caption(f"🧭 {model} に送信します（{decision.reason}）")
             
-            # モデルとチャット
-            start_time = time.time()
-            response = chat_with_model(
-                st.session_state.model,
-                history,
-                max_tokens=st.session_state.max_tokens,
-                temperature=st.session_state.temperature,
-                top_p=st.session_state.top_p
+            # 資料を参照する場合は、質問に関係するチャンクだけを検索する
+            context, chunks = retrieve_context(user_input, model) if st.session_state.rag else (None, [])
+            if chunks:
+                with st.expander(f"📚 参照した資料（{len(chunks)} 件）"):
+                    for chunk in chunks:
+                        st.caption(f"{chunk.document} #{chunk.seq + 1}（類似度 {chunk.score:.2f}）")
+                        st.text(chunk.text)
+            
+            # コンテキスト長に収まるようにチャットの履歴を作成（資料の分は生成分と同様に予算から差し引く）
+            summarize = None
+            if st.session_state.summarize_history:
+                def summarize(dropped, previous_summary):
+                    return summarize_messages(model, dropped, previous_summary)
+            history = st.session_state.history_manager.build(
+                model,
+                canonical_system_prompt(system_prompt),
+                st.session_state.messages,
+                st.session_state.max_tokens + (count_tokens(context, model) if context else 0),
+                summarize=summarize
             )
+            history = inject_context(history, context)
+            
+            st.session_state.prefix_stats.observe_prompt(history)
+            
+            # 決定的なリクエストは応答キャッシュを先に確認する
+            params = {
+                "max_tokens": st.session_state.max_tokens,
+                "temperature": st.session_state.temperature,
+                "top_p": st.session_state.top_p,
+            }
+            # レースモードでは応答するモデルが決まっていないため応答キャッシュは使わない
+            cache = None
+            if st.session_state.response_cache and is_cacheable(params) and not race_models:
+                cache = get_cache()
+            cache_lookup = cache.lookup(model, history, params) if cache else None
+            
+            # モデルとチャット（モデルごとの同時実行数を超える分は順番待ちになる）
+            start_time = time.time()
+            queue_wait = None
+            ttft = None
+            itl = None
+            usage = None
+            race = None
+            shared = False
+            # ストリーミングの途中で失敗した場合の例外（途中までの応答は表示するが記録しない）
+            stream_error = None
+            if cache_lookup and cache_lookup.hit:
+                response = cache_lookup.response
+            elif race_models:
+                # 両方のモデルに送り、最初のトークンが早い方の回答を表示する
+                race = start_race(race_models, history)
+                winner = race.wait_winner()
+                if winner is None:
+                    message_placeholder.empty()
+                    report_race_failure(race)
+                    response = None
+                else:
+                    model = winner.model
+                    start_time = winner.started_at
+                    queue_wait = winner.queue_wait
+                    try:
+                        response = render_stream(race.iter_winner(), message_placeholder)
+                    except BaseException:
+                        # 描画中に再実行されたら、どちらのモデルの生成も止める
+                        race.cancel()
+                        raise
+                    ttft = winner.stream.ttft
+                    itl = winner.stream.mean_itl
+                    usage = winner.stream.usage
+                    stream_error = winner.error
+                    if stream_error is not None:
+                        report_chat_error(model, stream_error, prefix="ストリーミング中にエラーが発生しました: ")
+            else:
+                def on_wait(position):
+                    message_placeholder.markdown(f"混雑中のため順番待ちしています...（前に {position} 件）")
+                
+                def generate(flight=None):
+                    """(応答, TTFT, トークン間レイテンシ, usage, 生成を共有したかどうか, 途中で失敗した例外) を返す"""
+                    if st.session_state.stream:
+                        stream = stream_chat_with_model(model, history, flight=flight, **params)
+                        if stream is None:
+                            return None, None, None, None, False, None
+                        response = render_stream(stream, message_placeholder)
+                        return response, stream.ttft, stream.mean_itl, stream.usage, stream.shared, stream.error
+                    result = chat_with_model(model, history, flight=flight, **params)
+                    if result is None:
+                        return None, None, None, None, False, None
+                    return result.text, None, None, result.usage, result.shared, None
+                
+                try:
+                    # 同じ質問を生成中なら、実行枠を待たずにその生成に合流する（確認と合流は1回の操作で行う）
+                    flight = join_chat(model, history, stream=st.session_state.stream, **params)
+                    if flight is not None:
+                        response, ttft, itl, usage, shared, stream_error = generate(flight)
+                    else:
+                        with get_scheduler().slot(
+                            model,
+                            st.session_state.session_id,
+                            timeout=QUEUE_TIMEOUT,
+                            on_wait=on_wait
+                        ) as ticket:
+                            # 生成時間は実行枠を得てから計測し、待ち時間は別に記録する
+                            queue_wait = ticket.wait_time
+                            start_time = time.time()
+                            if queue_wait:
+                                message_placeholder.markdown("考え中...")
+                            response, ttft, itl, usage, shared, stream_error = generate()
+                except QueueFullError:
+                    message_placeholder.empty()
+                    st.warning("リクエストが混み合っています。しばらく待ってから再度送信してください。")
+                    response = None
+                except QueueTimeoutError:
+                    message_placeholder.empty()
+                    st.warning("順番待ちがタイムアウトしました。しばらく待ってから再度送信してください。")
+                    response = None
             end_time = time.time()
             
             if response:
-                message_placeholder.markdown(response)
-                
                 # アシスタントメッセージを追加
-                st.session_state.messages.append({"role": "assistant", "content": response})
+                message = canonical_message("assistant", response)
+                add_message(message, model)
+                message_placeholder.markdown(rendered_markdown(message))
                 
                 # メトリクスを更新
                 st.session_state.request_count += 1
+                elapsed_time = end_time - start_time
+                
+                if cache_lookup and cache_lookup.hit:
+                    # キャッシュから返した応答はトークンを消費していない
+                    st.caption("💾 キャッシュされた応答" + ("（類似の質問）" if cache_lookup.kind == "semantic" else ""))
+                    st.session_state.prefix_stats.observe_response(response, None, 0)
+                    get_metrics_store().increment(f"response_cache_{cache_lookup.kind}_hits", model)
+                    return
+                
+                if race is not None:
+                    st.caption(f"⚡ {model} が先に応答しました（TTFT {ttft:.2f} 秒）")
+                if shared:
+                    st.caption("🔗 同時に送信された同じ質問と生成を共有しました")
+                if stream_error is not None:
+                    st.caption("⚠️ 応答が途中で途切れたため、応答キャッシュと性能のメトリクスには記録していません")
+                
+                # トークン数はAPIのusageを優先し、なければローカルのトークナイザーで数える
+                prompt_tokens, completion_tokens, usage_source = resolve_token_usage(
+                    usage, history, response, model
+                )
+                total_tokens = prompt_tokens + completion_tokens
+                cached_tokens = st.session_state.prefix_stats.observe_response(response, usage, prompt_tokens)
+                st.session_state.prompt_token_count += prompt_tokens
+                st.session_state.completion_token_count += completion_tokens
+                st.session_state.token_count += total_tokens
+                
+                # 途中で途切れた応答は、同じ質問に返し続けないようキャッシュしない
+                if cache_lookup and stream_error is None:
+                    cache.store(cache_lookup, model, response, usage)
+                
+                if usage_source == "local":
+                    st.session_state.local_usage_count += 1
                 
-                # トークン数の概算（実際のトークン数はAPIから取得できれば理想的）
-                # 簡易的な推定として、単語数の1.3倍をトークン数として計算
-                estimated_tokens = int(len(response.split()) * 1.3)
-                st.session_state.token_count += estimated_tokens
+                # 共有した生成のレイテンシとトークンは、最初に送信したリクエストの分として記録済み
+                # 途中で途切れた応答の生成速度やレイテンシは実際の性能を表さないため記録しない
+                if not shared and stream_error is None:
+                    metrics_exporter.observe_request(
+                        model,
+                        elapsed_time=elapsed_time,
+                        ttft=ttft,
+                        tokens_per_sec=completion_tokens / elapsed_time if elapsed_time > 0 else None,
+                        queue_wait=queue_wait,
+                        prompt_tokens=prompt_tokens,
+                        completion_tokens=completion_tokens
+                    )
+                    get_metrics_store().record(
+                        model=model,
+                        tokens=total_tokens,
+                        prompt_tokens=prompt_tokens,
+                        completion_tokens=completion_tokens,
+                        cached_tokens=cached_tokens,
+                        elapsed_time=elapsed_time,
+                        tokens_per_sec=completion_tokens / elapsed_time if elapsed_time > 0 else None,
+                        ttft=ttft,
+                        itl=itl,
+                        queue_wait=queue_wait
+                    )
                 
-                st.session_state.token_history.append({
-                    "timestamp": datetime.now().strftime("%H:%M:%S"),
-                    "tokens": estimated_tokens,
-                    "elapsed_time": end_time - start_time
-                })
+                if race is not None:
+                    finish_race(race, message_placeholder)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+会話履歴の永続化
+会話をSQLiteに追記のみで保存し、ブラウザのセッションが終わっても再開できるようにします。
+メッセージの差し替え（レースモードでの回答の切り替えなど）も新しい版の追記として記録し、
+読み込み時に各位置の最新版を返します。表示用に整形したMarkdownも一緒に保存するため、
+古いページを読み込むときに整形し直す必要はありません。
+会話には持ち主（ブラウザごとの識別子）を記録し、一覧や再開は持ち主の会話に限ります。
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_STORE_PATH = os.path.expanduser("~/.gpustack/conversations.db")
+# 一度に表示するメッセージ数（「さらに古いメッセージを表示」で増やす）
+DEFAULT_PAGE_SIZE = 20
+# 会話を再開するときにメモリに読み込むメッセージ数（送信する履歴の組み立てに使う）
+DEFAULT_RESUME_MESSAGES = 200
+TITLE_LENGTH = 40
+
+_FENCE_PATTERN = re.compile(r"^[ \t]*(```|~~~)", re.MULTILINE)
+_DISPLAY_MATH = re.compile(r"\\\[(.+?)\\\]", re.DOTALL)
+_INLINE_MATH = re.compile(r"\\\((.+?)\\\)", re.DOTALL)
+
+_lock = threading.Lock()
+_stores = {}
+
+
+def render_markdown(content):
+    """モデルの出力を表示用のMarkdownに整える
+
+    LaTeXの \\[...\\] と \\(...\\) をStreamlitが数式として表示できる $$...$$ と $...$ に変換し、
+    生成が途中で止まって閉じられていないコードブロックを閉じます。コードブロックの中は変更しません。
+    """
+    parts = re.split(r"(^[ \t]*(?:```|~~~).*$)", content or "", flags=re.MULTILINE)
+    in_code = False
+    for index, part in enumerate(parts):
+        if _FENCE_PATTERN.match(part):
+            in_code = not in_code
+        elif not in_code:
+            part = _DISPLAY_MATH.sub(lambda m: f"$${m.group(1)}$$", part)
+            parts[index] = _INLINE_MATH.sub(lambda m: f"${m.group(1)}$", part)
+    text = "".join(parts)
+    if in_code:
+        text += "\n```"
+    return text
+
+
+def _title(content):
+    lines = (content or "").strip().splitlines()
+    return lines[0][:TITLE_LENGTH] if lines else None
+
+
+def rendered_markdown(message):
+    """メッセージの表示用Markdown（整形結果はメッセージに保持し、再実行のたびに整形しない）"""
+    rendered = message.get("rendered")
+    if rendered is None:
+        rendered = render_markdown(message.get("content"))
+        message["rendered"] = rendered
+    return rendered
+
+
+class ConversationStore:
+    """会話とメッセージを追記のみで保存するSQLiteストア"""
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WALでは NORMAL でも電源断以外でコミット済みのデータは失われない
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                rendered TEXT NOT NULL,
+                model TEXT,
+                created_at REAL NOT NULL
+            )"""
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")}
+        if "owner" not in columns:
+            # 持ち主を記録していなかった版のデータベースに列を追加する（既存の会話は誰にも表示しない）
+            self._conn.execute("ALTER TABLE conversations ADD COLUMN owner TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_seq ON messages (conversation_id, seq, id)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversations_owner ON conversations (owner, updated_at)"
+        )
+        self._conn.commit()
+
+    def create(self, owner, title=None):
+        """owner の新しい会話を作成してIDを返す"""
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO conversations (id, owner, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (conversation_id, owner, title, now, now),
+            )
+            self._conn.commit()
+        return conversation_id
+
+    def append(self, conversation_id, seq, message, model=None):
+        """seq番目のメッセージを追記する（同じseqを追記するとその位置の新しい版になる）"""
+        rendered = rendered_markdown(message)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO messages (conversation_id, seq, role, content, rendered, model, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (conversation_id, seq, message["role"], message["content"], rendered, model, now),
+            )
+            # 最初のユーザー発言を会話のタイトルにする
+            title = _title(message["content"]) if message["role"] == "user" else None
+            self._conn.execute(
+                "UPDATE conversations SET updated_at = ?, title = COALESCE(title, ?) WHERE id = ?",
+                (now, title, conversation_id),
+            )
+            self._conn.commit()
+
+    def count(self, conversation_id):
+        """会話のメッセージ数"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(seq) FROM messages WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def load(self, conversation_id, start=0, end=None):
+        """seqが start 以上 end 未満のメッセージ（各位置の最新版）を古い順に返す"""
+        end = self.count(conversation_id) if end is None else end
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content, rendered, model FROM messages WHERE id IN ("
+                "SELECT MAX(id) FROM messages WHERE conversation_id = ? AND seq >= ? AND seq < ? GROUP BY seq"
+                ") ORDER BY seq",
+                (conversation_id, start, end),
+            ).fetchall()
+        return [
+            {"role": role, "content": content, "rendered": rendered, "model": model}
+            for role, content, rendered, model in rows
+        ]
+
+    def is_owner(self, conversation_id, owner):
+        """会話が owner のものかどうか"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM conversations WHERE id = ? AND owner = ?", (conversation_id, owner)
+            ).fetchone()
+        return row is not None
+
+    def conversations(self, owner, limit=50):
+        """owner の会話の、最近更新された順の (ID, タイトル, 最終更新時刻) のリスト"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, title, updated_at FROM conversations WHERE owner = ? ORDER BY updated_at DESC LIMIT ?",
+                (owner, limit),
+            ).fetchall()
+
+
+def get_conversation_store():
+    """環境変数の設定で作成した、プロセス全体で共有する会話ストアを返す"""
+    path = os.path.expanduser(os.getenv("CONVERSATION_STORE_PATH", DEFAULT_STORE_PATH))
+    store = _stores.get(path)
+    if store is None:
+        with _lock:
+            store = _stores.get(path)
+            if store is None:
+                store = ConversationStore(path)
+                _stores[path] = store
+    return store
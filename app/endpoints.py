@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+複数のGPUStackエンドポイント間の負荷分散とフェイルオーバー
+GPUSTACK_API_BASES に列挙した同じモデルを提供するノードへ、
+処理中リクエスト数が最少のノード（least_outstanding）または
+レイテンシのEWMAが最小のノード（ewma）を選んでリクエストを振り分けます。
+連続して失敗したノードは一定時間切り離し（受動的な検出）、
+バックグラウンドの能動プローブで復旧を確認してから戻します。
+サーキットブレーカーはノードごとに持ち、失敗が続くノードだけを遮断して他のノードに振り分けます。
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+import metrics_exporter
+from gpustack_client import ClientErrors, auth_headers, get_session
+from resilience import CircuitOpenError, classify_error, get_breaker, response_error
+
+STRATEGIES = ("least_outstanding", "ewma")
+DEFAULT_STRATEGY = "least_outstanding"
+DEFAULT_EJECT_AFTER = 3
+DEFAULT_EJECT_SECONDS = 30.0
+DEFAULT_PROBE_INTERVAL = 5.0
+EWMA_ALPHA = 0.3
+PROBE_TIMEOUT = 3
+# 別のノードで再試行してよいHTTPステータス（リクエストが処理されていない可能性が高いもの）
+RETRYABLE_STATUS = (502, 503)
+# ゲートウェイのタイムアウト（上流のサーバーが処理を続けている可能性がある）
+TIMEOUT_STATUS = (504,)
+
+_lock = threading.Lock()
+_pools = {}
+
+
+def _status_in(error, statuses):
+    if isinstance(error, ClientErrors.api_status):
+        return error.status_code in statuses
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in statuses
+    return False
+
+
+def is_timeout(error):
+    """応答待ちのタイムアウトかどうか（リクエストはサーバーに届いており、処理中の可能性がある）"""
+    if isinstance(error, ClientErrors.connect_timeout + ClientErrors.pool_timeout
+                  + (requests.exceptions.ConnectTimeout,)):
+        # 接続前のタイムアウトはリクエストを送っていない
+        return False
+    if isinstance(error, ClientErrors.api_timeout + ClientErrors.timeout + (requests.exceptions.Timeout,)):
+        return True
+    return _status_in(error, TIMEOUT_STATUS)
+
+
+def is_retryable(error):
+    """別のノードで安全に再試行できる失敗（リクエストが処理されていない接続失敗・ゲートウェイエラー）かどうか"""
+    if is_timeout(error):
+        return False
+    if isinstance(error, ClientErrors.api_connection + ClientErrors.transport
+                  + (requests.exceptions.ConnectionError,)):
+        return True
+    return _status_in(error, RETRYABLE_STATUS)
+
+
+class Endpoint:
+    """1ノード分の状態（処理中の数・レイテンシのEWMA・切り離し状態）"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.requests = 0
+        self.failures = 0
+        # ストリーミングの途中の失敗も含め、このノードへのリクエストの成否を記録するブレーカー
+        self.breaker = get_breaker(self.url)
+
+    def is_healthy(self, now=None):
+        return (time.time() if now is None else now) >= self.ejected_until
+
+    def score(self, strategy):
+        """小さいほど優先して選ばれる"""
+        # まだ計測値のないノードには一度振ってレイテンシを学習させる
+        latency = self.ewma_latency if self.ewma_latency is not None else 0.0
+        if strategy == "ewma":
+            return (latency * (self.outstanding + 1), self.outstanding)
+        return (self.outstanding, latency)
+
+
+class EndpointPool:
+    """エンドポイントの選択・受動的な切り離し・能動プローブを行うプール"""
+
+    def __init__(self, urls, api_key=None, strategy=DEFAULT_STRATEGY,
+                 eject_after=DEFAULT_EJECT_AFTER, eject_seconds=DEFAULT_EJECT_SECONDS,
+                 probe_interval=DEFAULT_PROBE_INTERVAL):
+        if not urls:
+            raise ValueError("エンドポイントが1つも指定されていません")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"未知の振り分け方式です: {strategy}")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.api_key = api_key
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def acquire(self, exclude=()):
+        """次にリクエストを送るエンドポイントを選び、処理中の数を加算する"""
+        now = time.time()
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep not in exclude]
+            if not candidates:
+                return None
+            healthy = [ep for ep in candidates if ep.is_healthy(now)]
+            if healthy:
+                endpoint = min(healthy, key=lambda ep: ep.score(self.strategy))
+            else:
+                # 全ノードが切り離されている場合は、最も早く復帰予定のノードに送る
+                endpoint = min(candidates, key=lambda ep: ep.ejected_until)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        self.start()
+        return endpoint
+
+    def release(self, endpoint, latency=None, error=None, info=None):
+        """リクエストの完了を記録する。errorが再試行対象の失敗なら切り離しの判定に使う
+
+        error（または例外を送出しない応答の分類済みのエラー info）はノードのブレーカーにも記録する。
+        ストリーミングでは読み終えたときに呼ぶため、途中で切れた応答も失敗として数える。
+        """
+        endpoint.breaker.record(classify_error(error) if error is not None else info)
+        with self._lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            # 応答しないノードも切り離しの対象にするため、タイムアウトも失敗として数える
+            if error is not None and (is_retryable(error) or is_timeout(error)):
+                self._mark_failure(endpoint)
+            elif error is None and info is None:
+                self._mark_success(endpoint, latency)
+
+    def _abandon(self, endpoint):
+        """送信しなかったリクエストの取得を取り消す"""
+        with self._lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            endpoint.requests = max(0, endpoint.requests - 1)
+
+    def _mark_success(self, endpoint, latency=None):
+        endpoint.consecutive_failures = 0
+        endpoint.ejected_until = 0.0
+        if latency is not None:
+            if endpoint.ewma_latency is None:
+                endpoint.ewma_latency = latency
+            else:
+                endpoint.ewma_latency += EWMA_ALPHA * (latency - endpoint.ewma_latency)
+
+    def _mark_failure(self, endpoint):
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.eject_after:
+            if endpoint.is_healthy():
+                endpoint.ejections += 1
+            endpoint.ejected_until = time.time() + self.eject_seconds
+
+    @contextmanager
+    def lease(self, exclude=()):
+        """with文の間だけエンドポイントを借り、所要時間と失敗を記録する"""
+        endpoint = self.acquire(exclude)
+        start = time.perf_counter()
+        try:
+            yield endpoint
+        except Exception as e:
+            self.release(endpoint, error=e)
+            raise
+        else:
+            self.release(endpoint, latency=time.perf_counter() - start)
+
+    def call(self, func, idempotent=True, model=None, keep_lease=False):
+        """func(endpoint) を実行し、再試行可能な失敗なら別のノードで再試行する
+
+        idempotent=False（生成など）の場合は、リクエストが処理されていない失敗だけを再試行し、
+        サーバーが処理している可能性があるタイムアウトは再試行しない。
+        keep_lease=True の場合は成功しても処理中のまま (結果, エンドポイント) を返すので、
+        ストリーミングを読み終えた後に呼び出し側で release() してください。
+        """
+        tried = []
+        attempts = len(self.endpoints)
+        for attempt in range(attempts):
+            endpoint = self.acquire(exclude=tried)
+            try:
+                endpoint.breaker.allow()
+            except CircuitOpenError:
+                # ブレーカーが開いているノードには送らず、別のノードを試す（全ノードが遮断中なら送出する）
+                self._abandon(endpoint)
+                tried.append(endpoint)
+                if attempt + 1 >= attempts:
+                    raise
+                continue
+            start = time.perf_counter()
+            try:
+                result = func(endpoint)
+            except Exception as e:
+                self.release(endpoint, error=e)
+                if attempt + 1 >= attempts or not (is_retryable(e) or (idempotent and is_timeout(e))):
+                    raise
+                tried.append(endpoint)
+                metrics_exporter.observe_retry(model)
+                continue
+            if keep_lease:
+                return result, endpoint
+            # 例外を送出せずにエラーのステータスコードを返す応答（requests.Response など）も失敗として記録する
+            self.release(endpoint, latency=time.perf_counter() - start, info=response_error(result))
+            return result
+
+    def probe(self, endpoint):
+        """/models に問い合わせてノードが応答するか確認する"""
+        try:
+            response = get_session().get(
+                f"{endpoint.url}/models",
+                headers=auth_headers(self.api_key),
+                timeout=PROBE_TIMEOUT,
+            )
+            ok = response.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        with self._lock:
+            if ok:
+                # プローブの応答時間は推論のレイテンシと性質が異なるためEWMAには入れない
+                self._mark_success(endpoint)
+            else:
+                self._mark_failure(endpoint)
+        return ok
+
+    def start(self):
+        """切り離したノードを能動的にプローブするスレッドを起動する（1ノードなら不要）"""
+        if len(self.endpoints) < 2 or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="endpoint-probe", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.probe_interval):
+            for endpoint in self.endpoints:
+                # 切り離し中か、直近で失敗しているノードだけを確認する
+                if not endpoint.is_healthy() or endpoint.consecutive_failures:
+                    self.probe(endpoint)
+
+    def status(self):
+        """UI表示用のノードごとの状態"""
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "url": ep.url,
+                    "healthy": ep.is_healthy(now),
+                    "outstanding": ep.outstanding,
+                    "ewma_latency": ep.ewma_latency,
+                    "requests": ep.requests,
+                    "failures": ep.failures,
+                    "ejections": ep.ejections,
+                    "breaker": ep.breaker.state,
+                }
+                for ep in self.endpoints
+            ]
+
+
+def get_api_bases(default=None):
+    """GPUSTACK_API_BASES（カンマ区切り）、なければ GPUSTACK_API_BASE を返す"""
+    bases = [url.strip() for url in os.getenv("GPUSTACK_API_BASES", "").split(",") if url.strip()]
+    if not bases:
+        bases = [default or os.getenv("GPUSTACK_API_BASE", "http://localhost:8000/v1")]
+    return bases
+
+
+def get_endpoint_pool(api_bases, api_key=None):
+    """エンドポイントの組み合わせごとに共有するプールを返す"""
+    key = (tuple(api_bases), api_key or "")
+    pool = _pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = EndpointPool(
+                    list(api_bases),
+                    api_key,
+                    strategy=os.getenv("GPUSTACK_LB_STRATEGY", DEFAULT_STRATEGY),
+                    eject_after=int(os.getenv("GPUSTACK_EJECT_AFTER", DEFAULT_EJECT_AFTER)),
+                    eject_seconds=float(os.getenv("GPUSTACK_EJECT_SECONDS", DEFAULT_EJECT_SECONDS)),
+                    probe_interval=float(os.getenv("GPUSTACK_PROBE_INTERVAL", DEFAULT_PROBE_INTERVAL)),
+                )
+                _pools[key] = pool
+    return pool
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GPUStack APIクライアント共通モジュール
+プロセス全体で共有するHTTPセッションとOpenAIクライアントを提供し、
+keep-aliveのコネクションプールで接続を再利用します
+openai（とhttpx）は読み込みに時間がかかるため、最初にクライアントを作るときに読み込みます
+"""
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# コネクションプールとタイムアウトのデフォルト値（環境変数で上書き可能）
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 120.0
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+
+_lock = threading.Lock()
+_session = None
+_openai_clients = {}
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def get_pool_size():
+    """コネクションプールのサイズ"""
+    return max(1, _env_int("GPUSTACK_POOL_SIZE", DEFAULT_POOL_SIZE))
+
+
+def get_timeout():
+    """(接続タイムアウト, 読み込みタイムアウト) を秒で返す"""
+    return (
+        _env_float("GPUSTACK_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT),
+        _env_float("GPUSTACK_READ_TIMEOUT", DEFAULT_READ_TIMEOUT),
+    )
+
+
+def auth_headers(api_key=None):
+    """APIキーがあればAuthorizationヘッダーを返す"""
+    if api_key:
+        return {"Authorization": f"Bearer {api_key}"}
+    return {}
+
+
+class _PooledSession(requests.Session):
+    """タイムアウト未指定のリクエストにデフォルトのタイムアウトを適用するセッション"""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", get_timeout())
+        return super().request(method, url, **kwargs)
+
+
+def get_session():
+    """プロセス全体で共有するrequestsセッションを返す"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                pool_size = get_pool_size()
+                session = _PooledSession()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+class ClientErrors:
+    """openai・httpx の例外の型（resolve_client_errors() を呼ぶまでは空のタプルで、isinstance は常に False）
+
+    これらの例外はクライアントを使うまで送出されないため、例外の判定のためだけに openai や httpx を読み込まず、
+    最初にクライアントを作るときに一度だけ型を解決します。
+    """
+
+    resolved = False
+    api_status = ()
+    api_timeout = ()
+    api_connection = ()
+    http_status = ()
+    connect_timeout = ()
+    connect_error = ()
+    pool_timeout = ()
+    timeout = ()
+    transport = ()
+
+
+def resolve_client_errors():
+    """openai と httpx を読み込んで ClientErrors の型を解決する（2回目以降は何もしない）"""
+    if ClientErrors.resolved:
+        return
+    import httpx
+    import openai
+    ClientErrors.api_status = (openai.APIStatusError,)
+    ClientErrors.api_timeout = (openai.APITimeoutError,)
+    ClientErrors.api_connection = (openai.APIConnectionError,)
+    ClientErrors.http_status = (httpx.HTTPStatusError,)
+    ClientErrors.connect_timeout = (httpx.ConnectTimeout,)
+    ClientErrors.connect_error = (httpx.ConnectError,)
+    ClientErrors.pool_timeout = (httpx.PoolTimeout,)
+    ClientErrors.timeout = (httpx.TimeoutException,)
+    ClientErrors.transport = (httpx.TransportError,)
+    ClientErrors.resolved = True
+
+
+def get_openai_client(api_base, api_key=None):
+    """APIベースURLとAPIキーごとに共有するOpenAIクライアントを返す"""
+    key = (api_base, api_key or "")
+    client = _openai_clients.get(key)
+    if client is None:
+        import httpx
+        from openai import OpenAI
+        resolve_client_errors()
+        with _lock:
+            client = _openai_clients.get(key)
+            if client is None:
+                pool_size = get_pool_size()
+                connect_timeout, read_timeout = get_timeout()
+                http_client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=pool_size,
+                        max_keepalive_connections=pool_size,
+                        keepalive_expiry=_env_float("GPUSTACK_KEEPALIVE_EXPIRY", DEFAULT_KEEPALIVE_EXPIRY),
+                    ),
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                )
+                client = OpenAI(
+                    api_key=api_key or "dummy_key",
+                    base_url=api_base,
+                    http_client=http_client,
+                    # 再試行は resilience.resilient_call とエンドポイントのフェイルオーバーで行う
+                    max_retries=0,
+                )
+                _openai_clients[key] = client
+    return client
+
+
+def close_all():
+    """共有しているセッションとクライアントを閉じる"""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+        for client in _openai_clients.values():
+            client.close()
+        _openai_clients.clear()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+コンテキストウィンドウを考慮したチャット履歴の管理
+モデルごとのトークン予算に収まるように、システムプロンプトを残したまま
+古いターンを削除または要約して送信する履歴を組み立てます。
+"""
+
+import os
+import re
+
+from token_counter import MESSAGE_OVERHEAD_TOKENS, REPLY_PRIMING_TOKENS, count_tokens
+
+DEFAULT_CONTEXT_WINDOW = 8192
+# 既知のモデルのコンテキスト長（モデルIDに含まれる文字列で判定）
+KNOWN_CONTEXT_WINDOWS = [
+    ("tinyllama", 2048),
+    ("qwen2.5", 32768),
+    ("llama-3.1", 8192),
+    ("mistral-7b-instruct-v0.2", 8192),
+    ("neural-chat", 8192),
+]
+# トークン数の誤差を吸収するための余白
+SAFETY_MARGIN_TOKENS = 64
+SUMMARY_PREFIX = "これまでの会話の要約:\n"
+# 予算を超えたときは予算のこの割合まで一度に削り、以降の数ターンはプレフィックスを変えない
+TRIM_TARGET_RATIO = 0.7
+
+
+def _parse_context_overrides():
+    """MODEL_CONTEXT_WINDOWS="tinyllama:2048,qwen:32768" 形式の設定を読み込む"""
+    overrides = []
+    for item in os.getenv("MODEL_CONTEXT_WINDOWS", "").split(","):
+        pattern, _, tokens = item.partition(":")
+        if pattern.strip() and tokens.strip().isdigit():
+            overrides.append((pattern.strip().lower(), int(tokens)))
+    return overrides
+
+
+def get_context_window(model):
+    """モデルのコンテキストウィンドウ（トークン数）を返す"""
+    model_id = (model or "").lower()
+    for pattern, tokens in _parse_context_overrides() + KNOWN_CONTEXT_WINDOWS:
+        if pattern in model_id:
+            return tokens
+    try:
+        return int(os.getenv("MODEL_CONTEXT_WINDOW", DEFAULT_CONTEXT_WINDOW))
+    except ValueError:
+        return DEFAULT_CONTEXT_WINDOW
+
+
+def message_tokens(message, model=None):
+    """メッセージのトークン数（オーバーヘッド込み）を返す。計算結果はメッセージに保持する"""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(message.get("content") or "", model) + MESSAGE_OVERHEAD_TOKENS
+        message["tokens"] = tokens
+    return tokens
+
+
+class HistoryManager:
+    """セッションごとの履歴の切り詰めと要約の状態を保持する"""
+
+    def __init__(self):
+        self.summary = None
+        self.summary_tokens = 0
+        # 要約済み（または削除済み）のメッセージ数
+        self.summarized_upto = 0
+        self.last_prompt_tokens = 0
+        self.last_budget = 0
+        self._system_tokens = (None, 0)
+
+    def reset(self):
+        self.summary = None
+        self.summary_tokens = 0
+        self.summarized_upto = 0
+
+    def budget_for(self, model, max_tokens):
+        """プロンプトに使えるトークン数（生成分と余白を差し引いたもの）"""
+        return max(256, get_context_window(model) - max_tokens - SAFETY_MARGIN_TOKENS)
+
+    def _find_cut(self, messages, start, available, model):
+        """新しいメッセージから順に予算内に収まる最古の位置を探す"""
+        used = 0
+        cut = len(messages)
+        for index in range(len(messages) - 1, start - 1, -1):
+            tokens = message_tokens(messages[index], model)
+            if used + tokens > available and cut < len(messages):
+                break
+            used += tokens
+            cut = index
+        # 履歴がユーザーの発言から始まるようにターン単位で切る
+        while cut < len(messages) - 1 and messages[cut]["role"] != "user":
+            cut += 1
+        return cut
+
+    def build(self, model, system_prompt, messages, max_tokens, summarize=None):
+        """予算内に収まる送信用の履歴を組み立てる
+
+        summarize が指定されている場合、予算からあふれた古いターンは
+        summarize(dropped_messages, previous_summary) の結果に置き換えられます。
+        """
+        if self.summarized_upto > len(messages):
+            self.reset()
+
+        budget = self.budget_for(model, max_tokens)
+        system_message = {"role": "system", "content": system_prompt}
+        if self._system_tokens[0] != system_prompt:
+            self._system_tokens = (system_prompt, message_tokens(dict(system_message), model))
+        fixed_tokens = REPLY_PRIMING_TOKENS + self._system_tokens[1]
+
+        available = budget - fixed_tokens - self.summary_tokens
+        remaining_tokens = sum(message_tokens(message, model) for message in messages[self.summarized_upto:])
+        cut = self.summarized_upto
+        if remaining_tokens > available:
+            # 毎ターン少しずつ削るとプレフィックスキャッシュが毎回外れるため、まとめて削る
+            cut = self._find_cut(messages, self.summarized_upto, int(available * TRIM_TARGET_RATIO), model)
+
+        if cut > self.summarized_upto:
+            dropped = messages[self.summarized_upto:cut]
+            if summarize is not None:
+                summary = summarize(dropped, self.summary)
+                if summary:
+                    self.summary = summary
+                    self.summary_tokens = count_tokens(SUMMARY_PREFIX + summary, model) + MESSAGE_OVERHEAD_TOKENS
+            self.summarized_upto = cut
+            # 要約の分だけ予算が減るので、残りのメッセージを再確認する
+            available = budget - fixed_tokens - self.summary_tokens
+            remaining_tokens = sum(message_tokens(message, model) for message in messages[cut:])
+            if remaining_tokens > available:
+                self.summarized_upto = self._find_cut(messages, cut, available, model)
+
+        history = [system_message]
+        if self.summary:
+            history.append({"role": "system", "content": SUMMARY_PREFIX + self.summary})
+        for message in messages[self.summarized_upto:]:
+            history.append({"role": message["role"], "content": message["content"]})
+
+        self.last_budget = budget
+        self.last_prompt_tokens = fixed_tokens + self.summary_tokens + sum(
+            message_tokens(message, model) for message in messages[self.summarized_upto:]
+        )
+        return history
+
+
+def strip_summary_prefix(text):
+    """要約テキストから先頭の見出しを取り除く"""
+    return re.sub(r"^\s*(要約[:：])\s*", "", text or "").strip()
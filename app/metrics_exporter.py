@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Prometheus/OpenMetrics エクスポーター
+クライアント側で観測したTTFT・応答時間・生成速度のヒストグラム、
+エラー・リトライのカウンター、待ち行列の深さのゲージをモデルごとのラベル付きで公開します。
+
+METRICS_PORT を設定するとアプリのプロセス内で /metrics を提供します。
+prometheus_client がインストールされていない場合は何もしません。
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+except ImportError:  # pragma: no cover - オプション依存
+    Counter = Gauge = Histogram = start_http_server = None
+
+NAMESPACE = "gpustack_client"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+TOKENS_PER_SEC_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+_lock = threading.Lock()
+_metrics = None
+_server_port = None
+
+
+def is_available():
+    return Counter is not None
+
+
+def _get_metrics():
+    """メトリクスを初回利用時に登録する（Streamlitの再実行で二重登録しないようにする）"""
+    global _metrics
+    if _metrics is None and is_available():
+        with _lock:
+            if _metrics is None:
+                _metrics = {
+                    "ttft": Histogram(
+                        "ttft_seconds", "Time to first token observed by the client",
+                        ["model"], namespace=NAMESPACE, buckets=LATENCY_BUCKETS),
+                    "duration": Histogram(
+                        "request_duration_seconds", "End-to-end chat completion latency",
+                        ["model"], namespace=NAMESPACE, buckets=LATENCY_BUCKETS),
+                    "queue_wait": Histogram(
+                        "queue_wait_seconds", "Time spent waiting in the client-side queue",
+                        ["model"], namespace=NAMESPACE, buckets=LATENCY_BUCKETS),
+                    "tokens_per_sec": Histogram(
+                        "tokens_per_second", "Completion tokens per second per request",
+                        ["model"], namespace=NAMESPACE, buckets=TOKENS_PER_SEC_BUCKETS),
+                    "prompt_tokens": Counter(
+                        "prompt_tokens", "Prompt tokens sent", ["model"], namespace=NAMESPACE),
+                    "completion_tokens": Counter(
+                        "completion_tokens", "Completion tokens received", ["model"], namespace=NAMESPACE),
+                    "requests": Counter(
+                        "requests", "Completed chat requests", ["model"], namespace=NAMESPACE),
+                    "errors": Counter(
+                        "errors", "Failed requests by error kind", ["model", "kind"], namespace=NAMESPACE),
+                    "retries": Counter(
+                        "retries", "Retried requests", ["model"], namespace=NAMESPACE),
+                    "queue_depth": Gauge(
+                        "queue_depth", "Requests waiting in the client-side queue", ["model"],
+                        namespace=NAMESPACE),
+                    "in_flight": Gauge(
+                        "in_flight_requests", "Requests currently being generated", ["model"],
+                        namespace=NAMESPACE),
+                }
+    return _metrics
+
+
+def start_exporter(port=None, addr="0.0.0.0"):
+    """/metrics を提供するHTTPサーバーを起動する（起動済みなら何もしない）"""
+    global _server_port
+    port = port or os.getenv("METRICS_PORT")
+    if not port or not is_available():
+        return None
+    with _lock:
+        if _server_port is None:
+            start_http_server(int(port), addr=os.getenv("METRICS_ADDR", addr))
+            _server_port = int(port)
+    _get_metrics()
+    return _server_port
+
+
+def observe_request(model, elapsed_time=None, ttft=None, tokens_per_sec=None, queue_wait=None,
+                    prompt_tokens=None, completion_tokens=None):
+    """完了したリクエストの計測値を記録する"""
+    metrics = _get_metrics()
+    if metrics is None:
+        return
+    model = model or "unknown"
+    metrics["requests"].labels(model).inc()
+    if elapsed_time is not None:
+        metrics["duration"].labels(model).observe(elapsed_time)
+    if ttft is not None:
+        metrics["ttft"].labels(model).observe(ttft)
+    if tokens_per_sec is not None:
+        metrics["tokens_per_sec"].labels(model).observe(tokens_per_sec)
+    if queue_wait is not None:
+        metrics["queue_wait"].labels(model).observe(queue_wait)
+    if prompt_tokens:
+        metrics["prompt_tokens"].labels(model).inc(prompt_tokens)
+    if completion_tokens:
+        metrics["completion_tokens"].labels(model).inc(completion_tokens)
+
+
+def observe_error(model, kind):
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics["errors"].labels(model or "unknown", kind).inc()
+
+
+def observe_retry(model):
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics["retries"].labels(model or "unknown").inc()
+
+
+def set_queue_depth(model, depth):
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics["queue_depth"].labels(model or "unknown").set(depth)
+
+
+@contextmanager
+def track_in_flight(model):
+    """ブロック内の実行中リクエスト数をゲージに反映する"""
+    metrics = _get_metrics()
+    if metrics is None:
+        yield
+        return
+    gauge = metrics["in_flight"].labels(model or "unknown")
+    gauge.inc()
+    try:
+        yield
+    finally:
+        gauge.dec()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+固定メモリのメトリクスストア
+リクエストごとの計測値を配列ベースのリングバッファに保持し、
+件数・合計・ストリーミングパーセンタイル（対数ヒストグラム）と
+時間窓ごとの集計を逐次更新します。プロセス内の全セッションで共有されます。
+"""
+
+import math
+import threading
+import time
+from array import array
+
+METRIC_FIELDS = (
+    "tokens",
+    "prompt_tokens",
+    "completion_tokens",
+    "cached_tokens",
+    "elapsed_time",
+    "ttft",
+    "itl",
+    "tokens_per_sec",
+    "queue_wait",
+)
+DEFAULT_CAPACITY = 2048
+DEFAULT_WINDOW_SECONDS = 60
+DEFAULT_NUM_WINDOWS = 60
+ALL_MODELS = "__all__"
+
+_lock = threading.Lock()
+_store = None
+
+
+class LogHistogram:
+    """対数間隔のバケットによるストリーミングパーセンタイル（相対誤差は約5%）"""
+
+    def __init__(self, min_value=1e-4, max_value=1e7, growth=1.1):
+        self.min_value = min_value
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        size = int(math.ceil(math.log(max_value / min_value) / self._log_growth)) + 1
+        # 先頭のバケットは min_value 未満（0を含む）の値
+        self.counts = array("L", [0] * (size + 1))
+        self.total = 0
+
+    def add(self, value):
+        if value < self.min_value:
+            index = 0
+        else:
+            index = min(len(self.counts) - 1, 1 + int(math.log(value / self.min_value) / self._log_growth))
+        self.counts[index] += 1
+        self.total += 1
+
+    def percentile(self, pct):
+        if not self.total:
+            return None
+        target = self.total * pct / 100
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= target:
+                if index == 0:
+                    return 0.0
+                # バケットの幾何平均を代表値とする
+                lower = self.min_value * self.growth ** (index - 1)
+                return lower * math.sqrt(self.growth)
+        return None
+
+
+class RunningStats:
+    """件数・合計・最小・最大と分位点を逐次更新する集計値"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = LogHistogram()
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.histogram.add(value)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.histogram.percentile(50),
+            "p95": self.histogram.percentile(95),
+            "p99": self.histogram.percentile(99),
+        }
+
+
+class WindowedCounter:
+    """一定秒数ごとの件数と合計を保持するリング（古い窓は上書きされる）"""
+
+    def __init__(self, window_seconds=DEFAULT_WINDOW_SECONDS, num_windows=DEFAULT_NUM_WINDOWS):
+        self.window_seconds = window_seconds
+        self.num_windows = num_windows
+        self.starts = array("d", [-1.0] * num_windows)
+        self.counts = array("L", [0] * num_windows)
+        self.sums = array("d", [0.0] * num_windows)
+
+    def add(self, timestamp, value):
+        start = timestamp - timestamp % self.window_seconds
+        slot = int(start // self.window_seconds) % self.num_windows
+        if self.starts[slot] != start:
+            self.starts[slot] = start
+            self.counts[slot] = 0
+            self.sums[slot] = 0.0
+        self.counts[slot] += 1
+        self.sums[slot] += value
+
+    def series(self, now=None):
+        """古い順に (窓の開始時刻, 件数, 合計) を返す（期限切れの窓は除く）"""
+        now = time.time() if now is None else now
+        oldest = now - self.window_seconds * self.num_windows
+        rows = [
+            (self.starts[i], self.counts[i], self.sums[i])
+            for i in range(self.num_windows)
+            if self.starts[i] >= oldest
+        ]
+        return sorted(rows)
+
+
+class _Aggregates:
+    """モデル単位（または全体）の集計値"""
+
+    def __init__(self, window_seconds, num_windows):
+        self.total_requests = 0
+        self.requests = WindowedCounter(window_seconds, num_windows)
+        self.stats = {name: RunningStats() for name in METRIC_FIELDS}
+        self.windows = {name: WindowedCounter(window_seconds, num_windows) for name in METRIC_FIELDS}
+        self.counters = {}
+
+
+class MetricsStore:
+    """リクエストの計測値を固定メモリで保持・集計するストア"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, window_seconds=DEFAULT_WINDOW_SECONDS,
+                 num_windows=DEFAULT_NUM_WINDOWS):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.num_windows = num_windows
+        self._lock = threading.Lock()
+        self._next = 0
+        self._size = 0
+        self._timestamps = array("d", [0.0] * capacity)
+        self._model_index = array("H", [0] * capacity)
+        self._values = {name: array("d", [math.nan] * capacity) for name in METRIC_FIELDS}
+        self._model_names = [ALL_MODELS]
+        self._aggregates = {ALL_MODELS: _Aggregates(window_seconds, num_windows)}
+
+    def _aggregates_for(self, model):
+        key = model or ALL_MODELS
+        aggregates = self._aggregates.get(key)
+        if aggregates is None:
+            aggregates = _Aggregates(self.window_seconds, self.num_windows)
+            self._aggregates[key] = aggregates
+            self._model_names.append(key)
+        return aggregates
+
+    def record(self, model=None, timestamp=None, **values):
+        """1リクエスト分の計測値を記録する（Noneの値は記録しない）"""
+        unknown = set(values) - set(METRIC_FIELDS)
+        if unknown:
+            raise ValueError(f"未知のメトリクスです: {', '.join(sorted(unknown))}")
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            targets = [self._aggregates[ALL_MODELS]]
+            if model:
+                targets.append(self._aggregates_for(model))
+            slot = self._next
+            self._timestamps[slot] = timestamp
+            self._model_index[slot] = self._model_names.index(model) if model else 0
+            for name in METRIC_FIELDS:
+                value = values.get(name)
+                self._values[name][slot] = math.nan if value is None else float(value)
+            self._next = (slot + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+            for aggregates in targets:
+                aggregates.total_requests += 1
+                aggregates.requests.add(timestamp, 1)
+                for name, value in values.items():
+                    if value is None:
+                        continue
+                    aggregates.stats[name].add(float(value))
+                    aggregates.windows[name].add(timestamp, float(value))
+
+    def increment(self, counter, model=None, amount=1):
+        """キャッシュヒットなどのイベント数を加算する"""
+        with self._lock:
+            targets = [self._aggregates[ALL_MODELS]]
+            if model:
+                targets.append(self._aggregates_for(model))
+            for aggregates in targets:
+                aggregates.counters[counter] = aggregates.counters.get(counter, 0) + amount
+
+    def counter(self, counter, model=None):
+        aggregates = self._aggregates.get(model or ALL_MODELS)
+        return aggregates.counters.get(counter, 0) if aggregates else 0
+
+    def summary(self, field, model=None):
+        """起動以降の集計値（件数・平均・p50/p95/p99など）"""
+        with self._lock:
+            aggregates = self._aggregates.get(model or ALL_MODELS)
+            if aggregates is None:
+                return RunningStats().summary()
+            return aggregates.stats[field].summary()
+
+    def request_count(self, model=None):
+        """起動以降に記録したリクエスト数"""
+        aggregates = self._aggregates.get(model or ALL_MODELS)
+        return aggregates.total_requests if aggregates else 0
+
+    def request_windows(self, model=None, now=None):
+        """時間窓ごとの (開始時刻, リクエスト数) のリスト"""
+        with self._lock:
+            aggregates = self._aggregates.get(model or ALL_MODELS)
+            if aggregates is None:
+                return []
+            return [(start, count) for start, count, _ in aggregates.requests.series(now)]
+
+    def windows(self, field, model=None, now=None):
+        """時間窓ごとの (開始時刻, 件数, 合計, 平均) のリスト"""
+        with self._lock:
+            aggregates = self._aggregates.get(model or ALL_MODELS)
+            if aggregates is None:
+                return []
+            return [
+                (start, count, total, total / count if count else None)
+                for start, count, total in aggregates.windows[field].series(now)
+            ]
+
+    def recent(self, field, limit=100, model=None):
+        """リングバッファから新しい順に最大limit件の (時刻, 値) を返す"""
+        with self._lock:
+            model_index = self._model_names.index(model) if model in self._model_names else None
+            rows = []
+            for offset in range(1, self._size + 1):
+                slot = (self._next - offset) % self.capacity
+                if model and self._model_index[slot] != model_index:
+                    continue
+                value = self._values[field][slot]
+                if not math.isnan(value):
+                    rows.append((self._timestamps[slot], value))
+                if len(rows) >= limit:
+                    break
+            return rows
+
+    def models(self):
+        with self._lock:
+            return [name for name in self._model_names if name != ALL_MODELS]
+
+
+def get_metrics_store():
+    """プロセス全体で共有するメトリクスストアを返す"""
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                _store = MetricsStore()
+    return _store
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GPUStack モデル一覧・ヘルス状態キャッシュ
+/models の結果をTTL付きでプロセス全体にキャッシュし、バックグラウンドスレッドで更新します。
+Streamlitの再実行はキャッシュを読むだけなので、ネットワーク待ちでブロックされません。
+複数のエンドポイントが指定されている場合は、応答できるノードから取得します。
+同時に届いた更新要求（初回表示が重なった場合など）は1回の問い合わせにまとめます。
+"""
+
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+import requests
+
+from endpoints import get_endpoint_pool
+from gpustack_client import auth_headers, get_session
+from resilience import CircuitOpenError, describe_error
+from singleflight import Group
+
+DEFAULT_TTL = 30.0
+DEFAULT_REFRESH_INTERVAL = 10.0
+# 起動中・ダウンロード中のモデルがある場合や接続できない場合の短い更新間隔
+DEFAULT_TRANSITION_INTERVAL = 2.0
+PROBE_TIMEOUT = 5
+
+_lock = threading.Lock()
+_caches = {}
+
+
+@dataclass(frozen=True)
+class ModelSnapshot:
+    """ある時点のGPUStackの接続状態とモデル一覧"""
+
+    connected: bool
+    models: list = field(default_factory=list)
+    updated_at: float = 0.0
+    error: str = None
+
+    @property
+    def running_models(self):
+        """RUNNING状態のモデルIDのリスト"""
+        return [model["id"] for model in self.models if model.get("status") == "RUNNING"]
+
+    @property
+    def has_transitioning(self):
+        """RUNNING以外の状態（起動中など）のモデルがあるかどうか"""
+        return any(model.get("status") != "RUNNING" for model in self.models)
+
+    @property
+    def age(self):
+        return time.time() - self.updated_at
+
+    def state_key(self):
+        """モデルの状態変化を検出するためのキー"""
+        return (self.connected, tuple(sorted((m.get("id"), m.get("status")) for m in self.models)))
+
+
+class ModelCache:
+    """モデル一覧とヘルス状態のTTL付きキャッシュ"""
+
+    def __init__(self, api_base, api_key=None, ttl=DEFAULT_TTL,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 transition_interval=DEFAULT_TRANSITION_INTERVAL):
+        self.api_bases = [api_base] if isinstance(api_base, str) else list(api_base)
+        self.api_key = api_key
+        self.pool = get_endpoint_pool(self.api_bases, api_key)
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.transition_interval = transition_interval
+        self.version = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._flights = Group("model-cache")
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _request_models(self, endpoint):
+        response = get_session().get(
+            f"{endpoint.url}/models",
+            headers=auth_headers(self.api_key),
+            timeout=PROBE_TIMEOUT,
+        )
+        response.raise_for_status()
+        return response.json().get("data", [])
+
+    def _fetch(self):
+        try:
+            # 応答しないノードがあれば別のノードに問い合わせる
+            return ModelSnapshot(True, self.pool.call(self._request_models), time.time())
+        except (requests.exceptions.RequestException, ValueError, CircuitOpenError) as e:
+            # 全ノードのブレーカーが開いている間も、更新スレッドを止めずに未接続として扱う
+            return ModelSnapshot(False, [], time.time(), describe_error(e))
+
+    def _refresh(self):
+        snapshot = self._fetch()
+        with self._lock:
+            previous = self._snapshot
+            if previous is None or previous.state_key() != snapshot.state_key():
+                self.version += 1
+            self._snapshot = snapshot
+        return snapshot
+
+    def refresh(self):
+        """GPUStackに問い合わせてキャッシュを更新する（問い合わせ中なら、その結果を待って返す）"""
+        snapshot, _ = self._flights.do("models", self._refresh)
+        return snapshot
+
+    def get(self):
+        """キャッシュされたスナップショットを返す（初回のみ同期的に取得する）"""
+        self.start()
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.refresh()
+        if snapshot.age > self.ttl:
+            # 期限切れの場合は更新を促し、次の更新までは古い値を返す
+            self._wakeup.set()
+        return snapshot
+
+    def invalidate(self, wait=False):
+        """キャッシュを無効化して即座に再取得させる"""
+        if wait:
+            return self.refresh()
+        self._wakeup.set()
+        return self._snapshot
+
+    def start(self):
+        """バックグラウンド更新スレッドを起動する"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="model-cache-refresh", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            snapshot = self.refresh()
+            if snapshot.connected and not snapshot.has_transitioning:
+                interval = self.refresh_interval
+            else:
+                interval = self.transition_interval
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+
+
+def get_model_cache(api_base, api_key=None):
+    """APIベースURL（またはそのリスト）ごとに共有するモデルキャッシュを返す"""
+    key = (api_base if isinstance(api_base, str) else tuple(api_base), api_key or "")
+    cache = _caches.get(key)
+    if cache is None:
+        with _lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = ModelCache(
+                    api_base,
+                    api_key,
+                    ttl=float(os.getenv("MODEL_CACHE_TTL", DEFAULT_TTL)),
+                    refresh_interval=float(os.getenv("MODEL_CACHE_REFRESH_INTERVAL", DEFAULT_REFRESH_INTERVAL)),
+                )
+                _caches[key] = cache
+    return cache
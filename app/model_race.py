@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+複数モデルへの同時送信（レースモード）
+同じプロンプトを小さいモデルと大きいモデルに同時に送り、先に最初のトークンを返した方を表示します。
+負けたモデルはその時点で接続を閉じて生成を打ち切りますが、大きいモデルが負けた場合は
+設定に応じて最後まで生成させ、完了後に回答を差し替えたり候補として提示したりできます。
+各モデルの生成はワーカースレッドで行い、トークンはキューで呼び出し元へ渡すため、
+Streamlitの描画はメインスレッドだけで行えます。
+"""
+
+import queue
+import re
+import threading
+import time
+from contextlib import nullcontext
+from functools import partial
+
+# 大きいモデルが負けたときの扱い
+POLICIES = ("cancel", "offer", "swap")
+DEFAULT_POLICY = "cancel"
+
+# "Llama-3.2-1B" や "qwen2.5-0.5b-instruct" のようなモデルIDからパラメータ数を読み取る
+_SIZE_PATTERN = re.compile(r"(?<![a-z0-9.])(\d+(?:\.\d+)?)b(?![a-z])", re.IGNORECASE)
+
+_DONE = object()
+
+
+def model_size(model_id):
+    """モデルIDに含まれるパラメータ数（十億単位）。読み取れなければ None"""
+    sizes = [float(match) for match in _SIZE_PATTERN.findall(model_id or "")]
+    return max(sizes) if sizes else None
+
+
+def order_by_size(models):
+    """パラメータ数の小さい順に並べる（読み取れないモデルは最後、同じ大きさなら元の順）"""
+    return sorted(models, key=lambda model: (model_size(model) is None, model_size(model) or 0.0))
+
+
+class Racer:
+    """レースに参加する1モデル分の生成"""
+
+    def __init__(self, model):
+        self.model = model
+        self.stream = None
+        self.error = None
+        self.queue_wait = None
+        self.started_at = None
+        self.finished_at = None
+        self.first_token_at = None
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.deltas = queue.Queue()
+        self.recorded = False
+        self._lock = threading.Lock()
+
+    @property
+    def text(self):
+        return self.stream.text if self.stream is not None else ""
+
+    @property
+    def ttft(self):
+        return self.stream.ttft if self.stream is not None else None
+
+    @property
+    def elapsed_time(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    @property
+    def completed(self):
+        """打ち切られず、エラーもなく最後まで生成したか"""
+        return self.done.is_set() and self.error is None and not self.cancelled.is_set() and bool(self.text)
+
+    def cancel(self):
+        """生成を打ち切る。接続を閉じるとサーバー側の生成も止まる"""
+        with self._lock:
+            self.cancelled.set()
+            stream = self.stream
+        if stream is not None:
+            stream.close()
+
+    def run(self, open_stream, slot, notify):
+        try:
+            with (slot(self.model) if slot else nullcontext()) as ticket:
+                self.queue_wait = getattr(ticket, "wait_time", None)
+                self.started_at = time.time()
+                if self.cancelled.is_set():
+                    return
+                stream = open_stream(self.model)
+                with self._lock:
+                    self.stream = stream
+                # 接続中に打ち切られた場合は、開いたばかりの接続をすぐ閉じる
+                if self.cancelled.is_set():
+                    stream.close()
+                    return
+                for delta in stream:
+                    if self.first_token_at is None:
+                        self.first_token_at = time.perf_counter()
+                        notify()
+                    self.deltas.put(delta)
+                    if self.cancelled.is_set():
+                        stream.close()
+                        break
+                self.error = stream.error
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished_at = time.time()
+            self.done.set()
+            self.deltas.put(_DONE)
+            notify()
+
+
+class ModelRace:
+    """複数モデルに同じリクエストを送り、最初のトークンが早いモデルを勝者にする
+
+    open_stream(model) は ChatStream（反復でトークンを返し、close() で打ち切れるもの）を返し、
+    失敗時は例外を送出してください。slot(model) を渡すと、その中で生成します（実行枠の確保など）。
+    store を渡すと、負けたモデルのTTFTと所要時間、勝敗の回数を記録します。
+    勝ったモデルの計測値は、応答のトークン数とあわせて呼び出し側で記録してください。
+    """
+
+    def __init__(self, models, open_stream, slot=None, policy=DEFAULT_POLICY, store=None):
+        if len(models) < 2:
+            raise ValueError("レースには2つ以上のモデルが必要です")
+        if policy not in POLICIES:
+            raise ValueError(f"未知の方針です: {policy}")
+        self.racers = [Racer(model) for model in order_by_size(models)]
+        self.open_stream = open_stream
+        self.slot = slot
+        self.policy = policy
+        self.store = store
+        self.winner = None
+        self._decided = threading.Condition()
+
+    def start(self):
+        for racer in self.racers:
+            threading.Thread(
+                target=racer.run,
+                args=(self.open_stream, self.slot, partial(self._notify, racer)),
+                name=f"race-{racer.model}",
+                daemon=True,
+            ).start()
+        return self
+
+    def _notify(self, racer):
+        with self._decided:
+            self._decided.notify_all()
+            self._record_loser(racer)
+
+    def wait_winner(self, timeout=None):
+        """最初のトークンを返したモデルを待って勝者とする。全モデルが失敗したら None"""
+        with self._decided:
+            self._decided.wait_for(
+                lambda: any(r.first_token_at is not None for r in self.racers)
+                or all(r.done.is_set() for r in self.racers),
+                timeout,
+            )
+            started = [r for r in self.racers if r.first_token_at is not None]
+            if not started:
+                return None
+            self.winner = min(started, key=lambda r: r.first_token_at)
+            for racer in self.racers:
+                if racer is self.winner:
+                    continue
+                if self.policy == "cancel" or not self.is_larger(racer):
+                    racer.cancel()
+                self._record_loser(racer)
+        if self.store is not None:
+            self.store.increment("race_wins", self.winner.model)
+        return self.winner
+
+    def is_larger(self, racer):
+        """勝者より大きいモデルか（小さい順に並べているので後ろにあるほど大きい）"""
+        return self.winner is not None and self.racers.index(racer) > self.racers.index(self.winner)
+
+    def iter_winner(self):
+        """勝者のトークンを到着順に返す"""
+        if self.winner is None:
+            return
+        while True:
+            delta = self.winner.deltas.get()
+            if delta is _DONE:
+                return
+            yield delta
+
+    @property
+    def pending(self):
+        """勝者の後も生成を続けている大きいモデル（なければ None）"""
+        for racer in self.racers:
+            if racer is not self.winner and not racer.cancelled.is_set() and self.is_larger(racer):
+                return racer
+        return None
+
+    def cancel(self):
+        for racer in self.racers:
+            racer.cancel()
+
+    def _record_loser(self, racer):
+        # 勝者が決まり、かつ生成を終えた負けモデルだけを1回記録する（_decided を保持して呼ぶ）
+        if (self.store is None or self.winner is None or racer is self.winner
+                or racer.recorded or not racer.done.is_set()):
+            return
+        racer.recorded = True
+        if racer.ttft is not None:
+            # 打ち切ったモデルは所要時間が短く見えるため、TTFTだけを記録する
+            self.store.record(
+                model=racer.model,
+                ttft=racer.ttft,
+                elapsed_time=racer.elapsed_time if racer.completed else None,
+                queue_wait=racer.queue_wait,
+            )
+        self.store.increment("race_losses", racer.model)
+        if racer.error is not None:
+            self.store.increment("race_errors", racer.model)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+プロンプトごとのモデル自動選択（ルーター）
+プロンプトの長さと簡単な分類ルールで難易度を見積もり、短く簡単な質問は最小のRUNNINGモデルへ、
+長い・複雑な質問は大きいモデルへ送ります。各モデルの実測レイテンシ（メトリクスストアのTTFTと応答時間）と
+スケジューラーの実行中・順番待ちの数から応答開始までの時間を予想し、
+選んだモデルが混雑していて予算を超える場合は、より早く応答できるモデルに切り替えます。
+"""
+
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+from history_manager import get_context_window
+from metrics_store import get_metrics_store
+from model_race import order_by_size
+from request_scheduler import get_scheduler
+from token_counter import count_tokens
+
+# モデル選択のセレクトボックスに追加する自動選択の項目
+AUTO_MODEL = "auto"
+DEFAULT_COMPLEXITY_THRESHOLD = 0.4
+DEFAULT_LATENCY_BUDGET = 15.0
+# このトークン数以上のプロンプトは長さだけで複雑とみなす
+LONG_PROMPT_TOKENS = 300
+
+# 推論・生成量の多い依頼によく含まれる語
+COMPLEX_KEYWORDS = (
+    "なぜ", "理由", "比較", "違い", "設計", "分析", "証明", "詳しく", "手順", "実装", "コード",
+    "プログラム", "翻訳", "要約", "レビュー", "最適化", "アルゴリズム", "計算", "考察",
+    "explain", "why", "compare", "design", "analy", "prove", "implement", "code",
+    "step by step", "refactor", "debug", "translate", "summari", "optimi", "algorithm",
+)
+# 挨拶やお礼など、小さいモデルで十分な短い発言
+SIMPLE_PATTERN = re.compile(
+    r"^\s*(こんにちは|こんばんは|おはよう|ありがとう|よろしく|はい|いいえ|了解|hi|hello|hey|thanks|thank you|ok)\b",
+    re.IGNORECASE,
+)
+_CODE_OR_MATH = re.compile(r"```|\bdef |\bclass |[=<>]\s*-?\d|\d\s*[+\-*/^]\s*\d|\\frac|∫|∑")
+# 埋め込みなどチャットに使えないモデル
+_NON_CHAT_PATTERN = re.compile(r"embed|rerank|whisper|tts", re.IGNORECASE)
+
+_lock = threading.Lock()
+_router = None
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    """ルーターが選んだモデルとその理由"""
+
+    model: str
+    complexity: float
+    reason: str
+    expected_latency: float = None
+
+
+def is_chat_model(model_id):
+    return not _NON_CHAT_PATTERN.search(model_id or "")
+
+
+def estimate_complexity(prompt):
+    """プロンプトの難易度を0（簡単）〜1（複雑）で見積もる"""
+    tokens = count_tokens(prompt)
+    if SIMPLE_PATTERN.match(prompt) and tokens < 20:
+        return 0.0
+    score = 0.5 * min(1.0, tokens / LONG_PROMPT_TOKENS)
+    lowered = prompt.lower()
+    score += min(0.5, 0.25 * sum(1 for keyword in COMPLEX_KEYWORDS if keyword in lowered))
+    if _CODE_OR_MATH.search(prompt):
+        score += 0.2
+    # 1つの発言に複数の質問や箇条書きの指示が含まれる
+    if prompt.count("?") + prompt.count("？") > 1 or len(re.findall(r"^\s*(?:[-*・]|\d+[.)])\s", prompt, re.M)) > 2:
+        score += 0.1
+    return min(1.0, score)
+
+
+class ModelRouter:
+    """難易度・コンテキスト長・実測レイテンシ・混雑状況からモデルを選ぶ"""
+
+    def __init__(self, store=None, scheduler=None, threshold=DEFAULT_COMPLEXITY_THRESHOLD,
+                 latency_budget=DEFAULT_LATENCY_BUDGET):
+        self.store = store or get_metrics_store()
+        self.scheduler = scheduler or get_scheduler()
+        self.threshold = threshold
+        self.latency_budget = latency_budget
+
+    def expected_latency(self, model):
+        """応答開始までの予想時間（秒）。まだ計測値がなければ None"""
+        ttft = self.store.summary("ttft", model)
+        elapsed = self.store.summary("elapsed_time", model)
+        if not ttft["count"] and not elapsed["count"]:
+            return None
+        first_token = ttft["p50"] if ttft["count"] else elapsed["p50"]
+        active, waiting, limit = self.scheduler.stats(model)
+        if active < limit and not waiting:
+            return first_token
+        # 実行枠が空くまで、前にいるリクエストの応答時間分だけ待つ
+        service_time = elapsed["p50"] if elapsed["count"] else first_token
+        return first_token + (waiting + 1) * service_time / max(1, limit)
+
+    def route(self, prompt, models, context_tokens=0):
+        """プロンプトを送るモデルを選ぶ。context_tokens は履歴と生成分を合わせたトークン数"""
+        candidates = order_by_size([model for model in models if is_chat_model(model)]) or list(models)
+        if not candidates:
+            raise ValueError("選択できるモデルがありません")
+        # 履歴が収まるモデルに絞る（どれにも収まらなければ最もコンテキストの長いモデル）
+        fitting = [model for model in candidates if get_context_window(model) >= context_tokens]
+        if not fitting:
+            fitting = [max(candidates, key=get_context_window)]
+
+        complexity = estimate_complexity(prompt)
+        if complexity < self.threshold:
+            preferred, reason = fitting, "短く簡単な質問"
+        else:
+            preferred, reason = list(reversed(fitting)), "長い・複雑な質問"
+        if len(fitting) < len(candidates):
+            reason += "、長い履歴"
+
+        latencies = {model: self.expected_latency(model) for model in preferred}
+        # 未計測のモデルは一度送って実測値を集める
+        within_budget = [m for m in preferred if latencies[m] is None or latencies[m] <= self.latency_budget]
+        if within_budget:
+            model = within_budget[0]
+        else:
+            # どのモデルも予算を超える場合は、最も早く応答を始められるモデルに送る
+            model = min(preferred, key=lambda m: latencies[m])
+        if model != preferred[0]:
+            reason += "、混雑のため応答の早いモデル"
+        return RouteDecision(model, complexity, reason, latencies[model])
+
+
+def get_router():
+    """プロセス全体で共有するルーターを返す"""
+    global _router
+    if _router is None:
+        with _lock:
+            if _router is None:
+                _router = ModelRouter(
+                    threshold=float(os.getenv("ROUTER_COMPLEXITY_THRESHOLD", DEFAULT_COMPLEXITY_THRESHOLD)),
+                    latency_budget=float(os.getenv("ROUTER_LATENCY_BUDGET", DEFAULT_LATENCY_BUDGET)),
+                )
+    return _router
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+プレフィックスキャッシュを効かせるためのプロンプト構築ユーティリティ
+システムプロンプトとメッセージを正規化してバイト単位で安定させ、
+サーバー側（llama.cpp / GPUStack）のKVプレフィックスキャッシュのヒット率を集計します。
+"""
+
+import hashlib
+import json
+import os
+import unicodedata
+
+
+def canonicalize_text(text):
+    """改行コード・Unicode正規化・行末の空白を揃えたテキストを返す"""
+    text = unicodedata.normalize("NFC", text or "")
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.split("\n")).strip()
+
+
+def canonical_system_prompt(text):
+    """サイドバーの入力から正規化したシステムプロンプトを作る"""
+    return canonicalize_text(text)
+
+
+def canonical_message(role, content):
+    """送信時と同じキー順のメッセージを作る（ユーザー入力は追加時に一度だけ正規化する）"""
+    if role in ("system", "user"):
+        content = canonicalize_text(content)
+    return {"role": role, "content": content}
+
+
+def inject_context(history, context):
+    """参照資料を最新のユーザー発言の前に入れた送信用の履歴を返す
+
+    資料は質問ごとに変わるため、システムプロンプトではなく最後のメッセージに入れ、
+    それより前のプレフィックス（サーバー側のKVキャッシュ）を変えないようにします。
+    """
+    if not context or not history or history[-1]["role"] != "user":
+        return history
+    return history[:-1] + [{"role": "user", "content": f"{context}\n\n質問: {history[-1]['content']}"}]
+
+
+def message_digest(message):
+    """メッセージのシリアライズ結果のハッシュ"""
+    payload = json.dumps(
+        {"role": message["role"], "content": message["content"]},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def prompt_cache_extra_body():
+    """llama.cpp系サーバーにプロンプトキャッシュの利用を指示する追加パラメータ"""
+    if os.getenv("GPUSTACK_CACHE_PROMPT", "true").lower() in ("0", "false", "no"):
+        return None
+    return {"cache_prompt": True}
+
+
+def cached_prompt_tokens(usage):
+    """usage.prompt_tokens_details.cached_tokens を取り出す（未報告ならNone）"""
+    if not usage:
+        return None
+    details = usage.get("prompt_tokens_details")
+    if hasattr(details, "model_dump"):
+        details = details.model_dump()
+    if isinstance(details, dict) and details.get("cached_tokens") is not None:
+        return details["cached_tokens"]
+    return None
+
+
+class PrefixCacheStats:
+    """プレフィックスの安定性とサーバー側のキャッシュヒット率を集計する"""
+
+    def __init__(self):
+        self.requests = 0
+        self.stable_prefix_requests = 0
+        self.reported_requests = 0
+        self.reported_prompt_tokens = 0
+        self.cached_tokens = 0
+        self._last_digests = []
+
+    def observe_prompt(self, history):
+        """前回のプロンプト（と応答）が今回のプロンプトの先頭に一致しているかを記録する"""
+        digests = [message_digest(message) for message in history]
+        stable = bool(self._last_digests) and digests[:len(self._last_digests)] == self._last_digests
+        self.requests += 1
+        if stable:
+            self.stable_prefix_requests += 1
+        self._last_digests = digests
+        return stable
+
+    def observe_response(self, reply, usage, prompt_tokens):
+        """応答をプレフィックスに加え、サーバーが報告したキャッシュ済みトークン数を記録する"""
+        if reply:
+            self._last_digests.append(message_digest({"role": "assistant", "content": reply}))
+        cached = cached_prompt_tokens(usage)
+        if cached is not None and prompt_tokens:
+            self.reported_requests += 1
+            self.reported_prompt_tokens += prompt_tokens
+            self.cached_tokens += cached
+        return cached
+
+    def reset_prefix(self):
+        self._last_digests = []
+
+    @property
+    def hit_rate(self):
+        """サーバーが報告したキャッシュ済みトークンの割合"""
+        if not self.reported_prompt_tokens:
+            return None
+        return self.cached_tokens / self.reported_prompt_tokens
+
+    @property
+    def stable_rate(self):
+        """前回のプロンプトをそのまま先頭に含んでいたリクエストの割合"""
+        if self.requests <= 1:
+            return None
+        return self.stable_prefix_requests / (self.requests - 1)
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+資料を参照した回答（RAG）のための文書インデックス
+文書をトークン数で区切ったチャンクに分け、OpenAI互換の /embeddings でまとめて埋め込み、
+ベクトルをメモリマップした行列（.npy、既定はfloat16）に保存します。
+検索はNumPyの行列演算で上位k件を求め、件数が多い場合はIVF（k-meansで分けたリスト）で候補を絞ります。
+文書は内容のハッシュで管理し、追加・更新された文書のチャンクだけを埋め込むため、
+資料を追加してもコーパス全体を埋め込み直す必要はありません。
+チャンクの本文と文書の情報はベクトルと同じディレクトリのSQLiteに保存します。
+インデックスは名前空間（利用者ごと、または scripts/rag_index.py で登録する共有の資料）ごとに分けて保存します。
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+from token_counter import count_tokens
+
+DEFAULT_INDEX_DIR = os.path.expanduser("~/.gpustack/rag_index")
+# scripts/rag_index.py で登録する、全員が参照できる資料の名前空間
+SHARED_NAMESPACE = "shared"
+DEFAULT_CHUNK_TOKENS = 300
+DEFAULT_CHUNK_OVERLAP = 50
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_TOP_K = 4
+DEFAULT_MIN_SCORE = 0.2
+DEFAULT_DTYPE = "float16"
+DEFAULT_NPROBE = 8
+# プロセス内で開いたままにしておくインデックスの最大数（利用者ごとの名前空間が増えても接続を抱え続けない）
+DEFAULT_MAX_OPEN_INDEXES = 32
+INITIAL_CAPACITY = 1024
+# 全件の類似度を一度に計算せず、この行数ずつ計算してメモリ使用量を抑える
+SEARCH_BLOCK_ROWS = 65536
+# k-meansの学習に使う最大件数と反復回数
+IVF_TRAIN_SAMPLES = 50000
+IVF_ITERATIONS = 10
+
+# 名前空間はディレクトリ名になるため、英数字・ハイフン・アンダースコアだけを受け付ける
+_NAMESPACE_PATTERN = re.compile(r"[0-9A-Za-z_-]+")
+# 文の区切り（句点・感嘆符・疑問符・改行の直後）
+_SENTENCE_END = re.compile(r"(?<=[。．！？!?\n])|(?<=\.)(?=\s)")
+
+_lock = threading.Lock()
+_indexes = OrderedDict()
+
+
+@dataclass
+class RetrievedChunk:
+    """検索で見つかったチャンク"""
+
+    document: str
+    seq: int
+    text: str
+    score: float
+
+
+def _split_long(sentence, max_tokens):
+    """1文が長すぎる場合は、トークン数の比率で文字数を見積もって区切る"""
+    tokens = count_tokens(sentence)
+    if tokens <= max_tokens:
+        return [sentence]
+    step = max(1, len(sentence) * max_tokens // tokens)
+    return [sentence[i:i + step] for i in range(0, len(sentence), step)]
+
+
+def chunk_text(text, chunk_tokens=DEFAULT_CHUNK_TOKENS, overlap_tokens=DEFAULT_CHUNK_OVERLAP):
+    """テキストを文の境界で、前のチャンクの末尾を重ねながら chunk_tokens 程度のチャンクに分ける"""
+    sentences = []
+    for sentence in _SENTENCE_END.split(text or ""):
+        if sentence.strip():
+            sentences += [(part, count_tokens(part)) for part in _split_long(sentence, chunk_tokens)]
+        elif sentences:
+            # 改行だけの区切りは直前の文に付けて、段落の区切りを残す
+            sentences[-1] = (sentences[-1][0] + sentence, sentences[-1][1])
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence, tokens in sentences:
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append("".join(part for part, _ in current).strip())
+            # 文脈が途切れないよう、直前の文を overlap_tokens まで次のチャンクの先頭に残す
+            overlap = []
+            overlap_total = 0
+            for part, part_tokens in reversed(current):
+                if overlap_total + part_tokens > overlap_tokens:
+                    break
+                overlap.insert(0, (part, part_tokens))
+                overlap_total += part_tokens
+            current, current_tokens = overlap, overlap_total
+        current.append((sentence, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append("".join(part for part, _ in current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+def format_context(chunks):
+    """検索結果をプロンプトに入れる資料の文章にする"""
+    lines = ["以下の資料を参考にして回答してください。資料に答えがない場合はそのように伝えてください。"]
+    for number, chunk in enumerate(chunks, 1):
+        lines.append(f"\n[資料{number}: {chunk.document}]\n{chunk.text}")
+    return "\n".join(lines)
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class DocumentIndex:
+    """チャンクの埋め込みをメモリマップした行列に保存し、コサイン類似度で検索する
+
+    embed(texts) はテキストのリストを受け取り、同じ順のベクトルのリストを返す関数です。
+    ベクトルは正規化して保存するため、類似度は内積で計算できます。
+    """
+
+    def __init__(self, directory=DEFAULT_INDEX_DIR, embed=None, dtype=DEFAULT_DTYPE,
+                 chunk_tokens=DEFAULT_CHUNK_TOKENS, overlap_tokens=DEFAULT_CHUNK_OVERLAP,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self.directory = directory
+        self.embed = embed
+        self.dtype = np.dtype(dtype)
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.batch_size = max(1, batch_size)
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.centroids_path = os.path.join(directory, "ivf_centroids.npy")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, "chunks.db"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS documents (
+                name TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                chunks INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        # row はベクトル行列の行番号。更新・削除された文書のチャンクは deleted にして検索から外す
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS chunks (
+                row INTEGER PRIMARY KEY,
+                document TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                list_id INTEGER,
+                deleted INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_document ON chunks (document)")
+        self._conn.commit()
+
+        self._load()
+
+    def _vectors_state(self):
+        """vectors.npy の (inode, 更新時刻, サイズ)。行列の作り直しや追記を検出するのに使う"""
+        try:
+            stat = os.stat(self.vectors_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _version(self):
+        # data_version は他の接続（scripts/rag_index.py など）がコミットしたときだけ変わる
+        return self._conn.execute("PRAGMA data_version").fetchone()[0], self._vectors_state()
+
+    def _load(self):
+        """SQLiteのチャンクとベクトルの行列を読み込む"""
+        version = self._version()
+        # 追加では行列を広げてからチャンクをコミットするため、先にチャンクを読めば行列に収まっている
+        rows = self._conn.execute("SELECT row, deleted, list_id FROM chunks ORDER BY row").fetchall()
+        self.vectors = np.lib.format.open_memmap(self.vectors_path, mode="r+") \
+            if os.path.exists(self.vectors_path) else None
+        self.centroids = np.load(self.centroids_path) if os.path.exists(self.centroids_path) else None
+        # 行列に書き込まれていても chunks にない行（追加の途中で止まった分）は使わない
+        self.count = rows[-1][0] + 1 if rows else 0
+        capacity = len(self.vectors) if self.vectors is not None else 0
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.list_ids = np.full(capacity, -1, dtype=np.int32)
+        for row, deleted, list_id in rows:
+            self.alive[row] = not deleted
+            self.list_ids[row] = -1 if list_id is None else list_id
+        self._loaded_version = version
+
+    def _written(self):
+        """自分の書き込みで変わった行列の状態を記録する（他の接続のコミットは次の refresh() で検出する）"""
+        self._loaded_version = (self._loaded_version[0], self._vectors_state())
+
+    def refresh(self):
+        """他のプロセスが資料を追加・削除していれば、チャンクとベクトルを読み込み直す"""
+        with self._lock:
+            if self._version() != self._loaded_version:
+                self._load()
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1] if self.vectors is not None else None
+
+    def __len__(self):
+        return int(self.alive[:self.count].sum())
+
+    def documents(self):
+        """登録済みの (文書名, チャンク数, 更新時刻) のリスト"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT name, chunks, updated_at FROM documents ORDER BY updated_at DESC"
+            ).fetchall()
+
+    def _embed(self, texts):
+        """テキストを batch_size 件ずつまとめて埋め込み、正規化した行列を返す"""
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self.embed(texts[start:start + self.batch_size]))
+        return _normalize(vectors)
+
+    def _reserve(self, rows, dim):
+        """rows 行を追加できるよう、容量が足りなければ倍にした行列に作り直す"""
+        if self.vectors is not None and self.dim != dim:
+            raise ValueError(f"埋め込みの次元数が一致しません（インデックス {self.dim}、埋め込み {dim}）")
+        capacity = len(self.vectors) if self.vectors is not None else 0
+        if self.count + rows <= capacity:
+            return
+        new_capacity = max(INITIAL_CAPACITY, capacity)
+        while new_capacity < self.count + rows:
+            new_capacity *= 2
+        tmp_path = self.vectors_path + ".tmp.npy"
+        # 既存の行列があればその型を引き継ぐ
+        dtype = self.vectors.dtype if self.vectors is not None else self.dtype
+        vectors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(new_capacity, dim))
+        if self.vectors is not None:
+            vectors[:self.count] = self.vectors[:self.count]
+        vectors.flush()
+        del vectors
+        self.vectors = None
+        os.replace(tmp_path, self.vectors_path)
+        self.vectors = np.lib.format.open_memmap(self.vectors_path, mode="r+")
+        self.alive = np.concatenate([self.alive, np.zeros(new_capacity - capacity, dtype=bool)])
+        self.list_ids = np.concatenate([self.list_ids, np.full(new_capacity - capacity, -1, dtype=np.int32)])
+
+    def add_document(self, name, text):
+        """文書を追加する（内容が変わっていなければ何もしない）。埋め込んだチャンク数を返す"""
+        digest = hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+        with self._lock:
+            row = self._conn.execute("SELECT sha256 FROM documents WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] == digest:
+            return 0
+        chunks = chunk_text(text, self.chunk_tokens, self.overlap_tokens)
+        # 埋め込みはロックの外で行い、その間も検索できるようにする
+        vectors = self._embed(chunks) if chunks else np.zeros((0, self.dim or 0), dtype=np.float32)
+
+        with self._lock:
+            start = self.count
+            if chunks:
+                self._reserve(len(chunks), vectors.shape[1])
+                self.vectors[start:start + len(chunks)] = vectors
+                self.vectors.flush()
+            list_ids = self._assign_lists(vectors)
+            # 古い版のチャンクを検索から外し、新しいチャンクを登録する
+            old_rows = [r for (r,) in self._conn.execute(
+                "SELECT row FROM chunks WHERE document = ? AND deleted = 0", (name,))]
+            self._conn.execute("UPDATE chunks SET deleted = 1 WHERE document = ?", (name,))
+            self._conn.executemany(
+                "INSERT INTO chunks (row, document, seq, text, list_id) VALUES (?, ?, ?, ?, ?)",
+                [(start + seq, name, seq, chunk, list_id if list_id >= 0 else None)
+                 for seq, (chunk, list_id) in enumerate(zip(chunks, list_ids))],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (name, sha256, chunks, updated_at) VALUES (?, ?, ?, ?)",
+                (name, digest, len(chunks), time.time()),
+            )
+            self._conn.commit()
+            self.alive[old_rows] = False
+            self.alive[start:start + len(chunks)] = True
+            self.list_ids[start:start + len(chunks)] = list_ids
+            self.count = start + len(chunks)
+            self._written()
+        return len(chunks)
+
+    def remove_document(self, name):
+        with self._lock:
+            rows = [r for (r,) in self._conn.execute("SELECT row FROM chunks WHERE document = ?", (name,))]
+            self._conn.execute("UPDATE chunks SET deleted = 1 WHERE document = ?", (name,))
+            self._conn.execute("DELETE FROM documents WHERE name = ?", (name,))
+            self._conn.commit()
+            self.alive[rows] = False
+
+    def _assign_lists(self, vectors):
+        """IVFを作成済みなら、各ベクトルを最も近いリストに割り当てる（未作成なら -1）"""
+        if self.centroids is None or not len(vectors):
+            return [-1] * len(vectors)
+        return [int(i) for i in np.argmax(vectors @ self.centroids.T, axis=1)]
+
+    def build_ivf(self, lists, seed=0):
+        """k-meansでベクトルを lists 個のリストに分け、検索で調べる範囲を絞れるようにする"""
+        with self._lock:
+            rows = np.flatnonzero(self.alive[:self.count])
+            if len(rows) < lists:
+                raise ValueError(f"IVFのリスト数（{lists}）よりチャンクが少なすぎます（{len(rows)} 件）")
+            rng = np.random.default_rng(seed)
+            sample = np.asarray(self.vectors[np.sort(rng.choice(rows, min(len(rows), IVF_TRAIN_SAMPLES),
+                                                                replace=False))], dtype=np.float32)
+            centroids = sample[rng.choice(len(sample), lists, replace=False)]
+            for _ in range(IVF_ITERATIONS):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                for index in range(lists):
+                    members = sample[assignment == index]
+                    # 空になったリストは中心を動かさない
+                    if len(members):
+                        centroids[index] = members.sum(axis=0)
+                centroids = _normalize(centroids)
+            list_ids = np.full(self.count, -1, dtype=np.int32)
+            for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+                block = np.asarray(self.vectors[start:min(self.count, start + SEARCH_BLOCK_ROWS)], dtype=np.float32)
+                list_ids[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            np.save(self.centroids_path, centroids)
+            self._conn.executemany("UPDATE chunks SET list_id = ? WHERE row = ?",
+                                   [(int(list_ids[row]), int(row)) for row in range(self.count)])
+            self._conn.commit()
+            self.centroids = centroids
+            self.list_ids[:self.count] = list_ids
+            self._written()
+
+    def search(self, query, k=DEFAULT_TOP_K, min_score=DEFAULT_MIN_SCORE, nprobe=DEFAULT_NPROBE):
+        """質問と類似度の高いチャンクを、類似度の高い順に最大k件返す"""
+        self.refresh()
+        if self.vectors is None or not len(self):
+            return []
+        return self.search_vector(self._embed([query])[0], k, min_score, nprobe)
+
+    def search_vector(self, query_vector, k=DEFAULT_TOP_K, min_score=DEFAULT_MIN_SCORE, nprobe=DEFAULT_NPROBE):
+        """正規化済みの質問のベクトルで検索する（複数のインデックスを1回の埋め込みで検索するため）"""
+        self.refresh()
+        if self.vectors is None or not len(self):
+            return []
+        with self._lock:
+            if self.centroids is not None:
+                # IVF: 質問に近い nprobe 個のリストのチャンクだけを調べる
+                probe = np.argsort(self.centroids @ query_vector)[::-1][:nprobe]
+                rows = np.flatnonzero(self.alive[:self.count] & np.isin(self.list_ids[:self.count], probe))
+                scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query_vector
+            else:
+                scores = np.empty(self.count, dtype=np.float32)
+                for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+                    block = self.vectors[start:min(self.count, start + SEARCH_BLOCK_ROWS)]
+                    scores[start:start + len(block)] = np.asarray(block, dtype=np.float32) @ query_vector
+                rows = np.flatnonzero(self.alive[:self.count])
+                scores = scores[rows]
+            if not len(rows):
+                return []
+            top = np.argpartition(-scores, min(k, len(rows)) - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results = []
+            for index in top:
+                if scores[index] < min_score:
+                    break
+                document, seq, text = self._conn.execute(
+                    "SELECT document, seq, text FROM chunks WHERE row = ?", (int(rows[index]),)
+                ).fetchone()
+                results.append(RetrievedChunk(document, seq, text, float(scores[index])))
+        return results
+
+    def retrieve(self, query, max_tokens, k=DEFAULT_TOP_K, min_score=DEFAULT_MIN_SCORE):
+        """max_tokens に収まる範囲で、類似度の高いチャンクを返す"""
+        return retrieve([self], query, max_tokens, k, min_score)
+
+
+def retrieve(indexes, query, max_tokens, k=DEFAULT_TOP_K, min_score=DEFAULT_MIN_SCORE):
+    """複数のインデックスから類似度の高い順にチャンクを集め、max_tokens に収まる分を返す"""
+    for index in indexes:
+        index.refresh()
+    indexes = [index for index in indexes if len(index)]
+    if not indexes:
+        return []
+    query_vector = indexes[0]._embed([query])[0]
+    candidates = []
+    for index in indexes:
+        candidates.extend(index.search_vector(query_vector, k, min_score))
+    candidates.sort(key=lambda chunk: chunk.score, reverse=True)
+    selected = []
+    used = 0
+    for chunk in candidates[:k]:
+        tokens = count_tokens(chunk.text)
+        if used + tokens > max_tokens:
+            break
+        selected.append(chunk)
+        used += tokens
+    return selected
+
+
+def get_document_index(embed, namespace=SHARED_NAMESPACE, create=True):
+    """環境変数の設定で作成した、名前空間ごとにプロセス全体で共有する文書インデックスを返す
+
+    create=False の場合、まだ資料が登録されていない（ディレクトリがない）名前空間には None を返す。
+    開いたままにするインデックスは RAG_MAX_OPEN_INDEXES 件までで、最も長く使われていないものから手放す。
+    """
+    if not _NAMESPACE_PATTERN.fullmatch(namespace):
+        raise ValueError(f"名前空間に使えない文字が含まれています: {namespace!r}")
+    directory = os.path.join(os.path.expanduser(os.getenv("RAG_INDEX_DIR", DEFAULT_INDEX_DIR)), namespace)
+    with _lock:
+        index = _indexes.get(directory)
+        if index is not None:
+            _indexes.move_to_end(directory)
+            return index
+        if not create and not os.path.isdir(directory):
+            return None
+        index = DocumentIndex(
+            directory,
+            embed=embed,
+            dtype=os.getenv("RAG_VECTOR_DTYPE", DEFAULT_DTYPE),
+            chunk_tokens=int(os.getenv("RAG_CHUNK_TOKENS", DEFAULT_CHUNK_TOKENS)),
+            overlap_tokens=int(os.getenv("RAG_CHUNK_OVERLAP", DEFAULT_CHUNK_OVERLAP)),
+            batch_size=int(os.getenv("RAG_EMBEDDING_BATCH_SIZE", DEFAULT_BATCH_SIZE)),
+        )
+        _indexes[directory] = index
+        while len(_indexes) > max(1, int(os.getenv("RAG_MAX_OPEN_INDEXES", DEFAULT_MAX_OPEN_INDEXES))):
+            # 検索中の可能性があるため閉じずに参照だけを外す（使われなくなった時点で接続とメモリマップが解放される）
+            _indexes.popitem(last=False)
+    return index
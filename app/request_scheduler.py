@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+クライアント側のリクエストスケジューラー
+プロセス内の全セッションからのリクエストを、モデルごとの同時実行数の上限と
+有限の待ち行列で制御します。待ち行列は優先度クラスごとに分かれ、
+同じ優先度の中ではセッション単位のラウンドロビンで公平に処理します。
+待ち行列が満杯の場合は待たずに QueueFullError で失敗させます（バックプレッシャー）。
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import metrics_exporter
+
+# 優先度の高い順
+PRIORITIES = ("interactive", "background")
+DEFAULT_MAX_CONCURRENCY = 2
+DEFAULT_MAX_QUEUE = 16
+
+_lock = threading.Lock()
+_scheduler = None
+
+
+class QueueFullError(Exception):
+    """待ち行列が満杯でリクエストを受け付けられない"""
+
+
+class QueueTimeoutError(Exception):
+    """待ち行列で待っている間にタイムアウトした"""
+
+
+class Ticket:
+    """待ち行列に入った1リクエスト"""
+
+    def __init__(self, model, session_id, priority):
+        self.model = model
+        self.session_id = session_id
+        self.priority = priority
+        self.enqueued_at = time.perf_counter()
+        self.granted_at = None
+        self.event = threading.Event()
+
+    @property
+    def wait_time(self):
+        """実行枠を得るまでに待った時間（秒）"""
+        if self.granted_at is None:
+            return None
+        return self.granted_at - self.enqueued_at
+
+
+class _ModelQueue:
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        # 優先度ごとに、セッションID -> そのセッションの待ちチケット
+        self.waiting = {priority: OrderedDict() for priority in PRIORITIES}
+        self.size = 0
+
+    def push(self, ticket):
+        sessions = self.waiting[ticket.priority]
+        sessions.setdefault(ticket.session_id, deque()).append(ticket)
+        self.size += 1
+
+    def pop(self):
+        """優先度の高いクラスから、セッションのラウンドロビンで次のチケットを取り出す"""
+        for priority in PRIORITIES:
+            sessions = self.waiting[priority]
+            if not sessions:
+                continue
+            session_id, tickets = next(iter(sessions.items()))
+            ticket = tickets.popleft()
+            del sessions[session_id]
+            if tickets:
+                # 同じセッションの残りは最後尾に回す
+                sessions[session_id] = tickets
+            self.size -= 1
+            return ticket
+        return None
+
+    def remove(self, ticket):
+        tickets = self.waiting[ticket.priority].get(ticket.session_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self.waiting[ticket.priority][ticket.session_id]
+            self.size -= 1
+
+    def position(self, ticket):
+        """チケットより先に処理される待ちの数（おおよそ）"""
+        ahead = 0
+        for priority in PRIORITIES:
+            if priority == ticket.priority:
+                break
+            ahead += sum(len(tickets) for tickets in self.waiting[priority].values())
+        return ahead + sum(len(tickets) for tickets in self.waiting[ticket.priority].values()) - 1
+
+
+class RequestScheduler:
+    """モデルごとの同時実行数と待ち行列を管理するディスパッチャー"""
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_queue=DEFAULT_MAX_QUEUE,
+                 model_concurrency=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.model_concurrency = dict(model_concurrency or {})
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def _queue_for(self, model):
+        queue = self._queues.get(model)
+        if queue is None:
+            limit = self.max_concurrency
+            for pattern, value in self.model_concurrency.items():
+                if pattern in (model or "").lower():
+                    limit = value
+                    break
+            queue = _ModelQueue(max(1, limit))
+            self._queues[model] = queue
+        return queue
+
+    def _grant(self, queue, ticket):
+        queue.active += 1
+        ticket.granted_at = time.perf_counter()
+        ticket.event.set()
+
+    def _dispatch(self, queue):
+        while queue.active < queue.max_concurrency:
+            ticket = queue.pop()
+            if ticket is None:
+                break
+            self._grant(queue, ticket)
+        metrics_exporter.set_queue_depth(self._model_of(queue), queue.size)
+
+    def _model_of(self, queue):
+        for model, candidate in self._queues.items():
+            if candidate is queue:
+                return model
+        return None
+
+    def acquire(self, model, session_id, priority="interactive", timeout=None, on_wait=None):
+        """実行枠を取得する。待ち行列が満杯なら即座に QueueFullError を送出する"""
+        if priority not in PRIORITIES:
+            raise ValueError(f"未知の優先度です: {priority}")
+        ticket = Ticket(model, session_id, priority)
+        with self._lock:
+            queue = self._queue_for(model)
+            if queue.active < queue.max_concurrency and queue.size == 0:
+                self._grant(queue, ticket)
+                return ticket
+            if queue.size >= self.max_queue:
+                metrics_exporter.observe_error(model, "queue_full")
+                raise QueueFullError(f"モデル '{model}' の待ち行列が満杯です（{self.max_queue}件）")
+            queue.push(ticket)
+            position = queue.position(ticket)
+            metrics_exporter.set_queue_depth(model, queue.size)
+        if on_wait is not None:
+            on_wait(position)
+        if not ticket.event.wait(timeout):
+            with self._lock:
+                if not ticket.event.is_set():
+                    queue.remove(ticket)
+                    metrics_exporter.set_queue_depth(model, queue.size)
+                    metrics_exporter.observe_error(model, "queue_timeout")
+                    raise QueueTimeoutError(f"モデル '{model}' の順番待ちがタイムアウトしました")
+        return ticket
+
+    def release(self, ticket):
+        """実行枠を返却し、次の待ちチケットに割り当てる"""
+        with self._lock:
+            queue = self._queue_for(ticket.model)
+            queue.active = max(0, queue.active - 1)
+            self._dispatch(queue)
+
+    @contextmanager
+    def slot(self, model, session_id, priority="interactive", timeout=None, on_wait=None):
+        """with文の間だけ実行枠を確保する"""
+        ticket = self.acquire(model, session_id, priority, timeout, on_wait)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self, model):
+        """モデルの (実行中の数, 待ちの数, 上限) を返す"""
+        with self._lock:
+            queue = self._queues.get(model)
+            if queue is None:
+                return 0, 0, self.max_concurrency
+            return queue.active, queue.size, queue.max_concurrency
+
+
+def _parse_model_concurrency():
+    """SCHEDULER_MODEL_CONCURRENCY="tinyllama:4,7b:1" 形式の設定を読み込む"""
+    limits = {}
+    for item in os.getenv("SCHEDULER_MODEL_CONCURRENCY", "").split(","):
+        pattern, _, value = item.partition(":")
+        if pattern.strip() and value.strip().isdigit():
+            limits[pattern.strip().lower()] = int(value)
+    return limits
+
+
+def get_scheduler():
+    """プロセス全体で共有するスケジューラーを返す"""
+    global _scheduler
+    if _scheduler is None:
+        with _lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler(
+                    max_concurrency=int(os.getenv("SCHEDULER_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+                    max_queue=int(os.getenv("SCHEDULER_MAX_QUEUE", DEFAULT_MAX_QUEUE)),
+                    model_concurrency=_parse_model_concurrency(),
+                )
+    return _scheduler
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GPUStack呼び出しの再試行・サーキットブレーカー・エラー分類
+安全な呼び出しはジッター付きの指数バックオフで再試行し、
+失敗が続くバックエンドにはサーキットブレーカーで一定時間リクエストを送らず回復を待ちます。
+例外は種類ごとに分類し、UIに表示する日本語のメッセージを付けます。
+"""
+
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+import requests
+
+import metrics_exporter
+from gpustack_client import ClientErrors
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 8.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+# サーバーが処理せずに断ったことが明らかなステータス（POSTでも再試行してよい）
+OVERLOADED_STATUS = (429, 503)
+# 処理された可能性があるため、冪等な呼び出しのみ再試行するステータス
+SERVER_ERROR_STATUS = (500, 502, 504)
+
+# バックエンドの不調とみなしてブレーカーに数えるエラーの種類
+BREAKER_KINDS = ("connection", "timeout", "overloaded", "server")
+
+ERROR_MESSAGES = {
+    "connection": "GPUStackサーバーに接続できません。サーバーが実行中か確認してください。",
+    "timeout": "GPUStackサーバーの応答がタイムアウトしました。負荷が高い可能性があります。",
+    "overloaded": "GPUStackサーバーが混み合っています。しばらく待ってから再度お試しください。",
+    "server": "GPUStackサーバーでエラーが発生しました。サーバーのログを確認してください。",
+    "auth": "認証に失敗しました。APIキーを確認してください。",
+    "not_found": "モデルまたはAPIが見つかりません。モデルが停止・削除されていないか確認してください。",
+    "client": "リクエストが受け付けられませんでした。パラメータを確認してください。",
+    "circuit_open": "GPUStackサーバーへの失敗が続いているため、一時的にリクエストを停止しています。",
+    "invalid_response": "GPUStackサーバーから不正な応答が返されました。",
+    "unknown": "予期しないエラーが発生しました。",
+}
+
+_lock = threading.Lock()
+_breakers = {}
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているためリクエストを送らなかった"""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"サーキットブレーカー '{name}' が開いています（あと {retry_in:.0f} 秒）")
+        self.name = name
+        self.retry_in = retry_in
+
+
+@dataclass(frozen=True)
+class ErrorInfo:
+    """分類済みのエラー"""
+
+    kind: str
+    message: str
+    status: int = None
+    detail: str = ""
+    retry_after: float = None
+
+    @property
+    def transient(self):
+        """サーバーが処理していないことが明らかで、どの呼び出しでも再試行してよいか"""
+        return self.kind in ("connection", "overloaded")
+
+    def retryable(self, idempotent):
+        if self.transient:
+            return True
+        return idempotent and self.kind in ("timeout", "server")
+
+    def __str__(self):
+        return f"{self.message}（{self.detail}）" if self.detail else self.message
+
+
+def _status_of(error):
+    if isinstance(error, ClientErrors.api_status):
+        return error.status_code, error.response
+    if (isinstance(error, (requests.exceptions.HTTPError,) + ClientErrors.http_status)
+            and error.response is not None):
+        return error.response.status_code, error.response
+    return None, None
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _kind_for_status(status):
+    if status in OVERLOADED_STATUS:
+        return "overloaded"
+    if status in (401, 403):
+        return "auth"
+    if status == 404:
+        return "not_found"
+    if status >= 500:
+        return "server"
+    return "client"
+
+
+def classify_error(error):
+    """例外を ErrorInfo に分類する"""
+    detail = str(error)
+    if isinstance(error, CircuitOpenError):
+        return ErrorInfo("circuit_open", ERROR_MESSAGES["circuit_open"], detail=detail,
+                         retry_after=error.retry_in)
+    status, response = _status_of(error)
+    if status is not None:
+        kind = _kind_for_status(status)
+        return ErrorInfo(kind, ERROR_MESSAGES[kind], status, f"HTTP {status}", _retry_after(response))
+    # 接続タイムアウトは接続失敗として扱う（サーバーには届いていない）
+    # openai・httpx の型はクライアントを作るときに解決する（作る前はその例外は起こり得ない）
+    if isinstance(error, (requests.exceptions.ConnectTimeout,) + ClientErrors.connect_timeout
+                  + ClientErrors.connect_error):
+        kind = "connection"
+    elif isinstance(error, (requests.exceptions.Timeout,) + ClientErrors.api_timeout + ClientErrors.timeout):
+        kind = "timeout"
+    elif isinstance(error, (requests.exceptions.ConnectionError,) + ClientErrors.api_connection
+                    + ClientErrors.transport):
+        kind = "connection"
+    elif isinstance(error, ValueError):
+        kind = "invalid_response"
+    else:
+        kind = "unknown"
+    return ErrorInfo(kind, ERROR_MESSAGES[kind], detail=detail)
+
+
+def classify_status(status):
+    """HTTPステータスコードを ErrorInfo に分類する（例外を送出しない呼び出し向け）"""
+    kind = _kind_for_status(status)
+    return ErrorInfo(kind, ERROR_MESSAGES[kind], status, f"HTTP {status}")
+
+
+def describe_error(error):
+    """UIやログに表示する日本語のエラーメッセージ"""
+    return str(classify_error(error))
+
+
+class CircuitBreaker:
+    """連続した失敗でリクエストを遮断し、一定時間後に1件だけ試して回復を確認する"""
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """リクエストを送ってよければ何もせず、遮断中なら CircuitOpenError を送出する"""
+        with self._lock:
+            if self.state == "closed":
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == "open" and elapsed >= self.reset_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            raise CircuitOpenError(self.name, max(0.0, self.reset_timeout - elapsed))
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record(self, info):
+        """分類済みのエラーを記録する（4xxなどバックエンドが生きている応答は成功扱い）"""
+        if info is None or info.kind not in BREAKER_KINDS:
+            self.record_success()
+        else:
+            self.record_failure()
+
+
+class RetryPolicy:
+    """ジッター付き指数バックオフ（full jitter）の再試行方針"""
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """attempt回目（1始まり）の失敗後に待つ秒数"""
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def response_error(result):
+    """ステータスコード付きの応答オブジェクトなら、再試行の判定に使う ErrorInfo を返す"""
+    status = getattr(result, "status_code", None)
+    if isinstance(status, int) and status >= 400:
+        info = classify_status(status)
+        return ErrorInfo(info.kind, info.message, status, info.detail, _retry_after(result))
+    return None
+
+
+def resilient_call(func, idempotent=True, breaker=None, policy=None, model=None, sleep=time.sleep):
+    """func() をブレーカーと再試行方針のもとで実行する
+
+    idempotent=False の呼び出し（チャットの生成やデプロイなど）は、
+    サーバーが処理していないことが明らかな失敗（接続失敗・429/503）のみ再試行します。
+    エラーのステータスコードを返す応答（requests.Response など）も再試行の対象で、
+    再試行し尽くした場合はその応答をそのまま返します。
+    """
+    policy = policy or get_retry_policy()
+    for attempt in range(1, policy.max_attempts + 1):
+        if breaker is not None:
+            breaker.allow()
+        try:
+            result = func()
+        except Exception as e:
+            info = classify_error(e)
+            if breaker is not None:
+                breaker.record(info)
+            if attempt >= policy.max_attempts or not info.retryable(idempotent):
+                raise
+        else:
+            info = response_error(result)
+            if breaker is not None:
+                breaker.record(info)
+            if info is None or attempt >= policy.max_attempts or not info.retryable(idempotent):
+                return result
+        metrics_exporter.observe_retry(model)
+        sleep(policy.delay(attempt, info.retry_after))
+
+
+def get_retry_policy():
+    """環境変数で設定した再試行方針を返す"""
+    return RetryPolicy(
+        max_attempts=int(os.getenv("GPUSTACK_RETRY_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+        base_delay=float(os.getenv("GPUSTACK_RETRY_BASE_DELAY", DEFAULT_BASE_DELAY)),
+        max_delay=float(os.getenv("GPUSTACK_RETRY_MAX_DELAY", DEFAULT_MAX_DELAY)),
+    )
+
+
+def get_breaker(name):
+    """名前ごとに共有するサーキットブレーカーを返す"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    name,
+                    failure_threshold=int(os.getenv("GPUSTACK_BREAKER_THRESHOLD", DEFAULT_FAILURE_THRESHOLD)),
+                    reset_timeout=float(os.getenv("GPUSTACK_BREAKER_RESET", DEFAULT_RESET_TIMEOUT)),
+                )
+                _breakers[name] = breaker
+    return breaker
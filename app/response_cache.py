@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+繰り返しの質問に対する応答キャッシュ
+モデル・正規化したメッセージ・サンプリングパラメータをキーにSQLiteへ保存し、
+再起動後も再利用できるようにします。temperatureが0のリクエストのみを対象とし、
+埋め込みモデルが設定されている場合は類似度による近似ヒットも行います。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+
+from prompt_builder import canonicalize_text
+
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.gpustack/response_cache.db")
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+# 近似検索で比較する候補の最大件数
+SEMANTIC_CANDIDATES = 200
+MMAP_SIZE = 64 * 1024 * 1024
+
+_lock = threading.Lock()
+_caches = {}
+
+
+def _digest(payload):
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _normalize_messages(messages):
+    return [{"role": m["role"], "content": canonicalize_text(m["content"])} for m in messages]
+
+
+def is_cacheable(params):
+    """決定的な（temperature=0の）リクエストのみキャッシュする"""
+    return float(params.get("temperature", 1.0)) == 0.0
+
+
+@dataclass
+class CacheLookup:
+    """キャッシュ検索の結果（ミスの場合も保存に必要なキーを保持する）"""
+
+    key: str
+    context_key: str
+    prompt: str
+    response: str = None
+    kind: str = None
+    embedding: list = None
+
+    @property
+    def hit(self):
+        return self.response is not None
+
+
+class ResponseCache:
+    """SQLiteを永続化先とするLRU/TTL付きの応答キャッシュ"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 embed=None, similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                context_key TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                response TEXT NOT NULL,
+                usage TEXT,
+                embedding BLOB,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_context ON responses (context_key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (last_access)")
+        self._conn.commit()
+
+    def _keys(self, model, messages, params):
+        normalized = _normalize_messages(messages)
+        params = {name: params.get(name) for name in sorted(params)}
+        key = _digest({"model": model, "messages": normalized, "params": params})
+        # 近似検索は直前までの文脈が同じで最後の発言だけが似ているものに限る
+        context_key = _digest({"model": model, "messages": normalized[:-1], "params": params})
+        prompt = normalized[-1]["content"] if normalized else ""
+        return key, context_key, prompt
+
+    def _embed(self, text):
+        if self.embed is None or not text:
+            return None
+        try:
+            return self.embed(text)
+        except Exception:
+            # 埋め込みが取得できなくても完全一致のキャッシュは使えるようにする
+            return None
+
+    def lookup(self, model, messages, params):
+        """キャッシュを検索する"""
+        key, context_key, prompt = self._keys(model, messages, params)
+        result = CacheLookup(key, context_key, prompt)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._touch(key, now)
+                self.exact_hits += 1
+                result.response, result.kind = row[0], "exact"
+                return result
+
+        result.embedding = self._embed(prompt)
+        if result.embedding is not None:
+            match = self._nearest(context_key, result.embedding)
+            if match is not None:
+                with self._lock:
+                    self._touch(match[0], now)
+                    self.semantic_hits += 1
+                result.response, result.kind = match[1], "semantic"
+                return result
+
+        with self._lock:
+            self.misses += 1
+        return result
+
+    def _nearest(self, context_key, embedding):
+        query = array("f", embedding)
+        query_norm = sum(v * v for v in query) ** 0.5
+        if not query_norm:
+            return None
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, response, embedding FROM responses "
+                "WHERE context_key = ? AND embedding IS NOT NULL "
+                "ORDER BY last_access DESC LIMIT ?",
+                (context_key, SEMANTIC_CANDIDATES),
+            ).fetchall()
+        best = None
+        best_score = self.similarity_threshold
+        for key, response, blob in rows:
+            vector = array("f")
+            vector.frombytes(blob)
+            if len(vector) != len(query):
+                continue
+            norm = sum(v * v for v in vector) ** 0.5
+            if not norm:
+                continue
+            score = sum(a * b for a, b in zip(query, vector)) / (query_norm * norm)
+            if score >= best_score:
+                best, best_score = (key, response), score
+        return best
+
+    def _touch(self, key, now):
+        self._conn.execute("UPDATE responses SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        self._conn.commit()
+
+    def store(self, lookup, model, response, usage=None):
+        """ミスしたリクエストの応答を保存する"""
+        if not response:
+            return
+        now = time.time()
+        blob = array("f", lookup.embedding).tobytes() if lookup.embedding is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, context_key, model, prompt, response, usage, embedding, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (lookup.key, lookup.context_key, model, lookup.prompt, response,
+                 json.dumps(usage) if usage else None, blob, now, now),
+            )
+            # 最大件数を超えた分は最後に使われた時刻が古いものから削除する（LRU）
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @property
+    def hit_rate(self):
+        total = self.exact_hits + self.semantic_hits + self.misses
+        if not total:
+            return None
+        return (self.exact_hits + self.semantic_hits) / total
+
+
+def get_response_cache(embed=None):
+    """環境変数の設定で作成した、プロセス全体で共有する応答キャッシュを返す"""
+    path = os.path.expanduser(os.getenv("RESPONSE_CACHE_PATH", DEFAULT_CACHE_PATH))
+    cache = _caches.get(path)
+    if cache is None:
+        with _lock:
+            cache = _caches.get(path)
+            if cache is None:
+                cache = ResponseCache(
+                    path,
+                    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                    ttl=float(os.getenv("RESPONSE_CACHE_TTL", DEFAULT_TTL)),
+                    embed=embed,
+                    similarity_threshold=float(
+                        os.getenv("RESPONSE_CACHE_SIMILARITY", DEFAULT_SIMILARITY_THRESHOLD)
+                    ),
+                )
+                _caches[path] = cache
+    return cache
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+同一リクエストの合流（シングルフライト）
+同じキーのリクエストが処理中の間に届いた呼び出しは、新たに送信せず処理中の結果を待って共有します。
+多数のセッションが同時に開いたときのモデル一覧・ヘルス確認や、
+temperature=0 の同じ質問による重複した生成をまとめ、GPUの無駄な処理を減らします。
+ストリーミング応答は受け取ったチャンクを記録しながら全ての待ち手に配り、途中から合流した待ち手には最初から再生します。
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+_lock = threading.Lock()
+_groups = {}
+
+
+class StreamCancelledError(Exception):
+    """共有していたストリームが、全ての待ち手が離れたため打ち切られた"""
+
+
+def request_key(*parts):
+    """リクエストの内容（エンドポイント・モデル・メッセージ・パラメータ）から合流用のキーを作る"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """処理中の1回の呼び出し"""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """呼び出しの完了を待って結果を返す（失敗した場合は同じ例外を送出する）"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("合流したリクエストの完了待ちがタイムアウトしました")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Broadcast:
+    """1本のストリームを読み、チャンクを全ての購読者に配る"""
+
+    def __init__(self, source, on_finish=None):
+        self._source = source
+        self._on_finish = on_finish
+        self._items = []
+        self._cond = threading.Condition()
+        self._subscribers = 0
+        self.started_at = time.perf_counter()
+        self.first_item_at = None
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        # 最初の購読者が読むのを待たずに読み始める（購読者の描画が遅くても上流を待たせない）
+        self._thread = threading.Thread(target=self._pump, name="singleflight-broadcast", daemon=True)
+        self._thread.start()
+
+    @property
+    def latency(self):
+        """最初のチャンクが届くまでの時間（秒）"""
+        if self.first_item_at is None:
+            return None
+        return self.first_item_at - self.started_at
+
+    def _pump(self):
+        try:
+            for item in self._source:
+                with self._cond:
+                    if self.first_item_at is None:
+                        self.first_item_at = time.perf_counter()
+                    self._items.append(item)
+                    self._cond.notify_all()
+                    if self.cancelled:
+                        break
+        except Exception as e:
+            # 打ち切った接続の読み込みエラーは失敗として扱わない
+            if not self.cancelled:
+                self.error = e
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            if self._on_finish is not None:
+                self._on_finish(self)
+
+    def subscribe(self):
+        """最初のチャンクから読める購読を返す"""
+        with self._cond:
+            self._subscribers += 1
+        return Subscription(self)
+
+    def _unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+            if self._subscribers > 0 or self.done:
+                return
+            # 誰も読んでいないストリームは接続を閉じて生成を止める
+            self.cancelled = True
+        close = getattr(self._source, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+
+    def _get(self, index):
+        """index 番目のチャンクを返す（届くまで待つ。終わりなら StopIteration）"""
+        with self._cond:
+            while index >= len(self._items) and not self.done:
+                self._cond.wait()
+            if index < len(self._items):
+                return self._items[index]
+            if self.error is not None:
+                raise self.error
+            if self.cancelled:
+                raise StreamCancelledError("共有していたストリームが打ち切られました")
+            raise StopIteration
+
+
+class Subscription:
+    """Broadcast の1購読者分のイテレーター（close() で購読をやめる）"""
+
+    def __init__(self, broadcast):
+        self._broadcast = broadcast
+        self._index = 0
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            item = self._broadcast._get(self._index)
+        except BaseException:
+            self.close()
+            raise
+        self._index += 1
+        return item
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._broadcast._unsubscribe()
+
+
+class Group:
+    """キーごとに処理中の呼び出しを1つにまとめる"""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _begin(self, key):
+        """(Flight, 自分が実行するかどうか) を返す"""
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.shared += 1
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            return flight, True
+
+    def _finish(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight._done.set()
+
+    def join(self, key):
+        """処理中の呼び出しがあれば合流して Flight を返す（なければ None）"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                return None
+            self.calls += 1
+            self.shared += 1
+            return flight
+
+    def do(self, key, func):
+        """func() を実行して (結果, 共有したかどうか) を返す
+
+        同じキーの呼び出しが処理中なら実行せずにその結果を待つ。失敗も全ての待ち手に同じ例外で返す。
+        """
+        flight, leader = self._begin(key)
+        if not leader:
+            return flight.wait(), True
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._finish(key, flight)
+        return flight.result, False
+
+    def stream(self, key, open_stream, on_finish=None):
+        """open_stream() で開いたストリームを共有し、(購読, 共有したかどうか) を返す
+
+        ストリームを最後まで読み終えるまでは、同じキーの呼び出しはこのストリームに合流する。
+        on_finish(broadcast) は上流を読み終えたとき（失敗・打ち切りを含む）に1回呼ばれる。
+        """
+        flight, leader = self._begin(key)
+        if not leader:
+            return flight.wait().subscribe(), True
+
+        def finish(broadcast):
+            try:
+                if on_finish is not None:
+                    on_finish(broadcast)
+            finally:
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+
+        try:
+            broadcast = Broadcast(open_stream(), on_finish=finish)
+        except BaseException as e:
+            flight.error = e
+            self._finish(key, flight)
+            raise
+        # 最初の購読を登録してから待ち手を起こす（先に全員が離れて打ち切られないようにする）
+        subscription = broadcast.subscribe()
+        flight.result = broadcast
+        flight._done.set()
+        return subscription, False
+
+    def stats(self):
+        """(呼び出し数, 合流した数, 処理中のキー数) を返す"""
+        with self._lock:
+            return self.calls, self.shared, len(self._flights)
+
+
+def get_group(name):
+    """名前ごとに共有する合流グループを返す"""
+    group = _groups.get(name)
+    if group is None:
+        with _lock:
+            group = _groups.get(name)
+            if group is None:
+                group = Group(name)
+                _groups[name] = group
+    return group
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+トークン数の計測ユーティリティ
+APIレスポンスのusageを優先し、サーバーがusageを返さない場合は
+ローカルのBPEトークナイザー（tiktoken）でトークン数を数えます。
+tiktokenが利用できない環境では文字種に基づく概算にフォールバックします。
+"""
+
+import os
+import re
+import unicodedata
+from functools import lru_cache
+
+DEFAULT_ENCODING = "cl100k_base"
+# チャット形式のメッセージ1件あたりのオーバーヘッド（ロール・区切りトークン）
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 2
+
+_ASCII_WORD_RE = re.compile(r"[A-Za-z0-9_]+")
+
+
+@lru_cache(maxsize=32)
+def _get_encoder(model):
+    """モデルごとのエンコーダーを取得する（生成結果はキャッシュされる）"""
+    # 起動時間を抑えるため、最初にトークンを数えるときに読み込む
+    try:
+        import tiktoken
+    except ImportError:  # pragma: no cover - オプション依存
+        return None
+    encoding_name = os.getenv("TOKENIZER_ENCODING", DEFAULT_ENCODING)
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception:
+        # エンコーディングファイルを取得できない（オフライン等）場合は概算を使う
+        return None
+
+
+def _estimate_tokens(text):
+    """トークナイザーがない場合の概算（CJK文字は1文字1トークン、英数字は約4文字1トークン）"""
+    tokens = 0.0
+    for word in _ASCII_WORD_RE.findall(text):
+        tokens += max(1.0, len(word) / 4)
+    remainder = _ASCII_WORD_RE.sub("", text)
+    for char in remainder:
+        if char.isspace():
+            continue
+        if unicodedata.east_asian_width(char) in ("W", "F"):
+            tokens += 1.0
+        else:
+            tokens += 0.5
+    return int(round(tokens))
+
+
+def count_tokens(text, model=None):
+    """テキストのトークン数を数える"""
+    if not text:
+        return 0
+    encoder = _get_encoder(model or "")
+    if encoder is None:
+        return _estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model=None):
+    """チャット形式のメッセージ列のトークン数を数える"""
+    total = REPLY_PRIMING_TOKENS
+    for message in messages:
+        total += MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content") or "", model)
+    return total
+
+
+def usage_to_dict(usage):
+    """APIレスポンスのusage（オブジェクトまたはdict）をdictに変換する"""
+    if usage is None:
+        return None
+    if hasattr(usage, "model_dump"):
+        usage = usage.model_dump()
+    elif not isinstance(usage, dict):
+        usage = dict(vars(usage))
+    if usage.get("prompt_tokens") is None and usage.get("completion_tokens") is None:
+        return None
+    return usage
+
+
+def resolve_token_usage(usage, messages, completion, model=None):
+    """usageがあればそれを使い、なければローカルで数えたトークン数を返す
+
+    戻り値は (prompt_tokens, completion_tokens, source) で、sourceは "api" または "local"
+    """
+    usage = usage_to_dict(usage)
+    if usage:
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = count_message_tokens(messages, model)
+        if completion_tokens is None:
+            completion_tokens = count_tokens(completion, model)
+        return prompt_tokens, completion_tokens, "api"
+    return count_message_tokens(messages, model), count_tokens(completion, model), "local"
@@ -1,18 +1,9 @@
 #!/bin/bash
 set -e
 
-gpustack start --port 80 &
-GPUSTACK_PID=$!
-
-echo "Waiting for GPUStack to start..."
-sleep 10
-
-if [ "$DEPLOY_MODEL" = "true" ]; then
-    echo "Deploying a small model..."
-    python /app/scripts/deploy_small_model.py
-fi
-
-cd /app/app
-streamlit run app.py
-
-wait $GPUSTACK_PID
+# GPUStack and Streamlit start in parallel; the model is deployed as soon as
+# GPUStack passes its readiness probe (DEPLOY_MODEL=true), instead of after a fixed sleep.
+# The supervisor forwards SIGTERM to both and restarts them if they crash.
+exec python /app/scripts/startup_supervisor.py \
+    --gpustack-port 80 \
+    --timeline-json /var/lib/gpustack/startup_timeline.json
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GPUStack バッチ推論スクリプト
+JSONLのプロンプトファイルを逐次読み込み、asyncioでN件を同時に処理しながら
+結果をJSONL（またはParquet）へ逐次書き出します。
+
+- 入力の各行は {"id": ..., "prompt": "..."} または {"id": ..., "messages": [...]} 形式
+  （"system", "max_tokens", "temperature", "top_p" を行ごとに指定可能）
+- 同じプロンプト・パラメータの行は1回だけ送信し、結果を使い回します
+- 完了した行はチェックポイントに記録されるため、中断しても同じコマンドで再開できます
+
+使用例:
+  python batch_infer.py prompts.jsonl -o results.jsonl --concurrency 8
+  python batch_infer.py prompts.jsonl -o results.parquet --format parquet --model qwen2.5-0.5b
+  python batch_infer.py prompts.jsonl -o results.jsonl --mock   # GPUなしでモックサーバーに対して実行
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+
+import httpx
+
+# 共通のAPIクライアントモジュール（app/gpustack_client.py）を読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from gpustack_client import auth_headers, resolve_client_errors
+from prompt_builder import canonical_message, prompt_cache_extra_body
+from resilience import classify_error, get_retry_policy
+
+API_BASE = os.getenv("GPUSTACK_API_BASE", "http://localhost:8000/v1")
+REQUEST_PARAMS = ("max_tokens", "temperature", "top_p")
+# 結果行のうちリクエストの結果にあたる列（再開時に重複の結果として使い回す）
+RESULT_FIELDS = ("response", "usage", "latency", "attempts", "error")
+PARQUET_BATCH_SIZE = 256
+
+
+def build_messages(row):
+    """入力行からチャットのメッセージ列を作る"""
+    if "_invalid" in row:
+        raise ValueError(f"JSONとして読み込めません: {row['_invalid']}")
+    if "messages" in row:
+        return [canonical_message(m["role"], m["content"]) for m in row["messages"]]
+    if "prompt" not in row:
+        raise ValueError("行に 'prompt' または 'messages' がありません")
+    messages = []
+    if row.get("system"):
+        messages.append(canonical_message("system", row["system"]))
+    messages.append(canonical_message("user", row["prompt"]))
+    return messages
+
+
+def request_key(model, messages, params):
+    """重複排除とチェックポイントに使うリクエストのキー"""
+    payload = json.dumps(
+        {"model": model, "messages": [(m["role"], m["content"]) for m in messages], "params": params},
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def read_checkpoint(path):
+    """チェックポイントから成功した結果行を読み込む（途中で切れた最終行は無視する）"""
+    done = []
+    if not path or not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if row.get("key") and row.get("error") is None:
+                done.append(row)
+    return done
+
+
+def count_lines(path):
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+class ParquetSink:
+    """結果をParquetの行グループとして逐次書き出す（pyarrowが必要）"""
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquetで出力するには pyarrow をインストールしてください: pip install pyarrow")
+        self._pa = pa
+        self._schema = pa.schema([
+            ("index", pa.int64()),
+            ("id", pa.string()),
+            ("model", pa.string()),
+            ("key", pa.string()),
+            ("response", pa.string()),
+            ("usage", pa.string()),
+            ("latency", pa.float64()),
+            ("attempts", pa.int64()),
+            ("error", pa.string()),
+            ("duplicate_of", pa.int64()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._rows = []
+
+    def write(self, row):
+        # 列の型を揃えるため、idは文字列に、usageはJSON文字列にする
+        row = dict(row)
+        row["id"] = None if row.get("id") is None else str(row["id"])
+        row["usage"] = json.dumps(row["usage"], ensure_ascii=False) if row.get("usage") else None
+        self._rows.append({name: row.get(name) for name in self._schema.names})
+        if len(self._rows) >= PARQUET_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        self._writer.write_table(self._pa.Table.from_pylist(self._rows, schema=self._schema))
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+class BatchRunner:
+    """JSONLのプロンプトを同時実行数を保ちながら処理する"""
+
+    def __init__(self, api_base, model, api_key=None, concurrency=8, defaults=None, timeout=300.0,
+                 progress_interval=5.0):
+        self.api_base = api_base.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.concurrency = concurrency
+        self.defaults = defaults or {}
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+        self.policy = get_retry_policy()
+        self.total = None
+        self.completed = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.output_tokens = 0
+        self.started_at = None
+        # キー -> (完了を通知するFuture, 最初の行番号) / キー -> (最初の行番号, 成功した結果)
+        self._in_flight = {}
+        self._results = {}
+        # 再開時に飛ばす、チェックポイントに書き出し済みの行番号
+        self._done_indexes = set()
+
+    def _params(self, row):
+        return {name: row.get(name, self.defaults.get(name)) for name in REQUEST_PARAMS
+                if row.get(name, self.defaults.get(name)) is not None}
+
+    async def _complete(self, client, messages, params):
+        payload = {"model": self.model, "messages": messages, **params, **prompt_cache_extra_body()}
+        headers = {"Content-Type": "application/json", **auth_headers(self.api_key)}
+        for attempt in range(1, self.policy.max_attempts + 1):
+            start = time.perf_counter()
+            try:
+                response = await client.post(f"{self.api_base}/chat/completions", json=payload, headers=headers)
+                response.raise_for_status()
+                body = response.json()
+                return {
+                    "response": body["choices"][0]["message"]["content"],
+                    "usage": body.get("usage"),
+                    "latency": time.perf_counter() - start,
+                    "attempts": attempt,
+                    "error": None,
+                }
+            except (httpx.HTTPError, ValueError, KeyError, IndexError) as e:
+                info = classify_error(e)
+                # バッチの生成は副作用がないので、タイムアウトやサーバーエラーも再試行する
+                if attempt >= self.policy.max_attempts or not info.retryable(idempotent=True):
+                    return {"response": None, "usage": None, "latency": None, "attempts": attempt,
+                            "error": f"{info.kind}: {info.detail}"}
+                await asyncio.sleep(self.policy.delay(attempt, info.retry_after))
+
+    def _emit(self, sink, base, result, duplicate_of=None):
+        row = dict(base)
+        row.update(result)
+        if duplicate_of is not None:
+            row["duplicate_of"] = duplicate_of
+        sink.write(row)
+        self.completed += 1
+        if row["error"] is not None:
+            self.errors += 1
+        elif duplicate_of is None:
+            self.output_tokens += (row.get("usage") or {}).get("completion_tokens") or 0
+
+    async def _process(self, client, sink, index, row):
+        base = {"index": index, "id": row.get("id", index), "model": self.model}
+        try:
+            messages = build_messages(row)
+        except (KeyError, TypeError, ValueError) as e:
+            self._emit(sink, {**base, "key": None}, {"response": None, "usage": None, "latency": None,
+                                                      "attempts": 0, "error": f"invalid_input: {e}"})
+            return
+        params = self._params(row)
+        key = request_key(self.model, messages, params)
+        base["key"] = key
+
+        if key in self._results:
+            self.duplicates += 1
+            first_index, result = self._results[key]
+            self._emit(sink, base, result, duplicate_of=first_index)
+            return
+        if key in self._in_flight:
+            # 同じリクエストが送信中なら、その完了を待って結果を使い回す
+            self.duplicates += 1
+            future, first_index = self._in_flight[key]
+            result = await asyncio.shield(future)
+            self._emit(sink, base, result, duplicate_of=first_index)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = (future, index)
+        try:
+            result = await self._complete(client, messages, params)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._in_flight[key]
+        if result["error"] is None:
+            self._results[key] = (index, result)
+        future.set_result(result)
+        self._emit(sink, base, result)
+
+    def progress(self):
+        elapsed = time.perf_counter() - self.started_at
+        done = self.completed + self.skipped
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        text = f"[{elapsed:7.1f}s] {done}"
+        if self.total:
+            text += f"/{self.total} ({done / self.total * 100:.1f}%)"
+        text += (f" | {rate:.2f} req/s, {self.output_tokens / elapsed if elapsed > 0 else 0:.1f} tok/s"
+                 f" | 重複 {self.duplicates} / エラー {self.errors} / 再開でスキップ {self.skipped}")
+        if self.total and rate > 0:
+            text += f" | 残り約 {(self.total - done) / rate:.0f} 秒"
+        return text
+
+    async def _report_progress(self, stop):
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), self.progress_interval)
+            except asyncio.TimeoutError:
+                print(self.progress(), file=sys.stderr)
+
+    def restore(self, done):
+        """チェックポイントの完了済みの行を登録する
+
+        書き出し済みの行番号は再開時に飛ばし、その結果は後の行の重複の結果として使い回す。
+        """
+        for row in done:
+            self._done_indexes.add(row["index"])
+            first_index = row.get("duplicate_of")
+            if first_index is None:
+                first_index = row["index"]
+            self._results.setdefault(row["key"], (first_index, {name: row.get(name) for name in RESULT_FIELDS}))
+
+    async def run(self, rows, sink):
+        """(行番号, 行) のイテレーターを処理する。restore() で登録した書き出し済みの行は送信しない"""
+        self.started_at = time.perf_counter()
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        timeout = httpx.Timeout(self.timeout, connect=10.0)
+        # 入力全体をメモリに載せないよう、待ち行列の長さを同時実行数の2倍に抑える
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        stop = asyncio.Event()
+
+        async def worker(client):
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                await self._process(client, sink, *item)
+
+        async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+            reporter = asyncio.create_task(self._report_progress(stop))
+            workers = [asyncio.create_task(worker(client)) for _ in range(self.concurrency)]
+            for index, row in rows:
+                if index in self._done_indexes:
+                    self.skipped += 1
+                    continue
+                await queue.put((index, row))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            stop.set()
+            await reporter
+        return self.summary()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            "model": self.model,
+            "completed": self.completed,
+            "skipped": self.skipped,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "output_tokens": self.output_tokens,
+            "wall_time": elapsed,
+            "requests_per_sec": self.completed / elapsed if elapsed > 0 else None,
+            "output_tokens_per_sec": self.output_tokens / elapsed if elapsed > 0 else None,
+        }
+
+
+class JsonlSink:
+    """結果を1行ずつ書き出し、すぐにフラッシュする（チェックポイントを兼ねる）"""
+
+    def __init__(self, path, append=True):
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+
+    def write(self, row):
+        self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TeeSink:
+    """複数の出力先に同じ行を書き出す"""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, row):
+        for sink in self.sinks:
+            sink.write(row)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def iter_rows(path):
+    """入力JSONLを1行ずつ (行番号, 行) として返す（'-' は標準入力）"""
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for index, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield index, json.loads(line)
+            except ValueError as e:
+                yield index, {"_invalid": str(e)}
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def resolve_model(api_base, api_key=None):
+    """モデル未指定時は最初のRUNNINGモデルを使う"""
+    response = httpx.get(f"{api_base}/models", headers=auth_headers(api_key), timeout=10.0)
+    response.raise_for_status()
+    running = [m["id"] for m in response.json().get("data", []) if m.get("status") == "RUNNING"]
+    return running[0] if running else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONLのプロンプトをまとめて推論するスクリプト")
+    parser.add_argument("input", help="入力JSONLファイル（'-' で標準入力）")
+    parser.add_argument("-o", "--output", required=True, help="出力ファイル")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="出力形式（省略時は拡張子から判定）")
+    parser.add_argument("--checkpoint", help="チェックポイントファイル（省略時はJSONL出力ならそのファイル自身）")
+    parser.add_argument("--no-resume", dest="resume", action="store_false", help="チェックポイントを無視して最初から実行する")
+    parser.add_argument("--api-base", default=API_BASE, help="APIのベースURL")
+    parser.add_argument("--api-key", default=os.getenv("GPUSTACK_API_KEY", ""), help="GPUStackのAPIキー")
+    parser.add_argument("--model", help="モデルID（省略時は最初のRUNNINGモデル）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に処理するリクエスト数")
+    parser.add_argument("--max-tokens", type=int, default=256, help="生成する最大トークン数（行で上書き可能）")
+    parser.add_argument("--temperature", type=float, default=0.0, help="Temperature（行で上書き可能）")
+    parser.add_argument("--top-p", type=float, help="Top P（行で上書き可能）")
+    parser.add_argument("--timeout", type=float, default=300.0, help="1リクエストのタイムアウト（秒）")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="進捗を表示する間隔（秒）")
+    parser.add_argument("--mock", action="store_true", help="内蔵のモックサーバーを起動してその上で実行する")
+    parser.add_argument("--mock-profile", default="fast", help="--mock 時の遅延プロファイル")
+    args = parser.parse_args()
+    # httpx を直接使うため、エラーの分類に使う httpx の型を先に解決しておく
+    resolve_client_errors()
+
+    output_format = args.format or ("parquet" if args.output.endswith(".parquet") else "jsonl")
+    api_base = args.api_base
+    model = args.model
+    if args.mock:
+        from mock_server import run_in_thread
+        mock = run_in_thread(profile=args.mock_profile, models=["mock-batch"])
+        api_base = mock.base_url
+        model = model or mock.model_ids[0]
+        print(f"モックサーバーを起動しました: {api_base}", file=sys.stderr)
+    if not model:
+        try:
+            model = resolve_model(api_base, args.api_key)
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"❌ モデルリストの取得に失敗しました: {classify_error(e)}", file=sys.stderr)
+            return 1
+        if not model:
+            print("❌ 実行中のモデルがありません。--model でモデルを指定してください。", file=sys.stderr)
+            return 1
+
+    checkpoint = args.checkpoint or (args.output if output_format == "jsonl" else args.output + ".checkpoint.jsonl")
+    done = read_checkpoint(checkpoint) if args.resume else []
+    if done:
+        print(f"チェックポイントから {len(done)} 件の完了済みリクエストを読み込みました", file=sys.stderr)
+
+    # 失敗した行は再開時に再送されるため、チェックポイントには成功した行のみ残す
+    checkpoint_sink = JsonlSink(checkpoint, append=False)
+    for row in done:
+        checkpoint_sink.write(row)
+    if output_format == "jsonl" and checkpoint == args.output:
+        sink = checkpoint_sink
+    elif output_format == "jsonl":
+        sink = TeeSink(JsonlSink(args.output, append=False), checkpoint_sink)
+    else:
+        sink = TeeSink(ParquetSink(args.output), checkpoint_sink)
+    # Parquetは追記できないため、完了済みの行も書き直してから新しい行を続ける
+    if sink is not checkpoint_sink:
+        for row in done:
+            sink.sinks[0].write(row)
+
+    runner = BatchRunner(
+        api_base,
+        model,
+        api_key=args.api_key,
+        concurrency=args.concurrency,
+        defaults={"max_tokens": args.max_tokens, "temperature": args.temperature, "top_p": args.top_p},
+        timeout=args.timeout,
+        progress_interval=args.progress_interval,
+    )
+    if args.input != "-":
+        runner.total = count_lines(args.input)
+    print(f"モデル '{model}' で {runner.total or '?'} 件を同時実行数 {args.concurrency} で処理します", file=sys.stderr)
+
+    try:
+        runner.restore(done)
+        summary = asyncio.run(runner.run(iter_rows(args.input), sink))
+    except KeyboardInterrupt:
+        print("\n中断しました。同じコマンドを再実行すると続きから再開します。", file=sys.stderr)
+        return 130
+    finally:
+        sink.close()
+    print(runner.progress(), file=sys.stderr)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0 if not summary["errors"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
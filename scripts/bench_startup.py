@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+チャットアプリの起動時間・再実行時間のベンチマーク
+アプリのモジュールを新しいプロセスで読み込んで import にかかる時間を計測し、
+読み込みの重いライブラリ（openai、matplotlib、numpy、pandas）が起動時に読み込まれていないことを確認します。
+Streamlitがインストールされていれば、モックサーバーにつないだ状態でアプリを実行し、
+初回の描画と、履歴がN件あるときの再実行（ボタン操作のたびに起こるもの）の時間も計測します:
+  python bench_startup.py
+  python bench_startup.py --messages 200 --reruns 10
+  python bench_startup.py --import-budget 500   # 予算を超えたら終了コード1（CI向け）
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, "..", "app"))
+
+# app.py が起動時に読み込むアプリのモジュール
+APP_MODULES = (
+    "gpustack_client", "endpoints", "resilience", "model_cache", "metrics_store", "metrics_exporter",
+    "request_scheduler", "response_cache", "token_counter", "history_manager", "prompt_builder",
+    "model_race", "model_router", "conversation_store", "singleflight",
+)
+# 使うときまで読み込みを遅らせているライブラリ
+DEFERRED_MODULES = ("openai", "httpx", "tiktoken", "matplotlib", "numpy", "pandas")
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure_imports(modules=APP_MODULES):
+    """新しいプロセスでモジュールを読み込み、(合計ms, 上位の読み込み, 読み込まれた遅延対象) を返す"""
+    # インタープリターの起動時に読み込まれるモジュール（site など）は集計から除く
+    baseline = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], capture_output=True, text=True)
+    startup = {match.group(4) for match in map(_IMPORTTIME_LINE.match, baseline.stderr.splitlines()) if match}
+    code = (
+        "import sys\n"
+        f"for name in {list(modules)!r}:\n"
+        "    __import__(name)\n"
+        f"print(','.join(m for m in {list(DEFERRED_MODULES)!r} if m in sys.modules))\n"
+    )
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=APP_DIR,
+                            capture_output=True, text=True, check=True)
+    wall = (time.perf_counter() - started) * 1000
+    top_level = []
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        # インデントのない行が、子モジュールを含めた最上位の読み込み
+        if match and len(match.group(3)) == 1 and match.group(4) not in startup:
+            cumulative = int(match.group(2))
+            total_us += cumulative
+            top_level.append((cumulative / 1000, match.group(4)))
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    top_level.sort(reverse=True)
+    return total_us / 1000, wall, top_level, loaded
+
+
+def measure_render(messages, reruns, timeout):
+    """モックサーバーにつないでアプリを実行し、(初回の秒数, 再実行の秒数のリスト) を返す"""
+    from streamlit.testing.v1 import AppTest
+
+    sys.path.insert(0, SCRIPT_DIR)
+    import mock_server
+
+    server = mock_server.run_in_thread(models=["mock-small:instant"])
+    os.environ["GPUSTACK_API_BASE"] = server.base_url
+    os.environ["CONVERSATION_STORE_ENABLED"] = "false"
+    os.environ.pop("METRICS_PORT", None)
+    sys.path.insert(0, APP_DIR)
+    os.chdir(APP_DIR)
+
+    at = AppTest.from_file("app.py", default_timeout=timeout)
+    at.session_state["messages"] = [
+        {"role": "user" if i % 2 == 0 else "assistant",
+         "content": f"メッセージ {i}: " + "ベンチマーク用の本文です。" * 20}
+        for i in range(messages)
+    ]
+    started = time.perf_counter()
+    at.run()
+    first = time.perf_counter() - started
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    rerun_times = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        at.run()
+        rerun_times.append(time.perf_counter() - started)
+    return first, rerun_times
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="チャットアプリの起動時間・再実行時間を計測する")
+    parser.add_argument("--messages", type=int, default=50, help="再実行の計測で履歴に入れておくメッセージ数")
+    parser.add_argument("--reruns", type=int, default=5, help="再実行の回数")
+    parser.add_argument("--top", type=int, default=10, help="表示する読み込み時間の上位件数")
+    parser.add_argument("--timeout", type=float, default=30.0, help="1回の実行のタイムアウト秒数")
+    parser.add_argument("--import-budget", type=float, default=None,
+                        help="モジュールの読み込み時間の上限（ms）。超えたら終了コード1")
+    parser.add_argument("--skip-render", action="store_true", help="Streamlitでの描画の計測を省略する")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    total, wall, top_level, loaded = measure_imports()
+    print(f"モジュールの読み込み: {total:.1f} ms（プロセス全体 {wall:.1f} ms）")
+    for elapsed, name in top_level[:args.top]:
+        print(f"  {elapsed:8.1f} ms  {name}")
+    if loaded:
+        print(f"⚠️ 起動時に読み込まれているライブラリ: {', '.join(loaded)}")
+    else:
+        print(f"✅ 起動時に読み込まれないライブラリ: {', '.join(DEFERRED_MODULES)}")
+
+    if not args.skip_render:
+        try:
+            first, rerun_times = measure_render(args.messages, args.reruns, args.timeout)
+        except ImportError as e:
+            print(f"描画の計測を省略しました（{e.name} がインストールされていません）")
+        else:
+            print(f"初回の描画: {first * 1000:.1f} ms")
+            if rerun_times:
+                print(f"再実行（履歴 {args.messages} 件）: 中央値 {statistics.median(rerun_times) * 1000:.1f} ms"
+                      f" / 最大 {max(rerun_times) * 1000:.1f} ms")
+
+    if args.import_budget is not None and total > args.import_budget:
+        print(f"❌ 読み込み時間が予算 {args.import_budget:.0f} ms を超えました")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,62 +1,36 @@
 import sys
 import os
-import requests
-import time
 
-API_BASE = "http://localhost:80/v1"
+# model_setup.py のマニフェストデプロイ（並行デプロイ・RUNNING待ち・ウォームアップ）を使う
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import model_setup
 
-def check_gpustack_running():
-    """Check if GPUStack is running"""
-    try:
-        response = requests.get(f"{API_BASE}/models")
-        if response.status_code == 200:
-            return True
-    except requests.exceptions.ConnectionError:
-        pass
-    return False
-
-def deploy_model(model_id):
-    """Deploy a model"""
-    headers = {"Content-Type": "application/json"}
-    
-    device = "mps" if sys.platform == "darwin" and "arm" in os.uname().machine else "cuda"
-    if device not in ["mps", "cuda"]:
-        device = "cpu"
-    
-    payload = {
-        "model_id": model_id,
-        "device": device,
-        "type": "llm"
-    }
-    
-    try:
-        print(f"Deploying model '{model_id}'...")
-        response = requests.post(f"{API_BASE}/models/deploy", headers=headers, json=payload)
-        if response.status_code == 200:
-            print(f"Model '{model_id}' deployed successfully")
-            return True
-        else:
-            print(f"Failed to deploy model: {response.status_code}")
-            print(response.text)
-            return False
-    except Exception as e:
-        print(f"Error deploying model: {e}")
-        return False
+model_setup.API_BASE = os.environ.get("GPUSTACK_API_BASE", "http://localhost:80/v1")
 
 def main():
-    for _ in range(30):
-        if check_gpustack_running():
-            break
-        print("Waiting for GPUStack to start...")
-        time.sleep(1)
-    
-    model_id = os.environ.get("MODEL_ID", "TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF")
-    
-    success = deploy_model(model_id)
-    if success:
-        print("Model deployment completed successfully")
+    if not model_setup.wait_for_server(timeout=float(os.environ.get("GPUSTACK_START_TIMEOUT", "60"))):
+        print("GPUStack did not start in time")
+        return 1
+
+    if os.environ.get("MODEL_MANIFEST"):
+        entries = model_setup.load_manifest(os.environ["MODEL_MANIFEST"])
     else:
-        print("Model deployment failed")
+        # MODEL_ID accepts a comma-separated list of models
+        model_ids = os.environ.get("MODEL_ID", "TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF")
+        entries = [model_setup.normalize_entry(model_id.strip()) for model_id in model_ids.split(",") if model_id.strip()]
+
+    results = model_setup.deploy_manifest(
+        entries,
+        model_setup.get_or_create_api_key(interactive=False),
+        timeout=float(os.environ.get("MODEL_READY_TIMEOUT", model_setup.DEFAULT_READY_TIMEOUT)),
+        warmup=os.environ.get("MODEL_WARMUP", "true").lower() in ("1", "true", "yes")
+    )
+    model_setup.print_report(results)
+    if all(result["error"] is None for result in results):
+        print("Model deployment completed successfully")
+        return 0
+    print("Model deployment failed")
+    return 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
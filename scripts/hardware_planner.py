@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ハードウェアに合わせたモデルと量子化の選択
+ホストのRAM・CPUコア数・SIMD拡張命令・GPU（CUDA/MPS）を調べ、
+候補のGGUFモデルごとに量子化レベル別のメモリ使用量と生成速度（tokens/秒）を見積もり、
+収まる中で最も大きいモデルと量子化を選びます。
+
+見積もりは目安です:
+- メモリ = 重み（パラメータ数 × 量子化のビット数）+ KVキャッシュ（コンテキスト長）+ 実行時のバッファ
+- 生成速度 = 実効メモリ帯域 ÷ 重みのサイズ（デコードは帯域律速）と、CPUの演算性能による上限の小さい方
+
+使用例:
+  python hardware_planner.py                    # このマシンでの推奨
+  python hardware_planner.py --cpu-only --ram-gb 8 --json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+
+GIB = 1024 ** 3
+
+# GGUFの量子化ごとの平均ビット数（llama.cppの実測値に近い値）。品質の低い順
+QUANTIZATIONS = (
+    ("Q2_K", 2.63),
+    ("Q3_K_M", 3.91),
+    ("Q4_0", 4.55),
+    ("Q4_K_M", 4.85),
+    ("Q5_K_M", 5.69),
+    ("Q6_K", 6.59),
+    ("Q8_0", 8.50),
+    ("F16", 16.0),
+)
+# これより低い量子化は品質の劣化が大きいため、他に収まるものがない場合だけ選ぶ
+MIN_RECOMMENDED_BITS = 4.5
+# Q8_0を超えても品質はほぼ変わらずメモリと速度だけが悪化するため、推奨はQ8_0まで
+MAX_RECOMMENDED_BITS = 8.5
+
+# 候補モデル: パラメータ数（十億）、層数、KVヘッド数×ヘッド次元（KVキャッシュの見積もり用）
+CANDIDATE_MODELS = (
+    {"model_id": "TheBloke/Qwen2.5-0.5B-Instruct-GGUF", "params_b": 0.49, "layers": 24, "kv_dim": 128},
+    {"model_id": "TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF", "params_b": 1.10, "layers": 22, "kv_dim": 256},
+    {"model_id": "Qwen/Qwen2.5-1.5B-Instruct-GGUF", "params_b": 1.54, "layers": 28, "kv_dim": 256},
+    {"model_id": "Qwen/Qwen2.5-3B-Instruct-GGUF", "params_b": 3.09, "layers": 36, "kv_dim": 256},
+    {"model_id": "TheBloke/Mistral-7B-Instruct-v0.2-GGUF", "params_b": 7.24, "layers": 32, "kv_dim": 1024},
+    {"model_id": "neural-chat/neural-chat-7b-v3-1-GGUF", "params_b": 7.24, "layers": 32, "kv_dim": 1024},
+    {"model_id": "TheBloke/Llama-3.1-8B-Instruct-GGUF", "params_b": 8.03, "layers": 32, "kv_dim": 1024},
+)
+
+# メモリ帯域のうち推論で実際に使える割合と、既定の帯域（GB/秒）
+BANDWIDTH_EFFICIENCY = {"cpu": 0.6, "mps": 0.7, "cuda": 0.75}
+DEFAULT_GPU_BANDWIDTH = {"mps": 100.0, "cuda": 300.0}
+# SIMD拡張命令ごとの1コアあたりの実効演算性能（GFLOP/秒、量子化行列積の目安）
+SIMD_GFLOPS_PER_CORE = (("avx512f", 64.0), ("avx2", 32.0), ("neon", 24.0), ("avx", 12.0), ("sse4_2", 6.0))
+SCALAR_GFLOPS_PER_CORE = 3.0
+# 実行時に必要な計算用バッファ（GiB）と重みに対する余裕の割合
+RUNTIME_OVERHEAD_GIB = 0.35
+RUNTIME_OVERHEAD_RATIO = 0.05
+
+
+@dataclass
+class HostInfo:
+    """推論に関係するホストの性能"""
+
+    system: str
+    machine: str
+    total_ram: int
+    available_ram: int
+    physical_cores: int
+    logical_cores: int
+    simd: list = field(default_factory=list)
+    device: str = "cpu"
+    gpu_name: str = None
+    gpu_memory: int = None
+    memory_bandwidth: float = None
+
+    @property
+    def gflops(self):
+        """CPUの実効演算性能（GFLOP/秒）"""
+        per_core = next((value for flag, value in SIMD_GFLOPS_PER_CORE if flag in self.simd), SCALAR_GFLOPS_PER_CORE)
+        return per_core * self.physical_cores
+
+
+@dataclass
+class Estimate:
+    """モデル×量子化の見積もり"""
+
+    model_id: str
+    quantization: str
+    params_b: float
+    bits: float
+    memory_gib: float
+    tokens_per_sec: float
+    fits: bool
+
+
+def _run(command):
+    try:
+        return subprocess.run(command, capture_output=True, text=True, timeout=5, check=True).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def _sysctl(name):
+    value = _run(["sysctl", "-n", name]).strip()
+    return int(value) if value.isdigit() else None
+
+
+def _detect_memory():
+    """(総メモリ, 利用可能なメモリ) をバイトで返す"""
+    if os.path.exists("/proc/meminfo"):
+        info = {}
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                info[key] = int(value.split()[0]) * 1024
+        total = info.get("MemTotal", 0)
+        return total, info.get("MemAvailable", total)
+    if sys.platform == "darwin":
+        total = _sysctl("hw.memsize") or 0
+        # macOSはファイルキャッシュを解放できるため、総メモリの7割を利用可能とみなす
+        return total, int(total * 0.7)
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        total = 0
+    return total, total
+
+
+def _detect_cores():
+    """(物理コア数, 論理コア数)"""
+    logical = os.cpu_count() or 1
+    if sys.platform == "darwin":
+        # 高効率コアは推論にほとんど寄与しないため、高性能コアの数を優先する
+        physical = _sysctl("hw.perflevel0.physicalcpu") or _sysctl("hw.physicalcpu") or logical
+        return physical, logical
+    if os.path.exists("/proc/cpuinfo"):
+        # (ソケット, コア) の組の数が物理コア数（SMTの論理コアは重複する）
+        pairs = set()
+        physical_id = None
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("physical id"):
+                    physical_id = line.split(":")[1].strip()
+                elif line.startswith("core id"):
+                    pairs.add((physical_id, line.split(":")[1].strip()))
+        if pairs:
+            return min(len(pairs), logical), logical
+    return logical, logical
+
+
+def _detect_simd(machine):
+    """推論に効くSIMD拡張命令のリスト"""
+    if machine in ("arm64", "aarch64"):
+        return ["neon"]
+    flags = set()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = set(line.split(":")[1].split())
+                    break
+    elif sys.platform == "darwin":
+        flags = set(_run(["sysctl", "-n", "machdep.cpu.features", "machdep.cpu.leaf7_features"]).lower().split())
+        flags = {flag.replace(".", "_") for flag in flags}
+    return [name for name in ("avx512f", "avx2", "fma", "f16c", "avx", "sse4_2") if name in flags]
+
+
+def _detect_gpu(system, machine, total_ram):
+    """(デバイス, GPU名, GPUメモリ) を返す。GPUがなければ ("cpu", None, None)"""
+    if shutil.which("nvidia-smi"):
+        output = _run(["nvidia-smi", "--query-gpu=name,memory.total", "--format=csv,noheader,nounits"])
+        gpus = [line.rsplit(",", 1) for line in output.strip().splitlines() if "," in line]
+        if gpus:
+            name, memory = max(gpus, key=lambda gpu: int(gpu[1]))
+            return "cuda", name.strip(), int(memory) * 1024 ** 2
+    if system == "Darwin" and machine == "arm64":
+        # Apple Siliconはユニファイドメモリ。GPUに割り当てられるのは既定で約7割
+        brand = _run(["sysctl", "-n", "machdep.cpu.brand_string"]).strip() or "Apple Silicon"
+        return "mps", brand, int(total_ram * 0.7)
+    return "cpu", None, None
+
+
+def measure_memory_bandwidth(size_mb=256, repeats=3):
+    """大きなバッファのコピーでメモリ帯域（GB/秒）を簡易計測する（読み書きの合計）"""
+    try:
+        source = bytearray(size_mb * 1024 * 1024)
+        target = bytearray(len(source))
+    except MemoryError:
+        return None
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        target[:] = source
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return 2 * len(source) / best / 1e9 if best else None
+
+
+def detect_host(measure_bandwidth=True):
+    """このマシンの性能を調べる"""
+    system = platform.system()
+    machine = platform.machine().lower()
+    total, available = _detect_memory()
+    physical, logical = _detect_cores()
+    device, gpu_name, gpu_memory = _detect_gpu(system, machine, total)
+    bandwidth = None
+    if device in DEFAULT_GPU_BANDWIDTH:
+        bandwidth = DEFAULT_GPU_BANDWIDTH[device]
+    elif measure_bandwidth:
+        bandwidth = measure_memory_bandwidth()
+    return HostInfo(
+        system=system,
+        machine=machine,
+        total_ram=total,
+        available_ram=available,
+        physical_cores=physical,
+        logical_cores=logical,
+        simd=_detect_simd(machine),
+        device=device,
+        gpu_name=gpu_name,
+        gpu_memory=gpu_memory,
+        memory_bandwidth=bandwidth,
+    )
+
+
+def detect_device():
+    """デプロイ時に指定するデバイス（cuda / mps / cpu）"""
+    system = platform.system()
+    machine = platform.machine().lower()
+    return _detect_gpu(system, machine, 0)[0]
+
+
+def estimate_memory(model, bits, context=4096):
+    """モデルを量子化してロードしたときのメモリ使用量（バイト）"""
+    weights = model["params_b"] * 1e9 * bits / 8
+    # KVキャッシュ: K と V × 層数 × コンテキスト長 × KV次元 × f16（2バイト）
+    kv_cache = 2 * model["layers"] * context * model["kv_dim"] * 2
+    return weights * (1 + RUNTIME_OVERHEAD_RATIO) + kv_cache + RUNTIME_OVERHEAD_GIB * GIB
+
+
+def estimate_tokens_per_sec(host, model, bits):
+    """デコード時の生成速度（tokens/秒）の目安"""
+    weight_bytes = model["params_b"] * 1e9 * bits / 8
+    bandwidth = host.memory_bandwidth or 20.0
+    memory_bound = bandwidth * 1e9 * BANDWIDTH_EFFICIENCY.get(host.device, 0.6) / weight_bytes
+    if host.device != "cpu":
+        return memory_bound
+    # CPUでは1トークンあたり約 2×パラメータ数 の演算が必要
+    compute_bound = host.gflops * 1e9 / (2 * model["params_b"] * 1e9)
+    return min(memory_bound, compute_bound)
+
+
+def memory_budget(host, headroom=0.8):
+    """モデルに使ってよいメモリ（バイト）"""
+    if host.device == "cuda" and host.gpu_memory:
+        return host.gpu_memory * 0.9
+    if host.device == "mps" and host.gpu_memory:
+        return min(host.gpu_memory, host.available_ram * headroom)
+    return host.available_ram * headroom
+
+
+def estimate_all(host, candidates=CANDIDATE_MODELS, context=4096, headroom=0.8):
+    """候補モデル×量子化ごとの見積もりを返す"""
+    budget = memory_budget(host, headroom)
+    estimates = []
+    for model in candidates:
+        for quantization, bits in QUANTIZATIONS:
+            memory = estimate_memory(model, bits, context)
+            estimates.append(Estimate(
+                model_id=model["model_id"],
+                quantization=quantization,
+                params_b=model["params_b"],
+                bits=bits,
+                memory_gib=memory / GIB,
+                tokens_per_sec=estimate_tokens_per_sec(host, model, bits),
+                fits=memory <= budget,
+            ))
+    return estimates
+
+
+def choose(estimates, min_tokens_per_sec=None):
+    """収まる中で最も大きいモデルと、そのモデルで最も精度の高い量子化を選ぶ（1モデル内の選択にも使う）"""
+    usable = [e for e in estimates if e.fits and e.bits <= MAX_RECOMMENDED_BITS
+              and (min_tokens_per_sec is None or e.tokens_per_sec >= min_tokens_per_sec)]
+    if not usable:
+        return None
+    # 低ビットの量子化は、推奨ビット数以上の候補が1つもない場合にだけ使う
+    preferred = [e for e in usable if e.bits >= MIN_RECOMMENDED_BITS] or usable
+    return max(preferred, key=lambda e: (e.params_b, e.bits))
+
+
+def recommend(host=None, candidates=CANDIDATE_MODELS, context=4096, headroom=0.8, min_tokens_per_sec=None):
+    """モデルごとに収まる最良の量子化を推奨順に返す
+
+    推奨ビット数以上の量子化で収まるモデルを優先し、その中で大きいモデルから並べます。
+    """
+    host = host or detect_host()
+    estimates = estimate_all(host, candidates, context, headroom)
+    ranked = []
+    for model in candidates:
+        best = choose([e for e in estimates if e.model_id == model["model_id"]], min_tokens_per_sec)
+        if best is not None:
+            ranked.append(best)
+    return sorted(ranked, key=lambda e: (e.bits >= MIN_RECOMMENDED_BITS, e.params_b, e.bits), reverse=True)
+
+
+def apply_overrides(host, ram_gb=None, cores=None, cpu_only=False, bandwidth=None):
+    """計測値をコマンドラインの指定で上書きする（テストや別マシンの見積もり用）"""
+    if ram_gb is not None:
+        host.total_ram = host.available_ram = int(ram_gb * GIB)
+    if cores is not None:
+        host.physical_cores = host.logical_cores = cores
+    if cpu_only:
+        host.device = "cpu"
+        host.gpu_name = host.gpu_memory = None
+        if bandwidth is None and (host.memory_bandwidth is None or host.memory_bandwidth in DEFAULT_GPU_BANDWIDTH.values()):
+            host.memory_bandwidth = measure_memory_bandwidth()
+    if bandwidth is not None:
+        host.memory_bandwidth = bandwidth
+    return host
+
+
+def format_host(host):
+    lines = [
+        f"OS: {host.system} ({host.machine})",
+        f"メモリ: {host.total_ram / GIB:.1f} GiB（利用可能 {host.available_ram / GIB:.1f} GiB）",
+        f"CPU: 物理 {host.physical_cores} コア / 論理 {host.logical_cores} コア、SIMD: {', '.join(host.simd) or 'なし'}",
+        f"デバイス: {host.device}" + (f"（{host.gpu_name}, {host.gpu_memory / GIB:.1f} GiB）" if host.gpu_name else ""),
+    ]
+    if host.memory_bandwidth:
+        lines.append(f"メモリ帯域: {host.memory_bandwidth:.1f} GB/秒")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ハードウェアに合わせてモデルと量子化を選ぶ")
+    parser.add_argument("--context", type=int, default=4096, help="想定するコンテキスト長")
+    parser.add_argument("--headroom", type=float, default=0.8, help="利用可能なメモリのうちモデルに使う割合")
+    parser.add_argument("--min-tokens-per-sec", type=float, help="これより遅いと見積もられた組み合わせは選ばない")
+    parser.add_argument("--ram-gb", type=float, help="メモリ容量を指定する（検出値を上書き）")
+    parser.add_argument("--cores", type=int, help="CPUコア数を指定する（検出値を上書き）")
+    parser.add_argument("--bandwidth", type=float, help="メモリ帯域（GB/秒）を指定する")
+    parser.add_argument("--cpu-only", action="store_true", help="GPUを使わない前提で見積もる")
+    parser.add_argument("--all", action="store_true", help="全ての量子化の見積もりを表示する")
+    parser.add_argument("--json", action="store_true", help="JSONで出力する")
+    args = parser.parse_args()
+
+    host = apply_overrides(detect_host(measure_bandwidth=args.bandwidth is None),
+                           args.ram_gb, args.cores, args.cpu_only, args.bandwidth)
+    ranked = recommend(host, context=args.context, headroom=args.headroom,
+                       min_tokens_per_sec=args.min_tokens_per_sec)
+    best = ranked[0] if ranked else None
+
+    if args.json:
+        report = {
+            "host": asdict(host),
+            "recommendation": asdict(best) if best else None,
+            "ranked": [asdict(e) for e in ranked],
+        }
+        if args.all:
+            report["estimates"] = [asdict(e) for e in estimate_all(host, context=args.context, headroom=args.headroom)]
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0 if best else 1
+
+    print(format_host(host))
+    print(f"\nモデルに使えるメモリ: {memory_budget(host, args.headroom) / GIB:.1f} GiB（コンテキスト長 {args.context}）\n")
+    rows = estimate_all(host, context=args.context, headroom=args.headroom) if args.all else ranked
+    print(f"{'モデル':<42} {'量子化':<8} {'メモリ(GiB)':>11} {'tokens/秒':>10}  収まる")
+    for e in rows:
+        print(f"{e.model_id[:42]:<44} {e.quantization:<8} {e.memory_gib:>11.1f} {e.tokens_per_sec:>10.1f}  {'✅' if e.fits else '❌'}")
+    if best is None:
+        print("\n❌ このマシンに収まる候補モデルがありません")
+        return 1
+    print(f"\n推奨: {best.model_id}（{best.quantization}、約 {best.memory_gib:.1f} GiB、約 {best.tokens_per_sec:.0f} tokens/秒）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GPUStack 負荷ベンチマーク
+asyncioで同時実行数・リクエストレートを制御しながらチャット補完APIに負荷をかけ、
+TTFT・トークン間レイテンシ（ITL）・エンドツーエンドのp50/p95/p99と
+総スループット（tokens/秒）をJSONまたはCSVで出力します。
+
+test_api.py の bench サブコマンドから利用します:
+  python scripts/test_api.py bench --mock --concurrency 8 --num-requests 100
+"""
+
+import asyncio
+import csv
+import io
+import json
+import math
+import random
+import sys
+import time
+
+import httpx
+
+PROMPT_WORDS = ["the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "and", "runs", "away"]
+
+
+def parse_distribution(spec):
+    """長さの分布指定をパースする
+
+    fixed:N / uniform:MIN:MAX / normal:MEAN:STD / lognormal:MEAN:SIGMA / N（fixedと同じ）
+    """
+    parts = str(spec).split(":")
+    if len(parts) == 1:
+        parts = ["fixed", parts[0]]
+    kind, values = parts[0], [float(v) for v in parts[1:]]
+    expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+    if kind not in expected or len(values) != expected[kind]:
+        raise ValueError(f"不正な分布指定です: {spec}")
+    return kind, values
+
+
+def sample_length(distribution, rng):
+    """分布から1以上の長さを1つサンプリングする"""
+    kind, values = distribution
+    if kind == "fixed":
+        value = values[0]
+    elif kind == "uniform":
+        value = rng.uniform(values[0], values[1])
+    elif kind == "normal":
+        value = rng.gauss(values[0], values[1])
+    else:
+        # 平均値が指定された値になるようにμを求める
+        mu = math.log(values[0]) - values[1] ** 2 / 2
+        value = rng.lognormvariate(mu, values[1])
+    return max(1, int(round(value)))
+
+
+def make_prompt(num_tokens, rng):
+    """おおよそ指定したトークン数になるプロンプトを作る（英単語1語≒1トークン）"""
+    return " ".join(rng.choice(PROMPT_WORDS) for _ in range(num_tokens))
+
+
+def percentile(values, pct):
+    """線形補間によるパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(math.floor(rank))
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+class RequestResult:
+    """1リクエストの計測結果"""
+
+    def __init__(self, index, prompt_tokens, max_tokens):
+        self.index = index
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.scheduled_at = None
+        self.started_at = None
+        self.ttft = None
+        self.itls = []
+        self.e2e = None
+        self.output_tokens = 0
+        self.error = None
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "prompt_tokens": self.prompt_tokens,
+            "max_tokens": self.max_tokens,
+            "output_tokens": self.output_tokens,
+            "ttft": self.ttft,
+            "mean_itl": sum(self.itls) / len(self.itls) if self.itls else None,
+            "e2e": self.e2e,
+            "error": self.error,
+        }
+
+
+class LoadBenchmark:
+    """クローズドループ／オープンループ（ポアソン到着）の負荷生成器"""
+
+    def __init__(self, api_base, model, api_key=None, concurrency=1, rate=None, num_requests=100,
+                 stream=True, prompt_tokens="fixed:128", output_tokens="fixed:128", timeout=300.0, seed=None):
+        self.api_base = api_base.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.num_requests = num_requests
+        self.stream = stream
+        self.prompt_distribution = parse_distribution(prompt_tokens)
+        self.output_distribution = parse_distribution(output_tokens)
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.results = []
+        self.wall_time = None
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def _new_request(self, index):
+        result = RequestResult(
+            index,
+            sample_length(self.prompt_distribution, self.rng),
+            sample_length(self.output_distribution, self.rng),
+        )
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": make_prompt(result.prompt_tokens, self.rng)}],
+            "max_tokens": result.max_tokens,
+            "temperature": 0.0,
+            # 出力長を分布どおりにするためEOSを無視させる（llama.cpp / vLLM が対応）
+            "ignore_eos": True,
+        }
+        if self.stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return result, payload
+
+    async def _send(self, client, result, payload):
+        # オープンループでは予定到着時刻から計測し、待ち行列の遅延も含める
+        start = result.scheduled_at or time.perf_counter()
+        result.started_at = time.perf_counter()
+        url = f"{self.api_base}/chat/completions"
+        try:
+            if self.stream:
+                await self._send_stream(client, url, payload, result, start)
+            else:
+                response = await client.post(url, json=payload, headers=self._headers())
+                response.raise_for_status()
+                body = response.json()
+                usage = body.get("usage") or {}
+                result.output_tokens = usage.get("completion_tokens") or 0
+            result.e2e = time.perf_counter() - start
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            result.error = f"{type(e).__name__}: {e}"
+        self.results.append(result)
+
+    async def _send_stream(self, client, url, payload, result, start):
+        last_token = None
+        token_events = 0
+        async with client.stream("POST", url, json=payload, headers=self._headers()) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage"):
+                    result.output_tokens = chunk["usage"].get("completion_tokens") or result.output_tokens
+                choices = chunk.get("choices") or []
+                if not choices or not (choices[0].get("delta") or {}).get("content"):
+                    continue
+                now = time.perf_counter()
+                if last_token is None:
+                    result.ttft = now - start
+                else:
+                    result.itls.append(now - last_token)
+                last_token = now
+                token_events += 1
+        if not result.output_tokens:
+            result.output_tokens = token_events
+
+    async def _closed_loop(self, client):
+        counter = iter(range(self.num_requests))
+
+        async def worker():
+            for index in counter:
+                result, payload = self._new_request(index)
+                await self._send(client, result, payload)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    async def _open_loop(self, client):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = []
+
+        async def fire(result, payload):
+            async with semaphore:
+                await self._send(client, result, payload)
+
+        next_arrival = time.perf_counter()
+        for index in range(self.num_requests):
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            result, payload = self._new_request(index)
+            result.scheduled_at = next_arrival
+            tasks.append(asyncio.create_task(fire(result, payload)))
+            next_arrival += self.rng.expovariate(self.rate)
+        await asyncio.gather(*tasks)
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        timeout = httpx.Timeout(self.timeout, connect=10.0)
+        async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+            started = time.perf_counter()
+            if self.rate:
+                await self._open_loop(client)
+            else:
+                await self._closed_loop(client)
+            self.wall_time = time.perf_counter() - started
+        self.results.sort(key=lambda r: r.index)
+        return self.report()
+
+    def report(self):
+        succeeded = [r for r in self.results if r.error is None]
+        output_tokens = sum(r.output_tokens for r in succeeded)
+        wall_time = self.wall_time or 0.0
+        return {
+            "config": {
+                "api_base": self.api_base,
+                "model": self.model,
+                "mode": "open-loop" if self.rate else "closed-loop",
+                "concurrency": self.concurrency,
+                "rate": self.rate,
+                "num_requests": self.num_requests,
+                "stream": self.stream,
+            },
+            "summary": {
+                "completed": len(succeeded),
+                "errors": len(self.results) - len(succeeded),
+                "wall_time": wall_time,
+                "requests_per_sec": len(succeeded) / wall_time if wall_time else None,
+                "output_tokens": output_tokens,
+                "output_tokens_per_sec": output_tokens / wall_time if wall_time else None,
+                "ttft": summarize([r.ttft for r in succeeded if r.ttft is not None]),
+                "itl": summarize([itl for r in succeeded for itl in r.itls]),
+                "e2e": summarize([r.e2e for r in succeeded if r.e2e is not None]),
+            },
+            "requests": [r.to_dict() for r in self.results],
+        }
+
+
+def format_report(report, fmt="json", include_requests=False):
+    """レポートをJSONまたはCSV文字列に変換する"""
+    if fmt == "json":
+        if not include_requests:
+            report = {key: value for key, value in report.items() if key != "requests"}
+        return json.dumps(report, ensure_ascii=False, indent=2)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if include_requests:
+        rows = report["requests"]
+        writer.writerow(list(rows[0].keys()) if rows else ["index"])
+        for row in rows:
+            writer.writerow(list(row.values()))
+        return buffer.getvalue()
+
+    summary = report["summary"]
+    writer.writerow(["metric", "count", "mean", "p50", "p95", "p99", "max"])
+    for metric in ("ttft", "itl", "e2e"):
+        stats = summary[metric]
+        writer.writerow([metric] + [stats[key] for key in ("count", "mean", "p50", "p95", "p99", "max")])
+    for metric in ("requests_per_sec", "output_tokens_per_sec", "wall_time", "completed", "errors"):
+        writer.writerow([metric, "", summary[metric], "", "", "", ""])
+    return buffer.getvalue()
+
+
+def add_bench_arguments(parser):
+    """bench サブコマンドの引数を登録する"""
+    parser.add_argument("--api-base", help="APIのベースURL（省略時は test_api.py の API_BASE）")
+    parser.add_argument("--model", help="対象のモデルID（省略時は最初のRUNNINGモデル）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時実行数（オープンループでは最大同時実行数）")
+    parser.add_argument("--rate", type=float, help="リクエストレート（req/秒）。指定するとポアソン到着のオープンループ")
+    parser.add_argument("--num-requests", type=int, default=100, help="送信するリクエスト数")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="ストリーミングを使わない")
+    parser.add_argument("--prompt-tokens", default="fixed:128",
+                        help="プロンプト長の分布 (fixed:N, uniform:MIN:MAX, normal:MEAN:STD, lognormal:MEAN:SIGMA)")
+    parser.add_argument("--output-tokens", default="fixed:128", help="出力長の分布（書式は --prompt-tokens と同じ）")
+    parser.add_argument("--timeout", type=float, default=300.0, help="1リクエストのタイムアウト（秒）")
+    parser.add_argument("--seed", type=int, help="乱数シード")
+    parser.add_argument("--format", choices=["json", "csv"], default="json", help="出力形式")
+    parser.add_argument("--per-request", action="store_true", help="リクエストごとの結果も出力する")
+    parser.add_argument("--output", help="結果の出力先ファイル（省略時は標準出力）")
+    parser.add_argument("--mock", action="store_true", help="内蔵のモックサーバーを起動してその上で計測する")
+    parser.add_argument("--mock-profile", default="fast",
+                        help="--mock 時のモックサーバーの遅延プロファイル（mock_server.py の PROFILES）")
+    return parser
+
+
+def run_bench(args, api_base, model, api_key=None):
+    """引数からベンチマークを実行し、結果を書き出す"""
+    bench = LoadBenchmark(
+        api_base,
+        model,
+        api_key=api_key,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        num_requests=args.num_requests,
+        stream=args.stream,
+        prompt_tokens=args.prompt_tokens,
+        output_tokens=args.output_tokens,
+        timeout=args.timeout,
+        seed=args.seed,
+    )
+    report = asyncio.run(bench.run())
+    text = format_report(report, args.format, args.per_request)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"ベンチマーク結果を {args.output} に書き出しました", file=sys.stderr)
+    else:
+        print(text)
+    return report
@@ -0,0 +1,762 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GPUStack互換のモックサーバー
+GPUを使わずにベンチマークやクライアント側の動作確認を行うための、
+OpenAI互換APIの軽量なスタンドインです（標準ライブラリのasyncioのみで動作します）。
+
+提供するエンドポイント:
+  GET  /v1/models                 モデル一覧（statusを含む）
+  POST /v1/chat/completions       チャット補完（ストリーミング／非ストリーミング）
+  POST /v1/embeddings             文字bigramのハッシュによる決定的な埋め込み
+  GET  /v1/metrics                リクエスト数・トークン数などのJSON
+  POST /v1/models/deploy          モデルのデプロイ（DOWNLOADING → STARTING → RUNNING）
+  GET/POST /mock/config           遅延プロファイルと障害注入の参照・変更
+
+--serve-files を指定すると、そのディレクトリのファイルをHugging Face Hub互換のパスで配信します
+（モデルファイルの事前ダウンロード scripts/prefetch_models.py の確認用）:
+  GET  /api/models/{repo}/tree/{revision}      ファイル一覧（LFSのSHA-256とサイズを含む）
+  GET/HEAD /{repo}/resolve/{revision}/{path}   ファイル本体（Rangeリクエスト対応）
+
+使用例:
+  python scripts/mock_server.py --port 8000 --models mock-small:fast,mock-large:mps-7b
+  python scripts/mock_server.py --profile cpu-1b --error-rate 0.05 --disconnect-rate 0.02
+  python scripts/mock_server.py --serve-files ./hub   # ./hub/TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF/*.gguf
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import asdict, dataclass, fields, replace
+
+VOCABULARY = ["これは", "モック", "サーバー", "の", "応答", "です", "。", "GPU", "Stack", "テスト", "トークン", "、"]
+STATUS_TEXT = {200: "OK", 206: "Partial Content", 400: "Bad Request", 404: "Not Found",
+               405: "Method Not Allowed", 416: "Range Not Satisfiable", 429: "Too Many Requests",
+               500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable"}
+# Hugging Face Hub互換のファイル配信のパス
+TREE_PATH = re.compile(r"^/api/models/(?P<repo>[^/]+/[^/]+)/tree/(?P<revision>[^/]+)$")
+RESOLVE_PATH = re.compile(r"^/(?P<repo>[^/]+/[^/]+)/resolve/(?P<revision>[^/]+)/(?P<path>.+)$")
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class LatencyProfile:
+    """モデルの速度特性"""
+
+    # プロンプト長によらない最初のトークンまでの時間（秒）
+    ttft: float
+    # プレフィルの速度（プロンプトトークン/秒、0なら無視）
+    prefill_tokens_per_sec: float
+    # 1リクエストあたりのデコード速度（トークン/秒、0なら待たない）
+    tokens_per_sec: float
+    # 待ち時間の相対的なゆらぎ
+    jitter: float = 0.1
+    # 速度を落とさずに同時処理できるリクエスト数（超えると速度が按分される）
+    parallel: int = 4
+
+
+PROFILES = {
+    "instant": LatencyProfile(0.0, 0.0, 0.0, 0.0, 1024),
+    "fast": LatencyProfile(0.05, 5000.0, 100.0, 0.1, 8),
+    "cpu-1b": LatencyProfile(0.3, 300.0, 20.0, 0.2, 2),
+    "mps-7b": LatencyProfile(0.5, 800.0, 25.0, 0.15, 4),
+    "gpu-7b": LatencyProfile(0.1, 4000.0, 60.0, 0.1, 16),
+}
+DEFAULT_MODELS = ["mock-small:fast", "mock-large:mps-7b"]
+DEFAULT_EMBEDDING_MODELS = ["mock-embedding"]
+
+
+@dataclass
+class FaultConfig:
+    """障害注入の設定（各rateは0〜1の確率）"""
+
+    # 5xxエラーを返す割合とそのステータス
+    error_rate: float = 0.0
+    error_status: int = 503
+    # 応答せずに hang_seconds 待たせる割合（クライアントのタイムアウト確認用）
+    hang_rate: float = 0.0
+    hang_seconds: float = 30.0
+    # ストリーミングの途中で接続を切る割合
+    disconnect_rate: float = 0.0
+    # TTFTが slow_factor 倍になる割合（テールレイテンシの再現用）
+    slow_rate: float = 0.0
+    slow_factor: float = 10.0
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Disconnect(Exception):
+    """ストリーミング途中で接続を切断する"""
+
+
+@dataclass
+class FileResponse:
+    """ファイルの byte start〜end（両端を含む）を返す応答"""
+
+    path: str
+    start: int
+    end: int
+    size: int
+    headers: list
+    status: int = 200
+    head_only: bool = False
+
+
+class Request:
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path.split("?", 1)[0]
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        try:
+            return json.loads(self.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "invalid JSON body")
+
+
+def parse_model_specs(specs, default_profile="fast"):
+    """"id" または "id:profile" のリストを {id: profile名} に変換する"""
+    models = {}
+    for spec in specs:
+        model_id, _, profile = spec.strip().partition(":")
+        if not model_id:
+            continue
+        profile = profile or default_profile
+        if profile not in PROFILES:
+            raise ValueError(f"不明なプロファイルです: {profile}（{', '.join(PROFILES)}）")
+        models[model_id] = profile
+    return models
+
+
+class MockGPUStackServer:
+    """OpenAI互換のエンドポイントを返すモックサーバー"""
+
+    def __init__(self, host="127.0.0.1", port=8000, models=None, embedding_models=None, profile="fast",
+                 ttft=None, tokens_per_sec=None, default_output_tokens=64, faults=None,
+                 deploy_delay=5.0, embedding_dim=256, seed=None, files_dir=None):
+        self.host = host
+        self.port = port
+        self.default_profile = profile
+        self.default_output_tokens = default_output_tokens
+        self.faults = faults or FaultConfig()
+        self.deploy_delay = deploy_delay
+        self.embedding_dim = embedding_dim
+        self.files_dir = os.path.realpath(files_dir) if files_dir else None
+        self._file_hashes = {}
+        self.random = random.Random(seed)
+        self.started_at = time.time()
+        self.request_count = 0
+        self.models = {}
+        for model_id, profile_name in parse_model_specs(models or DEFAULT_MODELS, profile).items():
+            profile_obj = PROFILES[profile_name]
+            # --ttft / --tokens-per-sec はプロファイルの値を上書きする
+            if ttft is not None:
+                profile_obj = replace(profile_obj, ttft=ttft)
+            if tokens_per_sec is not None:
+                profile_obj = replace(profile_obj, tokens_per_sec=tokens_per_sec)
+            self.models[model_id] = self._new_model_state(profile_obj, "llm")
+        for model_id in embedding_models if embedding_models is not None else DEFAULT_EMBEDDING_MODELS:
+            self.models[model_id] = self._new_model_state(PROFILES["fast"], "embedding")
+        self._server = None
+        self.routes = {
+            ("GET", "/v1/models"): self.handle_models,
+            ("POST", "/v1/chat/completions"): self.handle_chat_completions,
+            ("POST", "/v1/embeddings"): self.handle_embeddings,
+            ("GET", "/v1/metrics"): self.handle_metrics,
+            ("POST", "/v1/models/deploy"): self.handle_deploy,
+            ("POST", "/models/deploy"): self.handle_deploy,
+            ("GET", "/mock/config"): self.handle_get_config,
+            ("POST", "/mock/config"): self.handle_set_config,
+        }
+
+    @staticmethod
+    def _new_model_state(profile, model_type, status="RUNNING"):
+        return {
+            "status": status,
+            "type": model_type,
+            "profile": profile,
+            "active": 0,
+            "requests": 0,
+            "errors": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    @property
+    def model_ids(self):
+        """チャットに使えるモデルIDのリスト"""
+        return [model_id for model_id, state in self.models.items() if state["type"] == "llm"]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # port=0 の場合は実際に割り当てられたポートを使う
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # --- HTTP処理 ---
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        body = await reader.readexactly(length) if length else b""
+        return Request(method, path, headers, body)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    break
+                if request is None:
+                    break
+                self.request_count += 1
+                keep_alive = await self._dispatch(request, writer)
+                if not keep_alive or request.headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request, writer):
+        """リクエストを処理する。接続を維持できる場合はTrueを返す"""
+        handler = self.routes.get((request.method, request.path)) or self._file_handler(request)
+        try:
+            if handler is None:
+                if any(path == request.path for _, path in self.routes):
+                    raise HTTPError(405, f"method {request.method} not allowed")
+                raise HTTPError(404, f"{request.path} not found")
+            result = await handler(request)
+        except HTTPError as e:
+            await self.send_json(writer, e.status, {"error": {"message": e.message, "code": e.status}})
+            return True
+        if isinstance(result, tuple):
+            status, payload = result
+        else:
+            status, payload = 200, result
+        if hasattr(payload, "__aiter__"):
+            return await self.send_event_stream(writer, payload)
+        if isinstance(payload, FileResponse):
+            return await self.send_file(writer, payload)
+        if isinstance(payload, (bytes, str)):
+            await self.send_body(writer, status, payload, "text/plain; charset=utf-8")
+        else:
+            await self.send_json(writer, status, payload)
+        return True
+
+    async def send_body(self, writer, status, body, content_type, extra_headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        headers = [
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'OK')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            "Connection: keep-alive",
+        ] + list(extra_headers or [])
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def send_json(self, writer, status, payload):
+        await self.send_body(writer, status, json.dumps(payload, ensure_ascii=False), "application/json")
+
+    async def send_event_stream(self, writer, events):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n"
+        )
+        await writer.drain()
+        try:
+            async for event in events:
+                data = event if isinstance(event, str) else json.dumps(event, ensure_ascii=False)
+                chunk = f"data: {data}\n\n".encode("utf-8")
+                writer.write(f"{len(chunk):X}\r\n".encode("latin-1") + chunk + b"\r\n")
+                await writer.drain()
+        except Disconnect:
+            writer.transport.abort()
+            return False
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return True
+
+    async def send_file(self, writer, response):
+        length = response.end - response.start + 1 if response.size else 0
+        headers = [
+            f"HTTP/1.1 {response.status} {STATUS_TEXT[response.status]}",
+            "Content-Type: application/octet-stream",
+            f"Content-Length: {length}",
+            "Accept-Ranges: bytes",
+            "Connection: keep-alive",
+        ] + response.headers
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        if response.head_only:
+            return True
+        # 途中で切断する場合は、送る予定のバイト数の途中で接続を切る
+        cut_at = length // 2 if self.random.random() < self.faults.disconnect_rate else None
+        sent = 0
+        with open(response.path, "rb") as f:
+            f.seek(response.start)
+            while sent < length:
+                limit = min(FILE_CHUNK_SIZE, length - sent)
+                if cut_at is not None:
+                    limit = min(limit, cut_at - sent)
+                    if limit <= 0:
+                        writer.transport.abort()
+                        return False
+                data = f.read(limit)
+                writer.write(data)
+                await writer.drain()
+                sent += len(data)
+        return True
+
+    # --- 生成のシミュレーション ---
+
+    def _count_prompt_tokens(self, messages):
+        return sum(max(1, len(str(m.get("content", ""))) // 2) + 4 for m in messages) + 2
+
+    def _output_tokens(self, payload):
+        max_tokens = payload.get("max_tokens") or self.default_output_tokens
+        if payload.get("ignore_eos"):
+            return max_tokens
+        return max(1, min(max_tokens, self.default_output_tokens))
+
+    def _token(self):
+        return self.random.choice(VOCABULARY)
+
+    def _jittered(self, seconds, profile):
+        if seconds <= 0:
+            return 0.0
+        return max(0.0, seconds * (1 + self.random.uniform(-profile.jitter, profile.jitter)))
+
+    async def _sleep_for_prefill(self, state, prompt_tokens):
+        profile = state["profile"]
+        delay = profile.ttft
+        if profile.prefill_tokens_per_sec > 0:
+            delay += prompt_tokens / profile.prefill_tokens_per_sec
+        if self.random.random() < self.faults.slow_rate:
+            delay *= self.faults.slow_factor
+        await asyncio.sleep(self._jittered(delay, profile))
+
+    async def _sleep_per_token(self, state):
+        profile = state["profile"]
+        if profile.tokens_per_sec <= 0:
+            return
+        # 同時処理数を超えた分はデコード速度が按分される
+        slowdown = max(1.0, state["active"] / max(1, profile.parallel))
+        await asyncio.sleep(self._jittered(slowdown / profile.tokens_per_sec, profile))
+
+    def _check_model(self, payload, model_type):
+        model = payload.get("model")
+        state = self.models.get(model)
+        if state is None:
+            raise HTTPError(404, f"model '{model}' not found")
+        if state["status"] != "RUNNING":
+            raise HTTPError(503, f"model '{model}' is {state['status']}")
+        if state["type"] != model_type:
+            raise HTTPError(400, f"model '{model}' does not support this endpoint")
+        return model, state
+
+    async def _inject_faults(self, state):
+        """設定された確率でエラー応答やハングを発生させる"""
+        if self.random.random() < self.faults.hang_rate:
+            await asyncio.sleep(self.faults.hang_seconds)
+        if self.random.random() < self.faults.error_rate:
+            state["errors"] += 1
+            raise HTTPError(self.faults.error_status, "injected fault")
+
+    # --- エンドポイント ---
+
+    async def handle_models(self, request):
+        now = int(time.time())
+        return {
+            "object": "list",
+            "data": [
+                {"id": model_id, "object": "model", "created": now, "owned_by": "mock",
+                 "status": state["status"], "type": state["type"]}
+                for model_id, state in self.models.items()
+            ],
+        }
+
+    async def handle_chat_completions(self, request):
+        payload = request.json()
+        model, state = self._check_model(payload, "llm")
+        await self._inject_faults(state)
+        prompt_tokens = self._count_prompt_tokens(payload.get("messages", []))
+        output_tokens = self._output_tokens(payload)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": output_tokens,
+            "total_tokens": prompt_tokens + output_tokens,
+        }
+        state["requests"] += 1
+        state["prompt_tokens"] += prompt_tokens
+
+        if payload.get("stream"):
+            include_usage = bool((payload.get("stream_options") or {}).get("include_usage"))
+            return self._stream_chat(state, completion_id, created, model, prompt_tokens, output_tokens,
+                                     usage if include_usage else None)
+
+        state["active"] += 1
+        try:
+            await self._sleep_for_prefill(state, prompt_tokens)
+            tokens = []
+            for _ in range(output_tokens):
+                await self._sleep_per_token(state)
+                tokens.append(self._token())
+        finally:
+            state["active"] -= 1
+        state["completion_tokens"] += output_tokens
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "length" if output_tokens == payload.get("max_tokens") else "stop",
+            }],
+            "usage": usage,
+        }
+
+    async def _stream_chat(self, state, completion_id, created, model, prompt_tokens, output_tokens, usage):
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        disconnect_at = None
+        if self.random.random() < self.faults.disconnect_rate:
+            disconnect_at = self.random.randrange(max(1, output_tokens))
+
+        state["active"] += 1
+        try:
+            await self._sleep_for_prefill(state, prompt_tokens)
+            yield chunk({"role": "assistant", "content": ""})
+            for index in range(output_tokens):
+                if index == disconnect_at:
+                    state["errors"] += 1
+                    raise Disconnect()
+                if index:
+                    await self._sleep_per_token(state)
+                state["completion_tokens"] += 1
+                yield chunk({"content": self._token()})
+        finally:
+            state["active"] -= 1
+        yield chunk({}, "stop")
+        if usage:
+            yield {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                   "model": model, "choices": [], "usage": usage}
+        yield "[DONE]"
+
+    def embed(self, text):
+        """文字bigramをハッシュした正規化済みベクトル（似た文字列ほど近くなる）"""
+        vector = [0.0] * self.embedding_dim
+        text = f" {text} "
+        for i in range(len(text) - 1):
+            bucket = zlib.crc32(text[i:i + 2].encode("utf-8"))
+            vector[bucket % self.embedding_dim] += 1.0 if bucket & 0x80000000 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    async def handle_embeddings(self, request):
+        payload = request.json()
+        model, state = self._check_model(payload, "embedding")
+        await self._inject_faults(state)
+        inputs = payload.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        prompt_tokens = sum(max(1, len(str(text)) // 2) for text in inputs)
+        state["requests"] += 1
+        state["prompt_tokens"] += prompt_tokens
+        await self._sleep_for_prefill(state, prompt_tokens)
+        return {
+            "object": "list",
+            "model": model,
+            "data": [
+                {"object": "embedding", "index": index, "embedding": self.embed(str(text))}
+                for index, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        }
+
+    async def handle_metrics(self, request):
+        return {
+            "uptime": time.time() - self.started_at,
+            "requests_total": self.request_count,
+            "active_requests": sum(state["active"] for state in self.models.values()),
+            "models": {
+                model_id: {key: state[key] for key in
+                           ("status", "active", "requests", "errors", "prompt_tokens", "completion_tokens")}
+                for model_id, state in self.models.items()
+            },
+        }
+
+    async def handle_deploy(self, request):
+        payload = request.json()
+        model_id = payload.get("model_id") or payload.get("model")
+        if not model_id:
+            raise HTTPError(400, "model_id is required")
+        state = self.models.get(model_id)
+        if state is None:
+            model_type = "embedding" if payload.get("type") == "embedding" else "llm"
+            state = self._new_model_state(PROFILES[self.default_profile], model_type, status="DOWNLOADING")
+            self.models[model_id] = state
+            asyncio.get_running_loop().create_task(self._progress_deploy(state))
+        return {"id": model_id, "status": state["status"], "device": payload.get("device")}
+
+    async def _progress_deploy(self, state):
+        await asyncio.sleep(self.deploy_delay / 2)
+        state["status"] = "STARTING"
+        await asyncio.sleep(self.deploy_delay / 2)
+        state["status"] = "RUNNING"
+
+    # --- ファイル配信（Hugging Face Hub互換） ---
+
+    def _file_handler(self, request):
+        if self.files_dir is None:
+            return None
+        if request.method == "GET" and TREE_PATH.match(request.path):
+            return self.handle_tree
+        if request.method in ("GET", "HEAD") and RESOLVE_PATH.match(request.path):
+            return self.handle_resolve
+        return None
+
+    def _repo_dir(self, repo):
+        path = os.path.realpath(os.path.join(self.files_dir, repo))
+        if not path.startswith(self.files_dir + os.sep) or not os.path.isdir(path):
+            raise HTTPError(404, f"repository '{repo}' not found")
+        return path
+
+    def _file_sha256(self, path):
+        """ファイルのSHA-256（更新時刻とサイズが変わらない間はキャッシュする）"""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        digest = self._file_hashes.get(key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(FILE_CHUNK_SIZE), b""):
+                    sha.update(block)
+            digest = sha.hexdigest()
+            self._file_hashes[key] = digest
+        return digest
+
+    def _repo_files(self, repo_dir):
+        files = []
+        for root, _, names in os.walk(repo_dir):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                files.append((os.path.relpath(path, repo_dir).replace(os.sep, "/"), path))
+        return sorted(files)
+
+    def _repo_commit(self, repo_dir):
+        """リポジトリの内容から決まるコミットID（ファイルが変わると変わる）"""
+        sha = hashlib.sha1()
+        for name, path in self._repo_files(repo_dir):
+            sha.update(f"{name}:{self._file_sha256(path)}\n".encode("utf-8"))
+        return sha.hexdigest()
+
+    async def handle_tree(self, request):
+        repo_dir = self._repo_dir(TREE_PATH.match(request.path).group("repo"))
+        entries = []
+        for name, path in self._repo_files(repo_dir):
+            size = os.path.getsize(path)
+            digest = self._file_sha256(path)
+            entries.append({"type": "file", "path": name, "size": size, "oid": digest[:40],
+                            "lfs": {"oid": digest, "size": size}})
+        return entries
+
+    async def handle_resolve(self, request):
+        match = RESOLVE_PATH.match(request.path)
+        repo_dir = self._repo_dir(match.group("repo"))
+        path = os.path.realpath(os.path.join(repo_dir, match.group("path")))
+        if not path.startswith(repo_dir + os.sep) or not os.path.isfile(path):
+            raise HTTPError(404, f"file '{match.group('path')}' not found")
+        if self.random.random() < self.faults.error_rate:
+            raise HTTPError(self.faults.error_status, "injected fault")
+        size = os.path.getsize(path)
+        headers = [f'ETag: "{self._file_sha256(path)}"', f"X-Repo-Commit: {self._repo_commit(repo_dir)}"]
+        start, end, status = 0, size - 1, 200
+        range_match = RANGE_HEADER.match(request.headers.get("range", ""))
+        if range_match and (range_match.group(1) or range_match.group(2)):
+            if range_match.group(1):
+                start = int(range_match.group(1))
+                end = min(size - 1, int(range_match.group(2))) if range_match.group(2) else size - 1
+            else:
+                # "bytes=-N" は末尾のNバイト
+                start = max(0, size - int(range_match.group(2)))
+            if start >= size or start > end:
+                raise HTTPError(416, f"range not satisfiable (size {size})")
+            status = 206
+            headers.append(f"Content-Range: bytes {start}-{end}/{size}")
+        return FileResponse(path, start, end, size, headers, status, head_only=request.method == "HEAD")
+
+    async def handle_get_config(self, request):
+        return {
+            "faults": asdict(self.faults),
+            "models": {model_id: asdict(state["profile"]) for model_id, state in self.models.items()},
+            "profiles": {name: asdict(profile) for name, profile in PROFILES.items()},
+        }
+
+    async def handle_set_config(self, request):
+        """障害注入やモデルのプロファイルを実行中に変更する"""
+        payload = request.json()
+        fault_names = {f.name for f in fields(FaultConfig)}
+        faults = payload.get("faults") or {}
+        unknown = set(faults) - fault_names
+        if unknown:
+            raise HTTPError(400, f"unknown fault settings: {', '.join(sorted(unknown))}")
+        self.faults = replace(self.faults, **faults)
+        for model_id, profile in (payload.get("models") or {}).items():
+            state = self.models.get(model_id)
+            if state is None:
+                raise HTTPError(404, f"model '{model_id}' not found")
+            if isinstance(profile, str):
+                if profile not in PROFILES:
+                    raise HTTPError(400, f"unknown profile: {profile}")
+                state["profile"] = PROFILES[profile]
+            else:
+                state["profile"] = replace(state["profile"], **profile)
+        return await self.handle_get_config(request)
+
+
+def run_in_thread(**kwargs):
+    """モックサーバーをバックグラウンドスレッドで起動し、起動済みのサーバーを返す"""
+    kwargs.setdefault("port", 0)
+    server = MockGPUStackServer(**kwargs)
+    ready = threading.Event()
+    loop = asyncio.new_event_loop()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_until_complete(server.serve_forever())
+
+    thread = threading.Thread(target=run, name="mock-gpustack", daemon=True)
+    thread.start()
+    ready.wait()
+    server.loop = loop
+    return server
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="GPUStack互換のモックサーバー")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けるホスト")
+    parser.add_argument("--port", type=int, default=8000, help="待ち受けるポート")
+    parser.add_argument("--models", default=",".join(DEFAULT_MODELS),
+                        help="提供するモデル（id または id:profile をカンマ区切り）")
+    parser.add_argument("--embedding-models", default=",".join(DEFAULT_EMBEDDING_MODELS),
+                        help="提供する埋め込みモデルID（カンマ区切り）")
+    parser.add_argument("--profile", default="fast", choices=sorted(PROFILES),
+                        help="プロファイル未指定のモデルに使う遅延プロファイル")
+    parser.add_argument("--ttft", type=float, help="最初のトークンまでの待ち時間（秒、プロファイルを上書き）")
+    parser.add_argument("--tokens-per-sec", type=float, help="1リクエストあたりの生成速度（プロファイルを上書き）")
+    parser.add_argument("--output-tokens", type=int, default=64, help="max_tokens未指定時の生成トークン数")
+    parser.add_argument("--deploy-delay", type=float, default=5.0, help="デプロイからRUNNINGになるまでの秒数")
+    parser.add_argument("--embedding-dim", type=int, default=256, help="埋め込みベクトルの次元数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="5xxエラーを返す確率")
+    parser.add_argument("--error-status", type=int, default=503, help="注入するエラーのステータスコード")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="応答を止める確率")
+    parser.add_argument("--hang-seconds", type=float, default=30.0, help="応答を止める秒数")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="ストリーミング途中で切断する確率")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="TTFTを遅くする確率")
+    parser.add_argument("--slow-factor", type=float, default=10.0, help="遅くする場合のTTFTの倍率")
+    parser.add_argument("--seed", type=int, help="乱数シード")
+    parser.add_argument("--serve-files", metavar="DIR",
+                        help="DIR/{組織}/{リポジトリ}/ のファイルをHugging Face Hub互換のパスで配信する")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    faults = FaultConfig(
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        hang_rate=args.hang_rate,
+        hang_seconds=args.hang_seconds,
+        disconnect_rate=args.disconnect_rate,
+        slow_rate=args.slow_rate,
+        slow_factor=args.slow_factor,
+    )
+    try:
+        server = MockGPUStackServer(
+            host=args.host,
+            port=args.port,
+            models=[m for m in args.models.split(",") if m.strip()],
+            embedding_models=[m.strip() for m in args.embedding_models.split(",") if m.strip()],
+            profile=args.profile,
+            ttft=args.ttft,
+            tokens_per_sec=args.tokens_per_sec,
+            default_output_tokens=args.output_tokens,
+            faults=faults,
+            deploy_delay=args.deploy_delay,
+            embedding_dim=args.embedding_dim,
+            seed=args.seed,
+            files_dir=args.serve_files,
+        )
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    print(f"モックサーバーを起動しました: http://{args.host}:{args.port}/v1")
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,26 +4,58 @@
 """
 GPUStack モデルセットアップスクリプト
 Apple Silicon Mac向けに最適化された軽量モデルを自動的にデプロイします
+
+マニフェストを指定すると対話なしで複数のモデルを並行してデプロイし、
+RUNNINGになるまで待ってウォームアップのリクエストを送ります:
+  python model_setup.py --manifest models.json
+  python model_setup.py --models TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF,TheBloke/Qwen2.5-0.5B-Instruct-GGUF
+
+マニフェストの形式（JSON）:
+  {"models": ["TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF",
+              {"model_id": "TheBloke/Qwen2.5-0.5B-Instruct-GGUF", "name": "qwen2.5-0.5b", "warmup": false}]}
+項目ごとの quantization（例: "Q4_K_M"）・files（GGUFファイル名のリスト）はデプロイのリクエストにそのまま渡します。
+name は提供名としてデプロイのリクエストに含め、一覧に name がなければ model_id で状態を確認します。
+既にデプロイ済みのモデルは再デプロイせず、状態の確認から再開します。
 """
 
 import os
 import sys
+import argparse
+import random
 import subprocess
 import json
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
 
+# 共通のAPIクライアントモジュール（app/gpustack_client.py）を読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from gpustack_client import auth_headers, get_session
+from resilience import classify_status, describe_error, resilient_call
+# 同じディレクトリのハードウェアプランナー（scripts/hardware_planner.py）
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import hardware_planner
+
 # GPUStackのAPIエンドポイント
-API_BASE = "http://localhost:80/v1"
+API_BASE = os.getenv("GPUSTACK_API_BASE", "http://localhost:80/v1")
+
+# RUNNINGになるまでの待機時間とポーリング間隔（指数バックオフ）
+DEFAULT_READY_TIMEOUT = 900.0
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 15.0
+READY_STATUSES = ("RUNNING",)
+FAILED_STATUSES = ("ERROR", "FAILED")
+WARMUP_MESSAGES = [{"role": "user", "content": "こんにちは"}]
 
 def check_gpustack_running():
     """GPUStackが実行中かどうかを確認する"""
+    # 起動待ちのポーリングで使うため再試行はせず、短いタイムアウトで確認する
     try:
-        response = requests.get(f"{API_BASE}/models")
+        response = get_session().get(f"{API_BASE}/models", timeout=(2, 5))
         if response.status_code == 200:
             return True
-    except requests.exceptions.ConnectionError:
+    except requests.exceptions.RequestException:
         pass
     return False
 
@@ -35,21 +67,39 @@ def start_gpustack():
                          stdout=subprocess.PIPE, 
                          stderr=subprocess.PIPE)
         # APIが応答するまで待機
-        for _ in range(30):  # 最大30秒間待機
-            if check_gpustack_running():
-                print("GPUStackが起動しました")
-                return True
-            time.sleep(1)
+        if wait_for_server(timeout=60):
+            print("GPUStackが起動しました")
+            return True
         print("GPUStackの起動に失敗しました")
         return False
-    except Exception as e:
+    except OSError as e:
         print(f"GPUStackの起動中にエラーが発生しました: {e}")
         return False
 
-def get_or_create_api_key():
-    """APIキーを取得または作成する"""
+def poll_delays(initial=POLL_INITIAL_DELAY, maximum=POLL_MAX_DELAY):
+    """ポーリングの待ち時間（ジッター付きの指数バックオフ）を順に返す"""
+    delay = initial
+    while True:
+        yield delay * random.uniform(0.5, 1.0)
+        delay = min(maximum, delay * 2)
+
+def wait_for_server(timeout=60.0):
+    """APIが応答するまでバックオフしながら待つ"""
+    deadline = time.monotonic() + timeout
+    for delay in poll_delays(0.5, 5.0):
+        if check_gpustack_running():
+            return True
+        if time.monotonic() + delay > deadline:
+            return False
+        time.sleep(delay)
+
+def get_or_create_api_key(interactive=True):
+    """APIキーを取得または作成する（非対話モードでは環境変数かファイルのみ）"""
     api_key_file = os.path.expanduser("~/.gpustack/api_key.txt")
     
+    if os.getenv("GPUSTACK_API_KEY"):
+        return os.getenv("GPUSTACK_API_KEY")
+    
     # ファイルからAPIキーを読み込む
     if os.path.exists(api_key_file):
         with open(api_key_file, "r") as f:
@@ -58,6 +108,9 @@ def get_or_create_api_key():
                 print("既存のAPIキーを使用します")
                 return api_key
     
+    if not interactive:
+        return ""
+    
     # APIキーがない場合は入力を求める
     print("GPUStackのAPIキーが必要です")
     print("Playground UI (http://localhost:8000) で生成したAPIキーを入力してください")
@@ -75,76 +128,237 @@ def get_or_create_api_key():
 
 def list_available_models(api_key):
     """利用可能なモデルのリストを取得する"""
-    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    headers = auth_headers(api_key)
     
     try:
-        response = requests.get(f"{API_BASE}/models/list", headers=headers)
+        response = resilient_call(lambda: get_session().get(f"{API_BASE}/models/list", headers=headers))
         if response.status_code == 200:
             return response.json()
         else:
-            print(f"モデルリストの取得に失敗しました: {response.status_code}")
+            print(f"モデルリストの取得に失敗しました: {classify_status(response.status_code)}")
             print(response.text)
             return None
-    except Exception as e:
-        print(f"モデルリストの取得中にエラーが発生しました: {e}")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"モデルリストの取得中にエラーが発生しました: {describe_error(e)}")
         return None
 
 def list_deployed_models(api_key):
     """デプロイ済みのモデルのリストを取得する"""
-    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    headers = auth_headers(api_key)
     
     try:
-        response = requests.get(f"{API_BASE}/models", headers=headers)
+        response = resilient_call(lambda: get_session().get(f"{API_BASE}/models", headers=headers))
         if response.status_code == 200:
             data = response.json()
             return {"data": data["items"]} if "items" in data else {"data": []}
         else:
-            print(f"デプロイ済みモデルリストの取得に失敗しました: {response.status_code}")
+            print(f"デプロイ済みモデルリストの取得に失敗しました: {classify_status(response.status_code)}")
             print(response.text)
             return None
-    except Exception as e:
-        print(f"デプロイ済みモデルリストの取得中にエラーが発生しました: {e}")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"デプロイ済みモデルリストの取得中にエラーが発生しました: {describe_error(e)}")
         return None
 
-def deploy_model(model_id, api_key):
-    """モデルをデプロイする"""
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}" if api_key else ""
-    }
+def deploy_model(model_id, api_key, device=None, quantization=None, files=None, name=None):
+    """モデルをデプロイする（quantization・files を指定するとそのGGUFファイルを使い、name で提供名を付ける）"""
+    headers = {"Content-Type": "application/json", **auth_headers(api_key)}
     
     payload = {
         "model_id": model_id,
-        "device": "mps" if sys.platform == "darwin" and "arm" in os.uname().machine else "cuda",
+        "device": device or hardware_planner.detect_device(),
         "type": "llm"
     }
+    if name and name != model_id:
+        payload["name"] = name
+    # 量子化やファイルを指定しないと、サーバーが選んだ（このマシンに収まらない可能性のある）ファイルになる
+    if quantization:
+        payload["quantization"] = quantization
+    if files:
+        payload["files"] = list(files)
     
     try:
-        print(f"モデル '{model_id}' をデプロイしています...")
-        response = requests.post(f"{API_BASE}/models/deploy", headers=headers, json=payload)
+        print(f"モデル '{model_id}' をデプロイしています" + (f"（{quantization}）" if quantization else "") + "...")
+        # デプロイは冪等ではないため、サーバーが処理していない失敗のみ再試行する
+        response = resilient_call(
+            lambda: get_session().post(f"{API_BASE}/models/deploy", headers=headers, json=payload),
+            idempotent=False
+        )
         if response.status_code == 200:
             print(f"モデル '{model_id}' が正常にデプロイされました")
             return True
         else:
-            print(f"モデルのデプロイに失敗しました: {response.status_code}")
+            print(f"モデルのデプロイに失敗しました: {classify_status(response.status_code)}")
             print(response.text)
             return False
-    except Exception as e:
-        print(f"モデルのデプロイ中にエラーが発生しました: {e}")
+    except requests.exceptions.RequestException as e:
+        print(f"モデルのデプロイ中にエラーが発生しました: {describe_error(e)}")
         return False
 
-def recommend_models_for_mac():
-    """Mac向けの推奨モデルリストを返す"""
-    return [
-        "TheBloke/Qwen2.5-0.5B-Instruct-GGUF",
-        "TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF",
-        "TheBloke/Mistral-7B-Instruct-v0.2-GGUF",
-        "TheBloke/Llama-3.1-8B-Instruct-GGUF",
-        "TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF",
-        "neural-chat/neural-chat-7b-v3-1-GGUF",
-    ]
+def get_model_statuses(api_key):
+    """デプロイ済みモデルの {モデルID: 状態} を返す（取得できなければNone）"""
+    try:
+        response = resilient_call(
+            lambda: get_session().get(f"{API_BASE}/models", headers=auth_headers(api_key), timeout=(5, 10))
+        )
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        models = data.get("data", data.get("items", []))
+        return {model.get("id") or model.get("name"): model.get("status") for model in models}
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+def find_model(statuses, names):
+    """names のうちサーバーが一覧に返した最初の名前と、その状態を返す（見つからなければ (None, None)）"""
+    for name in names:
+        if name in statuses:
+            return name, statuses[name]
+    return None, None
+
+def wait_until_ready(model_names, api_key, timeout=DEFAULT_READY_TIMEOUT):
+    """モデルがRUNNINGになるまでバックオフしながら待ち、(一覧での名前, 最後に確認した状態) を返す
+
+    サーバーが提供名を使わずモデルIDで一覧に載せる場合もあるため、model_names の候補を順に探す。
+    """
+    deadline = time.monotonic() + timeout
+    found = (None, None)
+    for delay in poll_delays():
+        statuses = get_model_statuses(api_key)
+        if statuses is not None:
+            found = find_model(statuses, model_names)
+            if found[1] in READY_STATUSES or found[1] in FAILED_STATUSES:
+                return found
+        if time.monotonic() + delay > deadline:
+            return found
+        time.sleep(delay)
+
+def warm_up(model_name, api_key):
+    """短いリクエストを1回送り、モデルのロードと最初のプリフィルを済ませておく（所要秒数を返す）"""
+    headers = {"Content-Type": "application/json", **auth_headers(api_key)}
+    payload = {"model": model_name, "messages": WARMUP_MESSAGES, "max_tokens": 1, "temperature": 0.0}
+    start = time.perf_counter()
+    response = resilient_call(
+        lambda: get_session().post(f"{API_BASE}/chat/completions", headers=headers, json=payload),
+        idempotent=False
+    )
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+def load_manifest(path):
+    """マニフェスト（JSON）を読み込み、モデルの設定のリストを返す"""
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    entries = manifest.get("models", []) if isinstance(manifest, dict) else manifest
+    return [normalize_entry(entry) for entry in entries]
+
+def normalize_entry(entry):
+    """マニフェストの1項目（文字列または辞書）を辞書にそろえる"""
+    if isinstance(entry, str):
+        entry = {"model_id": entry}
+    if not entry.get("model_id"):
+        raise ValueError(f"model_id がありません: {entry}")
+    entry.setdefault("name", entry["model_id"])
+    entry.setdefault("warmup", True)
+    return entry
+
+def deploy_and_warm_up(entry, api_key, timeout=DEFAULT_READY_TIMEOUT, warmup=True):
+    """1モデルをデプロイし、RUNNINGになるまで待ってウォームアップする"""
+    name = entry["name"]
+    result = {"model_id": entry["model_id"], "name": name, "deployed": False, "status": None,
+              "time_to_ready": None, "warmup_time": None, "error": None}
+    names = (name, entry["model_id"])
+    start = time.perf_counter()
+    served_name, status = find_model(get_model_statuses(api_key) or {}, names)
+    if served_name is not None:
+        # 既にデプロイ済み（前回の途中など）なら再デプロイせず状態の確認から再開する
+        print(f"[{name}] デプロイ済みです（{status}）")
+    elif deploy_model(entry["model_id"], api_key, entry.get("device"), entry.get("quantization"), entry.get("files"),
+                      name):
+        result["deployed"] = True
+    else:
+        result["error"] = "デプロイに失敗しました"
+        return result
+    
+    served_name, status = wait_until_ready(names, api_key, timeout)
+    result["status"] = status
+    if status not in READY_STATUSES:
+        result["error"] = f"{timeout:.0f}秒以内にRUNNINGになりませんでした（状態: {status}）"
+        return result
+    result["time_to_ready"] = time.perf_counter() - start
+    print(f"[{name}] RUNNINGになりました（{result['time_to_ready']:.1f} 秒）")
+    
+    if warmup and entry.get("warmup", True):
+        try:
+            result["warmup_time"] = warm_up(served_name, api_key)
+            print(f"[{name}] ウォームアップが完了しました（{result['warmup_time']:.1f} 秒）")
+        except requests.exceptions.RequestException as e:
+            result["error"] = f"ウォームアップに失敗しました: {describe_error(e)}"
+    return result
+
+def deploy_manifest(entries, api_key, concurrency=4, timeout=DEFAULT_READY_TIMEOUT, warmup=True):
+    """複数のモデルを並行してデプロイ・ウォームアップし、モデルごとの結果を返す"""
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(entries)))) as executor:
+        futures = [executor.submit(deploy_and_warm_up, entry, api_key, timeout, warmup) for entry in entries]
+        return [future.result() for future in futures]
+
+def print_report(results):
+    """モデルごとのRUNNINGまでの時間とウォームアップ時間を表示する"""
+    print("\nモデル                                     状態       準備完了(秒)  ウォームアップ(秒)")
+    for result in results:
+        ready = f"{result['time_to_ready']:.1f}" if result["time_to_ready"] is not None else "-"
+        warm = f"{result['warmup_time']:.1f}" if result["warmup_time"] is not None else "-"
+        print(f"{result['name'][:40]:<42} {str(result['status']):<10} {ready:>12}  {warm:>16}")
+        if result["error"]:
+            print(f"  ⚠️ {result['error']}")
+
+def run_manifest(args):
+    """非対話モード: マニフェストのモデルを並行してデプロイする"""
+    entries = load_manifest(args.manifest) if args.manifest else []
+    entries += [normalize_entry(model_id.strip()) for model_id in (args.models or "").split(",") if model_id.strip()]
+    if not entries:
+        print("デプロイするモデルがありません")
+        return 1
+    
+    if not wait_for_server(timeout=args.server_timeout):
+        print("GPUStackが実行されていません。先に 'gpustack start' を実行してください。")
+        return 1
+    
+    api_key = args.api_key or get_or_create_api_key(interactive=False)
+    print(f"{len(entries)} 個のモデルを並行してデプロイします...")
+    results = deploy_manifest(entries, api_key, args.concurrency, args.timeout, args.warmup)
+    print_report(results)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0 if all(result["error"] is None for result in results) else 1
+
+def recommend_models():
+    """このマシンのメモリに収まるモデルを推奨順に返す（hardware_planner の見積もり）"""
+    host = hardware_planner.detect_host()
+    print(hardware_planner.format_host(host))
+    return hardware_planner.recommend(host)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GPUStackにモデルをデプロイするスクリプト")
+    parser.add_argument("--manifest", help="デプロイするモデルのマニフェスト（JSON）。指定すると対話なしで実行する")
+    parser.add_argument("--models", help="デプロイするモデルIDのカンマ区切りリスト（対話なしで実行する）")
+    parser.add_argument("--api-base", help="APIのベースURL")
+    parser.add_argument("--api-key", help="GPUStackのAPIキー")
+    parser.add_argument("--concurrency", type=int, default=4, help="並行してデプロイするモデル数")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_READY_TIMEOUT, help="RUNNINGになるまで待つ最大秒数")
+    parser.add_argument("--server-timeout", type=float, default=60.0, help="GPUStackのAPIが応答するまで待つ最大秒数")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="ウォームアップのリクエストを送らない")
+    parser.add_argument("--report", help="モデルごとの結果をJSONで書き出すファイル")
+    return parser.parse_args(argv)
 
 def main():
+    global API_BASE
+    args = parse_args()
+    if args.api_base:
+        API_BASE = args.api_base
+    if args.manifest or args.models:
+        return run_manifest(args)
+    
     print("GPUStack モデルセットアップスクリプトを開始します...")
     
     # GPUStackが実行中かどうかを確認
@@ -156,26 +370,33 @@ def main():
     # APIキーを取得
     api_key = get_or_create_api_key()
     
-    # Mac向けの推奨モデルをリスト表示
-    mac_models = recommend_models_for_mac()
+    # このマシン向けの推奨モデルをリスト表示
+    recommended = recommend_models()
+    if not recommended:
+        print("このマシンのメモリに収まる推奨モデルがありません")
+        return 1
     
-    print("\nApple Silicon Mac向けの推奨モデル:")
-    for i, model_id in enumerate(mac_models, 1):
-        print(f"{i}. {model_id}")
+    print("\nこのマシン向けの推奨モデル（推奨の量子化・メモリ使用量・生成速度の目安）:")
+    for i, estimate in enumerate(recommended, 1):
+        print(f"{i}. {estimate.model_id}（{estimate.quantization}、約 {estimate.memory_gib:.1f} GiB、"
+              f"約 {estimate.tokens_per_sec:.0f} tokens/秒）")
     
     # ユーザーにモデルを選択させる
     choice = 0
-    while choice < 1 or choice > len(mac_models):
+    while choice < 1 or choice > len(recommended):
         try:
-            choice = int(input("\nデプロイするモデルの番号を選択してください (1-{}): ".format(len(mac_models))))
+            choice = int(input("\nデプロイするモデルの番号を選択してください (1-{}): ".format(len(recommended))))
         except ValueError:
             print("有効な番号を入力してください")
     
-    selected_model = mac_models[choice - 1]
-    print(f"\nモデル '{selected_model}' をデプロイします...")
+    selected = recommended[choice - 1]
+    print(f"\nモデル '{selected.model_id}'（{selected.quantization}）をデプロイします...")
     
-    # モデルをデプロイ
-    success = deploy_model(selected_model, api_key)
+    # 見積もりに使った量子化でデプロイし、RUNNINGになるまで待ってウォームアップする
+    result = deploy_and_warm_up(normalize_entry({"model_id": selected.model_id, "quantization": selected.quantization}),
+                                api_key)
+    print_report([result])
+    success = result["error"] is None
     
     if success:
         print("\nセットアップが完了しました！")
@@ -186,7 +407,7 @@ def main():
         print("\nセットアップに失敗しました。")
         print("GPUStackログを確認し、問題を解決してから再試行してください。")
     
-    return 0
+    return 0 if success else 1
 
 if __name__ == "__main__":
     sys.exit(main())
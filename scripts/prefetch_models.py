@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+モデルファイル（GGUF）の事前ダウンロード
+GPUStackにデプロイするモデルのファイルを、Rangeリクエストで分割して並行にダウンロードし、
+SHA-256をファイル名にしたローカルのキャッシュ（コンテンツアドレス）に保存します。
+中断したダウンロードは完了したチャンクから再開し、保存前にSHA-256を検証します。
+--seed-dir を指定すると、キャッシュのファイルをHugging Face Hubのキャッシュ形式で
+GPUStackのデータボリュームに配置（同じファイルシステムならハードリンク）するため、
+新しいボリュームやコンテナでもモデルを取得し直さずにデプロイを始められます:
+  python prefetch_models.py --models TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF --quantization Q4_K_M
+  python prefetch_models.py --recommend --seed-dir /var/lib/gpustack/cache/huggingface
+  python prefetch_models.py --manifest models.json --hub-url http://localhost:8000   # モックサーバーから取得
+
+マニフェストは model_setup.py と同じ形式で、項目ごとに quantization・revision・files を指定できます:
+  {"models": [{"model_id": "TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF", "quantization": "Q5_K_M"},
+              {"model_id": "Qwen/Qwen2.5-1.5B-Instruct-GGUF", "files": ["qwen2.5-1.5b-instruct-q4_k_m.gguf"]}]}
+モデルを指定しない場合は、環境変数 MODEL_MANIFEST または MODEL_ID（deploy_small_model.py と同じ）を使います。
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests
+
+# 共通のAPIクライアントモジュール（app/gpustack_client.py）を読み込めるようにする
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "app"))
+from gpustack_client import get_session
+from resilience import resilient_call
+# 同じディレクトリのモデルセットアップ（マニフェストの読み込みと推奨モデルを共有する）
+sys.path.insert(0, SCRIPT_DIR)
+import model_setup
+
+DEFAULT_CACHE_DIR = "~/.gpustack/model_cache"
+DEFAULT_HUB_URL = "https://huggingface.co"
+DEFAULT_REVISION = "main"
+DEFAULT_QUANTIZATION = "Q4_K_M"
+DEFAULT_CONNECTIONS = 8
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+# 大きなファイルの転送中に読み込みが止まったとみなすまでの時間
+DOWNLOAD_TIMEOUT = (10, 60)
+MODEL_FILE_SUFFIX = ".gguf"
+
+_SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ChecksumError(Exception):
+    """ダウンロードしたファイルのSHA-256が一致しない"""
+
+
+@dataclass
+class Artifact:
+    """ダウンロードする1ファイル"""
+
+    repo: str
+    path: str
+    url: str
+    sha256: str = None
+    size: int = None
+    revision: str = DEFAULT_REVISION
+    commit: str = None
+
+
+class ArtifactCache:
+    """SHA-256をファイル名にしてファイルを保存するキャッシュ
+
+    root/blobs/sha256/<ハッシュ> に検証済みのファイル、root/partial/ にダウンロード途中のファイルと
+    完了したチャンクの記録を置きます。同じ内容のファイルはモデルやURLが違っても1つだけ保存されます。
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        self.root = os.path.expanduser(root)
+        self.blob_dir = os.path.join(self.root, "blobs", "sha256")
+        self.partial_dir = os.path.join(self.root, "partial")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256)
+
+    def has(self, sha256):
+        return bool(sha256) and os.path.exists(self.blob_path(sha256))
+
+    def partial_paths(self, artifact):
+        """ダウンロード途中のファイルと、完了したチャンクの記録のパス"""
+        key = artifact.sha256 or hashlib.sha256(artifact.url.encode("utf-8")).hexdigest()
+        path = os.path.join(self.partial_dir, key)
+        return path, path + ".json"
+
+    def add(self, path, sha256):
+        """検証済みのファイルをキャッシュに移し、そのパスを返す"""
+        blob = self.blob_path(sha256)
+        os.replace(path, blob)
+        return blob
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _content_range_size(response):
+    """"Content-Range: bytes 0-0/12345" からファイル全体のサイズを読み取る"""
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def _etag_sha256(response):
+    """ETag がSHA-256（Hugging Face HubのLFSファイル）ならその値"""
+    for name in ("X-Linked-Etag", "ETag"):
+        value = response.headers.get(name, "").strip().removeprefix("W/").strip('"')
+        if _SHA256_PATTERN.match(value):
+            return value
+    return None
+
+
+class Downloader:
+    """Rangeリクエストでチャンクに分けて並行にダウンロードする"""
+
+    def __init__(self, cache, connections=DEFAULT_CONNECTIONS, chunk_size=DEFAULT_CHUNK_SIZE, headers=None):
+        self.cache = cache
+        self.connections = max(1, connections)
+        self.chunk_size = max(1, chunk_size)
+        self.headers = headers or {}
+
+    def probe(self, artifact):
+        """先頭の1バイトを要求して、サイズ・Rangeへの対応・SHA-256・コミットを調べる"""
+        response = resilient_call(
+            lambda: get_session().get(artifact.url, headers={**self.headers, "Range": "bytes=0-0"}, stream=True,
+                                      timeout=DOWNLOAD_TIMEOUT)
+        )
+        with response:
+            response.raise_for_status()
+            ranged = response.status_code == 206
+            size = _content_range_size(response) if ranged else int(response.headers.get("Content-Length", 0))
+            artifact.size = artifact.size or size
+            artifact.sha256 = artifact.sha256 or _etag_sha256(response)
+            artifact.commit = artifact.commit or response.headers.get("X-Repo-Commit")
+        return ranged
+
+    def fetch(self, artifact):
+        """ファイルをキャッシュに取得し、(キャッシュのパス, 今回ダウンロードしたバイト数, キャッシュ済みか) を返す"""
+        if self.cache.has(artifact.sha256):
+            return self.cache.blob_path(artifact.sha256), 0, True
+        ranged = self.probe(artifact)
+        if self.cache.has(artifact.sha256):
+            return self.cache.blob_path(artifact.sha256), 0, True
+        path, state_path = self.cache.partial_paths(artifact)
+        if ranged and artifact.size:
+            downloaded = self._fetch_ranges(artifact, path, state_path)
+        else:
+            # Rangeに対応していないサーバーからは1本の接続で最初から取得する
+            downloaded = self._fetch_whole(artifact, path)
+
+        digest = file_sha256(path)
+        if artifact.sha256 and digest != artifact.sha256:
+            # 壊れたファイルから再開しないよう、途中のファイルと記録を消す
+            for stale in (path, state_path):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            raise ChecksumError(f"{artifact.path} のSHA-256が一致しません（期待値 {artifact.sha256[:12]}…、"
+                                f"実際 {digest[:12]}…）")
+        artifact.sha256 = digest
+        blob = self.cache.add(path, digest)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return blob, downloaded, False
+
+    def _fetch_ranges(self, artifact, path, state_path):
+        chunks = [(start, min(start + self.chunk_size, artifact.size) - 1)
+                  for start in range(0, artifact.size, self.chunk_size)]
+        state = self._load_state(state_path, artifact)
+        done = set(state["done"])
+        if not os.path.exists(path):
+            done.clear()
+        mode = "r+b" if os.path.exists(path) else "w+b"
+        lock = threading.Lock()
+        downloaded = 0
+
+        with open(path, mode) as f:
+            f.truncate(artifact.size)
+            fd = f.fileno()
+
+            def fetch_chunk(index):
+                nonlocal downloaded
+                start, end = chunks[index]
+                resilient_call(lambda: self._fetch_range(fd, artifact.url, start, end))
+                with lock:
+                    done.add(index)
+                    downloaded += end - start + 1
+                    state["done"] = sorted(done)
+                    self._save_state(state_path, state)
+
+            pending = [index for index in range(len(chunks)) if index not in done]
+            if len(pending) < len(chunks):
+                print(f"[{artifact.path}] {len(chunks) - len(pending)}/{len(chunks)} チャンクから再開します")
+            with ThreadPoolExecutor(max_workers=min(self.connections, max(1, len(pending)))) as executor:
+                # 1つでも失敗したら例外を送出する（完了したチャンクは記録済みなので次回はそこから再開する）
+                for _ in executor.map(fetch_chunk, pending):
+                    pass
+            os.fsync(fd)
+        return downloaded
+
+    def _fetch_range(self, fd, url, start, end):
+        """byte start〜end を取得してファイルの同じ位置に書き込む"""
+        response = get_session().get(url, headers={**self.headers, "Range": f"bytes={start}-{end}"}, stream=True,
+                                     timeout=DOWNLOAD_TIMEOUT)
+        with response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise requests.exceptions.ConnectionError(f"Rangeリクエストに {response.status_code} が返されました")
+            offset = start
+            try:
+                for block in response.iter_content(chunk_size=1024 * 1024):
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+            except requests.exceptions.ChunkedEncodingError as e:
+                # 転送途中の切断は接続エラーとして再試行する
+                raise requests.exceptions.ConnectionError(str(e)) from e
+            if offset != end + 1:
+                raise requests.exceptions.ConnectionError(
+                    f"チャンクが途中で切れました（{offset - start}/{end - start + 1} バイト）"
+                )
+
+    def _fetch_whole(self, artifact, path):
+        def download():
+            response = get_session().get(artifact.url, headers=self.headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+            with response:
+                response.raise_for_status()
+                size = 0
+                try:
+                    with open(path, "wb") as f:
+                        for block in response.iter_content(chunk_size=1024 * 1024):
+                            f.write(block)
+                            size += len(block)
+                except requests.exceptions.ChunkedEncodingError as e:
+                    raise requests.exceptions.ConnectionError(str(e)) from e
+                return size
+        return resilient_call(download)
+
+    def _load_state(self, state_path, artifact):
+        """完了したチャンクの記録（URL・サイズ・チャンクの大きさが変わっていれば使わない）"""
+        fresh = {"url": artifact.url, "size": artifact.size, "chunk_size": self.chunk_size, "done": []}
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return fresh
+        if (state.get("url"), state.get("size"), state.get("chunk_size")) != (artifact.url, artifact.size,
+                                                                             self.chunk_size):
+            return fresh
+        return state
+
+    @staticmethod
+    def _save_state(state_path, state):
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+
+def seed_hf_cache(artifact, blob, seed_dir):
+    """キャッシュのファイルをHugging Face Hubのキャッシュ形式で配置する
+
+    models--{組織}--{リポジトリ}/blobs/<SHA-256> に実体（ハードリンク、できなければコピー）を置き、
+    snapshots/<コミット>/<ファイル名> からシンボリックリンクを張ります。
+    """
+    repo_dir = os.path.join(seed_dir, "models--" + artifact.repo.replace("/", "--"))
+    target = os.path.join(repo_dir, "blobs", artifact.sha256)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if not os.path.exists(target):
+        tmp_path = target + ".incomplete"
+        try:
+            os.link(blob, tmp_path)
+        except OSError:
+            # 別のファイルシステム（ボリュームとホストのキャッシュなど）ではコピーする
+            shutil.copyfile(blob, tmp_path)
+        os.replace(tmp_path, target)
+
+    commit = artifact.commit or artifact.revision
+    snapshot = os.path.join(repo_dir, "snapshots", commit, artifact.path)
+    os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+    if os.path.lexists(snapshot):
+        os.remove(snapshot)
+    os.symlink(os.path.relpath(target, os.path.dirname(snapshot)), snapshot)
+    if commit != artifact.revision:
+        os.makedirs(os.path.join(repo_dir, "refs"), exist_ok=True)
+        with open(os.path.join(repo_dir, "refs", artifact.revision), "w", encoding="utf-8") as f:
+            f.write(commit)
+    return snapshot
+
+
+def list_repo_files(hub_url, repo, revision=DEFAULT_REVISION, headers=None):
+    """リポジトリのファイル一覧（パス → (SHA-256, サイズ)）"""
+    response = resilient_call(
+        lambda: get_session().get(f"{hub_url}/api/models/{repo}/tree/{revision}", params={"recursive": "1"},
+                                  headers=headers)
+    )
+    response.raise_for_status()
+    files = {}
+    for item in response.json():
+        if item.get("type") != "file":
+            continue
+        lfs = item.get("lfs") or {}
+        files[item["path"]] = (lfs.get("oid") or lfs.get("sha256"), lfs.get("size") or item.get("size"))
+    return files
+
+
+def select_model_files(paths, quantization=None):
+    """GGUFファイルのうち、指定した量子化のもの（分割されたファイルはすべて）を選ぶ"""
+    ggufs = sorted(path for path in paths if path.lower().endswith(MODEL_FILE_SUFFIX))
+    if quantization:
+        pattern = re.compile(rf"(^|[./_-]){re.escape(quantization)}([./-]|$)", re.IGNORECASE)
+        return [path for path in ggufs if pattern.search(path.rsplit("/", 1)[-1])]
+    return ggufs if len(ggufs) == 1 else []
+
+
+def resolve_entry(entry, hub_url, headers=None, default_quantization=DEFAULT_QUANTIZATION):
+    """マニフェストの1項目を、ダウンロードするファイルのリストにする"""
+    repo = entry["model_id"]
+    revision = entry.get("revision", DEFAULT_REVISION)
+    files = list_repo_files(hub_url, repo, revision, headers)
+    if entry.get("files"):
+        paths = entry["files"]
+        missing = [path for path in paths if path not in files]
+        if missing:
+            raise ValueError(f"{repo} に {', '.join(missing)} がありません")
+    else:
+        quantization = entry.get("quantization", default_quantization)
+        paths = select_model_files(files, quantization)
+        if not paths:
+            raise ValueError(f"{repo} に量子化 {quantization} のGGUFファイルがありません")
+    return [
+        Artifact(repo=repo, path=path, url=f"{hub_url}/{repo}/resolve/{revision}/{path}",
+                 sha256=files[path][0], size=files[path][1], revision=revision)
+        for path in paths
+    ]
+
+
+def load_entries(args):
+    """引数・マニフェスト・推奨モデル・環境変数から、取得するモデルの設定のリストを作る"""
+    entries = model_setup.load_manifest(args.manifest) if args.manifest else []
+    entries += [model_setup.normalize_entry(model_id.strip())
+                for model_id in (args.models or "").split(",") if model_id.strip()]
+    if args.recommend:
+        entries += [{"model_id": estimate.model_id, "quantization": estimate.quantization}
+                    for estimate in model_setup.recommend_models()[:args.recommend]]
+    if not entries and os.getenv("MODEL_MANIFEST"):
+        entries = model_setup.load_manifest(os.environ["MODEL_MANIFEST"])
+    if not entries and os.getenv("MODEL_ID"):
+        entries = [model_setup.normalize_entry(model_id.strip())
+                   for model_id in os.environ["MODEL_ID"].split(",") if model_id.strip()]
+    return entries
+
+
+def prefetch(artifacts, downloader, seed_dir=None):
+    """ファイルを順に取得し（各ファイルはチャンクを並行に取得する）、ファイルごとの結果を返す"""
+    results = []
+    for artifact in artifacts:
+        result = {"repo": artifact.repo, "path": artifact.path, "sha256": artifact.sha256, "size": artifact.size,
+                  "cached": False, "downloaded": 0, "seconds": None, "seeded": None, "error": None}
+        start = time.perf_counter()
+        try:
+            blob, downloaded, cached = downloader.fetch(artifact)
+            result.update(sha256=artifact.sha256, size=artifact.size, cached=cached, downloaded=downloaded)
+            if seed_dir:
+                result["seeded"] = seed_hf_cache(artifact, blob, seed_dir)
+        except (requests.exceptions.RequestException, ChecksumError, OSError) as e:
+            result["error"] = f"ダウンロードに失敗しました（{e}）" if isinstance(e, requests.exceptions.RequestException) else str(e)
+        result["seconds"] = time.perf_counter() - start
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def print_result(result):
+    name = f"{result['repo']}/{result['path']}"
+    if result["error"]:
+        print(f"❌ {name}: {result['error']}")
+        return
+    size_mib = (result["size"] or 0) / 1024 / 1024
+    if result["cached"]:
+        print(f"✅ {name}: キャッシュ済み（{size_mib:.1f} MiB）")
+    else:
+        speed = result["downloaded"] / 1024 / 1024 / max(result["seconds"], 1e-6)
+        print(f"✅ {name}: {size_mib:.1f} MiB を {result['seconds']:.1f} 秒でダウンロード（{speed:.1f} MiB/秒）")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="モデルファイルを並行・再開可能にダウンロードしてキャッシュする")
+    parser.add_argument("--manifest", help="取得するモデルのマニフェスト（JSON、model_setup.py と同じ形式）")
+    parser.add_argument("--models", help="取得するモデルIDのカンマ区切りリスト")
+    parser.add_argument("--recommend", type=int, nargs="?", const=1, default=0, metavar="N",
+                        help="このマシン向けの推奨モデルの上位N個を取得する（既定1）")
+    parser.add_argument("--quantization", default=DEFAULT_QUANTIZATION,
+                        help="量子化を指定していないモデルで取得する量子化")
+    parser.add_argument("--hub-url", default=os.getenv("HF_ENDPOINT", DEFAULT_HUB_URL),
+                        help="Hugging Face Hub互換のサーバー（既定は環境変数 HF_ENDPOINT）")
+    parser.add_argument("--cache-dir", default=os.getenv("MODEL_CACHE_DIR", DEFAULT_CACHE_DIR),
+                        help="ダウンロードしたファイルのキャッシュ（既定は環境変数 MODEL_CACHE_DIR）")
+    parser.add_argument("--seed-dir", default=os.getenv("PREFETCH_SEED_DIR"),
+                        help="Hugging Face Hubのキャッシュ形式でファイルを配置するディレクトリ"
+                             "（GPUStackのデータボリューム。既定は環境変数 PREFETCH_SEED_DIR）")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS, help="1ファイルあたりの同時接続数")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE // (1024 * 1024),
+                        help="1回のRangeリクエストで取得するサイズ（MiB）")
+    parser.add_argument("--report", help="ファイルごとの結果をJSONで書き出すファイル")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    entries = load_entries(args)
+    if not entries:
+        print("取得するモデルがありません（--models / --manifest / --recommend を指定してください）")
+        return 1
+    hub_url = args.hub_url.rstrip("/")
+    token = os.getenv("HF_TOKEN")
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+    artifacts = []
+    for entry in entries:
+        try:
+            artifacts += resolve_entry(entry, hub_url, headers, args.quantization)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"❌ {entry['model_id']}: {e}")
+            return 1
+
+    downloader = Downloader(ArtifactCache(args.cache_dir), args.connections, args.chunk_size * 1024 * 1024,
+                            headers)
+    total_size = sum(artifact.size or 0 for artifact in artifacts)
+    print(f"{len(artifacts)} 個のファイル（{total_size / 1024 / 1024:.1f} MiB）を取得します...")
+    results = prefetch(artifacts, downloader, args.seed_dir)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0 if all(result["error"] is None for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
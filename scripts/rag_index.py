@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+RAG用の文書インデックスの管理スクリプト
+ファイルやディレクトリの資料をまとめてチャットアプリの文書インデックス（app/rag.py）に登録し、
+件数が多い場合はIVFを作成して検索を速くします。内容が変わっていない資料は埋め込み直しません。
+既定では共有の名前空間に登録し、チャットアプリでは「共有の資料も参照する」を選んだ利用者だけが参照します。
+
+使用例:
+  python rag_index.py add docs/ notes.md --embedding-model bge-m3
+  python rag_index.py build-ivf --lists 256
+  python rag_index.py search "メンテナンスの予定は？" -k 5
+  python rag_index.py list
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+# 共通のAPIクライアントモジュール（app/gpustack_client.py）を読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from gpustack_client import auth_headers, get_session
+from rag import DEFAULT_TOP_K, SHARED_NAMESPACE, DocumentIndex, get_document_index
+from resilience import describe_error, resilient_call
+
+API_BASE = os.getenv("GPUSTACK_API_BASE", "http://localhost:8000/v1")
+DOCUMENT_SUFFIXES = (".txt", ".md", ".csv", ".json", ".py", ".html", ".rst")
+
+
+def make_embed(api_base, api_key, model):
+    """/embeddings にテキストのリストをまとめて送る埋め込み関数を作る"""
+    def post(texts):
+        response = get_session().post(f"{api_base}/embeddings", headers=auth_headers(api_key),
+                                      json={"model": model, "input": texts})
+        # 429/5xx も再試行の対象にするため、ステータスの確認まで resilient_call の中で行う
+        response.raise_for_status()
+        return response
+
+    def embed(texts):
+        response = resilient_call(lambda: post(texts))
+        return [item["embedding"] for item in sorted(response.json()["data"], key=lambda item: item["index"])]
+    return embed
+
+
+def iter_documents(paths):
+    """ファイルと、ディレクトリ以下の資料ファイルを順に返す"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(DOCUMENT_SUFFIXES):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def add(index, paths):
+    start = time.perf_counter()
+    files = added = 0
+    for path in iter_documents(paths):
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            chunks = index.add_document(os.path.relpath(path), f.read())
+        files += 1
+        added += chunks
+        print(f"{'登録' if chunks else 'スキップ（変更なし）'}: {path}" + (f"（{chunks} チャンク）" if chunks else ""))
+    print(f"{files} ファイルを確認し、{added} チャンクを埋め込みました（{time.perf_counter() - start:.1f} 秒、"
+          f"インデックス全体で {len(index)} チャンク）")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="RAG用の文書インデックスを管理する")
+    parser.add_argument("--api-base", default=API_BASE, help="APIのベースURL")
+    parser.add_argument("--api-key", default=os.getenv("GPUSTACK_API_KEY", ""), help="GPUStackのAPIキー")
+    parser.add_argument("--embedding-model", default=os.getenv("RAG_EMBEDDING_MODEL"),
+                        help="埋め込みモデル（既定は環境変数 RAG_EMBEDDING_MODEL）")
+    parser.add_argument("--namespace", default=SHARED_NAMESPACE,
+                        help=f"登録先の名前空間（既定は全員が参照できる '{SHARED_NAMESPACE}'）")
+    parser.add_argument("--index-dir", help="インデックスのディレクトリを直接指定する（--namespace より優先）")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add_parser = commands.add_parser("add", help="資料を登録する（変更された資料だけ埋め込む）")
+    add_parser.add_argument("paths", nargs="+", help="資料のファイルまたはディレクトリ")
+    ivf_parser = commands.add_parser("build-ivf", help="IVFを作成して検索の範囲を絞れるようにする")
+    ivf_parser.add_argument("--lists", type=int, default=256, help="リスト数（目安はチャンク数の平方根）")
+    search_parser = commands.add_parser("search", help="質問に近いチャンクを表示する")
+    search_parser.add_argument("query", help="質問")
+    search_parser.add_argument("-k", type=int, default=DEFAULT_TOP_K, help="表示する件数")
+    commands.add_parser("list", help="登録済みの資料を表示する")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command in ("add", "search") and not args.embedding_model:
+        print("埋め込みモデルを --embedding-model または RAG_EMBEDDING_MODEL で指定してください")
+        return 1
+    embed = make_embed(args.api_base, args.api_key, args.embedding_model)
+    index = DocumentIndex(os.path.expanduser(args.index_dir), embed=embed) if args.index_dir \
+        else get_document_index(embed, args.namespace)
+    try:
+        if args.command == "add":
+            add(index, args.paths)
+        elif args.command == "build-ivf":
+            start = time.perf_counter()
+            index.build_ivf(args.lists)
+            print(f"{len(index)} チャンクを {args.lists} 個のリストに分けました（{time.perf_counter() - start:.1f} 秒）")
+        elif args.command == "search":
+            for chunk in index.search(args.query, args.k, min_score=-1.0):
+                print(f"[{chunk.score:.3f}] {chunk.document} #{chunk.seq + 1}\n{chunk.text}\n")
+        else:
+            for name, chunks, updated_at in index.documents():
+                print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(updated_at))}  {chunks:5d} チャンク  {name}")
+    except requests.exceptions.RequestException as e:
+        print(f"❌ 埋め込みの取得に失敗しました: {describe_error(e)}")
+        return 1
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
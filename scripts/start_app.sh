@@ -56,6 +56,10 @@ if ! python -c "import requests; exit(0 if requests.get('http://localhost:8000/v
     python scripts/model_setup.py
 fi
 
+# クライアント側のメトリクス（Prometheus形式）を公開するポート
+export METRICS_PORT="${METRICS_PORT:-9464}"
+echo "Prometheusメトリクス: http://localhost:${METRICS_PORT}/metrics"
+
 # Streamlitアプリケーションを起動
 echo "チャットボットアプリケーションを起動しています..."
 cd app
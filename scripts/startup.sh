@@ -20,14 +20,7 @@ else
     exit 1
 fi
 
-# GPUStackの起動
-echo "GPUStackを起動しています..."
-gpustack start &
-
-# GPUStackの起動を待機
-echo "GPUStackの起動を待機しています..."
-sleep 10
-
-# Streamlitアプリケーションの起動
-echo "Streamlitアプリケーションを起動しています..."
-cd app && streamlit run app.py 
\ No newline at end of file
+# GPUStackとStreamlitアプリケーションを並行して起動
+# （GPUStackの準備完了はヘルスチェックで確認し、落ちた場合は自動で再起動します）
+echo "GPUStackとStreamlitアプリケーションを起動しています..."
+exec python scripts/startup_supervisor.py "$@"
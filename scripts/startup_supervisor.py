@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+GPUStackとチャットUIの起動スーパーバイザー
+GPUStackとStreamlitを同時に起動し、固定のsleepではなくヘルスチェック（バックオフ付きのポーリング）で
+GPUStackの準備完了を確認してからモデルをデプロイします。
+SIGTERM/SIGINTは子プロセスのプロセスグループへ転送して猶予時間内の終了を待ち、
+予期せず終了した子プロセスはバックオフしながら再起動します。
+--prefetch を指定すると、GPUStackの起動と並行してモデルファイルを事前ダウンロードし（prefetch_models.py）、
+終わってからデプロイします。
+起動の各段階の経過時間をタイムラインとして出力するので、コールドスタートの計測に使えます:
+  python startup_supervisor.py --gpustack-port 80 --deploy
+  python startup_supervisor.py --gpustack-port 80 --deploy --prefetch
+  python startup_supervisor.py --timeline-json /tmp/startup_timeline.json
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+# 共通のAPIクライアントモジュール（app/gpustack_client.py）を読み込めるようにする
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(SCRIPT_DIR, "..", "app")
+sys.path.insert(0, APP_DIR)
+from gpustack_client import auth_headers, get_session
+# 同じディレクトリのモデルセットアップ（ポーリング間隔の計算を共有する）
+sys.path.insert(0, SCRIPT_DIR)
+from model_setup import poll_delays
+
+DEFAULT_READY_TIMEOUT = 300.0
+DEFAULT_GRACE_PERIOD = 20.0
+# 再起動の待ち時間の上限と、この時間動き続けたら待ち時間を初期値に戻す
+RESTART_MAX_DELAY = 30.0
+RESTART_RESET_AFTER = 60.0
+PROBE_TIMEOUT = (2, 5)
+MONITOR_INTERVAL = 0.2
+
+
+class Timeline:
+    """起動の各段階を、スーパーバイザーの起動からの経過時間とともに記録する"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def mark(self, component, phase, detail=""):
+        elapsed = time.monotonic() - self.started_at
+        with self._lock:
+            self.events.append({"elapsed": round(elapsed, 3), "component": component, "phase": phase,
+                                "detail": detail})
+        print(f"[supervisor +{elapsed:7.2f}s] {component}: {phase}" + (f"（{detail}）" if detail else ""),
+              flush=True)
+
+    def write_json(self, path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"events": events}, f, ensure_ascii=False, indent=2)
+
+
+class Child:
+    """監視対象の子プロセス（自身のプロセスグループで起動し、グループ単位でシグナルを送る）"""
+
+    def __init__(self, name, command, cwd=None, env=None, restart=True, probe=None):
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.restart = restart
+        self.probe = probe
+        self.process = None
+        self.started_at = None
+        self.starts = 0
+        self.restart_delay = 1.0
+        self.restart_at = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, cwd=self.cwd, env=self.env, start_new_session=True)
+        self.started_at = time.monotonic()
+        self.starts += 1
+        self.restart_at = None
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def send_signal(self, sig):
+        if not self.running:
+            return
+        try:
+            os.killpg(self.process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def schedule_restart(self):
+        """再起動の時刻を決める（すぐに落ち続ける場合は待ち時間を倍にしていく）"""
+        if time.monotonic() - self.started_at >= RESTART_RESET_AFTER:
+            self.restart_delay = 1.0
+        self.restart_at = time.monotonic() + self.restart_delay
+        delay = self.restart_delay
+        self.restart_delay = min(RESTART_MAX_DELAY, self.restart_delay * 2)
+        return delay
+
+
+def http_probe(url, headers=None):
+    """URLが200を返すかどうか（ポーリング用に再試行せず短いタイムアウトで確認する）"""
+    def probe():
+        try:
+            return get_session().get(url, headers=headers, timeout=PROBE_TIMEOUT).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+    return probe
+
+
+class Supervisor:
+    """子プロセスの起動・準備完了の確認・再起動・終了をまとめて管理する"""
+
+    def __init__(self, children, deploy=None, env=None, ready_timeout=DEFAULT_READY_TIMEOUT,
+                 grace_period=DEFAULT_GRACE_PERIOD, timeline=None, prefetch=None):
+        self.children = children
+        # GPUStackの準備完了後（prefetch があればその完了後）に一度だけ実行するデプロイのコマンド
+        self.deploy = deploy
+        # 起動と同時に一度だけ実行するモデルファイルの事前ダウンロードのコマンド
+        self.prefetch = prefetch
+        self.env = env
+        self.ready_timeout = ready_timeout
+        self.grace_period = grace_period
+        self.timeline = timeline or Timeline()
+        self.stopping = threading.Event()
+        self.ready = {}
+        self.deploy_process = None
+        self.deploy_done = deploy is None
+        self.prefetch_process = None
+        self.prefetch_done = prefetch is None
+        self._reported = False
+
+    def handle_signal(self, signum, frame):
+        self.timeline.mark("supervisor", "停止要求", signal.Signals(signum).name)
+        self.stopping.set()
+
+    def start_child(self, child):
+        child.start()
+        self.ready[child.name] = False
+        self.timeline.mark(child.name, "起動" if child.starts == 1 else "再起動", f"pid {child.process.pid}")
+        if child.probe is not None:
+            threading.Thread(target=self.wait_ready, args=(child, child.process), name=f"probe-{child.name}",
+                             daemon=True).start()
+
+    def wait_ready(self, child, process):
+        """ヘルスチェックが成功するまでバックオフしながら待つ"""
+        deadline = time.monotonic() + self.ready_timeout
+        attempts = 0
+        for delay in poll_delays(0.25, 5.0):
+            # 待っている間に停止・再起動された場合は、このプロセスの確認をやめる
+            if self.stopping.is_set() or child.process is not process or process.poll() is not None:
+                return
+            attempts += 1
+            if child.probe():
+                self.ready[child.name] = True
+                self.timeline.mark(child.name, "準備完了", f"ヘルスチェック {attempts} 回目")
+                return
+            if time.monotonic() + delay > deadline:
+                self.timeline.mark(child.name, "準備完了の待機がタイムアウト", f"{self.ready_timeout:.0f} 秒")
+                return
+            if self.stopping.wait(delay):
+                return
+
+    def start_prefetch(self):
+        self.prefetch_process = subprocess.Popen(self.prefetch, env=self.env, start_new_session=True)
+        self.timeline.mark("prefetch", "開始", f"pid {self.prefetch_process.pid}")
+
+    def check_prefetch(self):
+        if self.prefetch_process is None or self.prefetch_done:
+            return
+        code = self.prefetch_process.poll()
+        if code is not None:
+            # 失敗してもデプロイは続ける（取得できなかったファイルはGPUStackがダウンロードする）
+            self.prefetch_done = True
+            self.timeline.mark("prefetch", "完了" if code == 0 else "失敗", f"終了コード {code}")
+
+    def start_deploy(self):
+        self.deploy_process = subprocess.Popen(self.deploy, env=self.env, start_new_session=True)
+        self.timeline.mark("deploy", "開始", f"pid {self.deploy_process.pid}")
+
+    def check_deploy(self):
+        if self.deploy is None or self.deploy_done:
+            return
+        if self.deploy_process is None:
+            if self.ready.get("gpustack") and self.prefetch_done:
+                self.start_deploy()
+            return
+        code = self.deploy_process.poll()
+        if code is not None:
+            self.deploy_done = True
+            self.timeline.mark("deploy", "完了" if code == 0 else "失敗", f"終了コード {code}")
+
+    def report_if_started(self):
+        """全コンポーネントの準備が整ったら、起動にかかった時間を一度だけ出力する"""
+        if self._reported or not (self.deploy_done and self.prefetch_done) or not all(self.ready.get(c.name) for c in self.children):
+            return
+        self._reported = True
+        self.timeline.mark("supervisor", "起動完了")
+
+    def monitor(self):
+        for child in self.children:
+            if child.running:
+                continue
+            now = time.monotonic()
+            if child.restart_at is None:
+                code = child.process.returncode
+                if not child.restart:
+                    self.timeline.mark(child.name, "終了", f"終了コード {code}")
+                    self.stopping.set()
+                    return
+                self.ready[child.name] = False
+                delay = child.schedule_restart()
+                self.timeline.mark(child.name, "異常終了", f"終了コード {code}、{delay:.0f} 秒後に再起動")
+            elif now >= child.restart_at:
+                self.start_child(child)
+
+    def shutdown(self):
+        """子プロセスにSIGTERMを送り、猶予時間を過ぎても残っていればSIGKILLで止める"""
+        processes = list(self.children)
+        for task in (self.prefetch_process, self.deploy_process):
+            if task is not None and task.poll() is None:
+                os.killpg(task.pid, signal.SIGTERM)
+        for child in processes:
+            child.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.grace_period
+        while time.monotonic() < deadline and any(child.running for child in processes):
+            time.sleep(MONITOR_INTERVAL)
+        for child in processes:
+            if child.running:
+                self.timeline.mark(child.name, "強制終了", f"{self.grace_period:.0f} 秒以内に終了しませんでした")
+                child.send_signal(signal.SIGKILL)
+                child.process.wait()
+        self.timeline.mark("supervisor", "停止完了")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        # GPUStackとUIを同時に起動する（UIはGPUStackの準備が整うまで接続待ちの画面を出す）
+        for child in self.children:
+            self.start_child(child)
+        if self.prefetch is not None:
+            self.start_prefetch()
+        while not self.stopping.wait(MONITOR_INTERVAL):
+            self.monitor()
+            self.check_prefetch()
+            self.check_deploy()
+            self.report_if_started()
+        self.shutdown()
+        return 0
+
+
+def build_children(args, env):
+    api_base = env["GPUSTACK_API_BASE"]
+    gpustack_command = ["gpustack", "start"] + (["--port", str(args.gpustack_port)] if args.gpustack_port else [])
+    ui_command = [sys.executable, "-m", "streamlit", "run", "app.py",
+                  "--server.port", str(args.ui_port), "--server.headless", "true"]
+    return [
+        Child("gpustack", gpustack_command, env=env,
+              probe=http_probe(f"{api_base}/models", auth_headers(env.get("GPUSTACK_API_KEY")))),
+        Child("ui", ui_command, cwd=os.path.abspath(APP_DIR), env=env,
+              probe=http_probe(f"http://localhost:{args.ui_port}/_stcore/health")),
+    ]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GPUStackとチャットUIを並行して起動・監視する")
+    parser.add_argument("--gpustack-port", type=int, default=None, help="GPUStackの待ち受けポート（省略時はGPUStackの既定）")
+    parser.add_argument("--ui-port", type=int, default=8501, help="StreamlitのUIのポート")
+    parser.add_argument("--api-base", default=None,
+                        help="GPUStackのAPI（省略時は GPUSTACK_API_BASE、なければ --gpustack-port から決める）")
+    parser.add_argument("--deploy", action="store_true",
+                        default=os.getenv("DEPLOY_MODEL", "false").lower() in ("1", "true", "yes"),
+                        help="GPUStackの準備完了後にモデルをデプロイする（既定は環境変数 DEPLOY_MODEL）")
+    parser.add_argument("--prefetch", action="store_true",
+                        default=os.getenv("PREFETCH_MODELS", "false").lower() in ("1", "true", "yes"),
+                        help="起動と並行してモデルファイルを事前ダウンロードする（既定は環境変数 PREFETCH_MODELS）")
+    parser.add_argument("--ready-timeout", type=float, default=DEFAULT_READY_TIMEOUT,
+                        help="準備完了を待つ最大秒数")
+    parser.add_argument("--grace-period", type=float, default=DEFAULT_GRACE_PERIOD,
+                        help="停止時にSIGKILLを送るまでの猶予秒数")
+    parser.add_argument("--timeline-json", help="停止時に起動タイムラインをJSONで書き出すパス")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    env = dict(os.environ)
+    # UIとデプロイが、起動したGPUStackと同じAPIを参照するようにする
+    env["GPUSTACK_API_BASE"] = (args.api_base or env.get("GPUSTACK_API_BASE")
+                                or f"http://localhost:{args.gpustack_port or 80}/v1")
+    deploy = [sys.executable, os.path.join(SCRIPT_DIR, "deploy_small_model.py")] if args.deploy else None
+    # 取得するモデル・キャッシュ・配置先は環境変数（MODEL_ID、MODEL_CACHE_DIR、PREFETCH_SEED_DIR など）で指定する
+    prefetch = [sys.executable, os.path.join(SCRIPT_DIR, "prefetch_models.py")] if args.prefetch else None
+    supervisor = Supervisor(build_children(args, env), deploy=deploy, env=env, ready_timeout=args.ready_timeout,
+                            grace_period=args.grace_period, prefetch=prefetch)
+    try:
+        return supervisor.run()
+    finally:
+        if args.timeline_json:
+            supervisor.timeline.write_json(args.timeline_json)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
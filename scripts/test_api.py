@@ -4,6 +4,10 @@
 """
 GPUStack APIテストスクリプト
 GPUStackの接続状態、モデルの状態、およびシンプルなレスポンスをテストします
+
+bench サブコマンドで同時実行の負荷ベンチマークも実行できます:
+  python test_api.py bench --concurrency 8 --rate 2 --num-requests 200
+  python test_api.py bench --mock --format csv   # GPUなしでモックサーバーに対して実行
 """
 
 import os
@@ -13,34 +17,34 @@ import requests
 import argparse
 from getpass import getpass
 
+# 共通のAPIクライアントモジュール（app/gpustack_client.py）を読み込めるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from gpustack_client import auth_headers, get_session
+from resilience import classify_status, describe_error, resilient_call
+
 # GPUStackのAPIエンドポイント
 API_BASE = "http://localhost:8000/v1"
 
 def check_gpustack_running():
     """GPUStackが実行中かどうかを確認する"""
     try:
-        response = requests.get(f"{API_BASE}/models")
+        response = resilient_call(lambda: get_session().get(f"{API_BASE}/models"))
         if response.status_code == 200:
             print("✅ GPUStackサーバーに正常に接続できました")
             return True
         else:
-            print(f"❌ GPUStackサーバーに接続できましたが、エラーが返されました: {response.status_code}")
+            print(f"❌ GPUStackサーバーに接続できましたが、エラーが返されました: {classify_status(response.status_code)}")
             return False
-    except requests.exceptions.ConnectionError:
-        print("❌ GPUStackサーバーに接続できません。サーバーが実行中であることを確認してください。")
-        return False
-    except Exception as e:
-        print(f"❌ 接続テスト中にエラーが発生しました: {e}")
+    except requests.exceptions.RequestException as e:
+        print(f"❌ {describe_error(e)}")
         return False
 
 def list_models(api_key=None):
     """デプロイされているモデルのリストを取得する"""
-    headers = {}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
+    headers = auth_headers(api_key)
     
     try:
-        response = requests.get(f"{API_BASE}/models", headers=headers)
+        response = resilient_call(lambda: get_session().get(f"{API_BASE}/models", headers=headers))
         if response.status_code == 200:
             models_data = response.json()
             print("デプロイされているモデル:")
@@ -49,19 +53,16 @@ def list_models(api_key=None):
                 print(f"{status_emoji} {model['id']} ({model['status']})")
             return models_data["data"]
         else:
-            print(f"❌ モデルリストの取得に失敗しました: {response.status_code}")
+            print(f"❌ モデルリストの取得に失敗しました: {classify_status(response.status_code)}")
             print(response.text)
             return None
-    except Exception as e:
-        print(f"❌ モデルリストの取得中にエラーが発生しました: {e}")
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print(f"❌ モデルリストの取得中にエラーが発生しました: {describe_error(e)}")
         return None
 
 def test_model_response(model_id, api_key=None):
     """モデルからの応答をテストする"""
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}" if api_key else ""
-    }
+    headers = {"Content-Type": "application/json", **auth_headers(api_key)}
     
     payload = {
         "model": model_id,
@@ -75,7 +76,10 @@ def test_model_response(model_id, api_key=None):
     
     try:
         print(f"モデル '{model_id}' をテストしています...")
-        response = requests.post(f"{API_BASE}/chat/completions", headers=headers, json=payload)
+        response = resilient_call(
+            lambda: get_session().post(f"{API_BASE}/chat/completions", headers=headers, json=payload),
+            idempotent=False
+        )
         if response.status_code == 200:
             result = response.json()
             print("✅ モデルが正常に応答しました")
@@ -85,18 +89,58 @@ def test_model_response(model_id, api_key=None):
             print("-" * 50)
             return True
         else:
-            print(f"❌ モデルの応答テストに失敗しました: {response.status_code}")
+            print(f"❌ モデルの応答テストに失敗しました: {classify_status(response.status_code)}")
             print(response.text)
             return False
-    except Exception as e:
-        print(f"❌ モデルのテスト中にエラーが発生しました: {e}")
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print(f"❌ モデルのテスト中にエラーが発生しました: {describe_error(e)}")
         return False
 
+def run_bench_command(args):
+    """bench サブコマンド: 負荷ベンチマークを実行する"""
+    from load_bench import run_bench
+    
+    api_base = args.api_base or API_BASE
+    model_id = args.model
+    mock = None
+    if args.mock:
+        from mock_server import run_in_thread
+        mock = run_in_thread(profile=args.mock_profile, models=["mock-bench"], seed=args.seed)
+        api_base = mock.base_url
+        model_id = model_id or mock.model_ids[0]
+        print(f"モックサーバーを起動しました: {api_base}", file=sys.stderr)
+    
+    if not model_id:
+        try:
+            response = resilient_call(
+                lambda: get_session().get(f"{api_base}/models", headers=auth_headers(args.api_key))
+            )
+            response.raise_for_status()
+            running = [m["id"] for m in response.json().get("data", []) if m.get("status") == "RUNNING"]
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"❌ モデルリストの取得に失敗しました: {describe_error(e)}", file=sys.stderr)
+            return 1
+        if not running:
+            print("❌ 実行中のモデルがありません。--model でモデルを指定してください。", file=sys.stderr)
+            return 1
+        model_id = running[0]
+    
+    print(f"モデル '{model_id}' でベンチマークを実行しています...", file=sys.stderr)
+    report = run_bench(args, api_base, model_id, args.api_key)
+    return 0 if report["summary"]["completed"] else 1
+
 def main():
     parser = argparse.ArgumentParser(description="GPUStack APIをテストするスクリプト")
     parser.add_argument("--api-key", help="GPUStackのAPIキー")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    from load_bench import add_bench_arguments
+    add_bench_arguments(subparsers.add_parser("bench", help="同時実行の負荷ベンチマークを実行する"))
     args = parser.parse_args()
     
+    if args.command == "bench":
+        return run_bench_command(args)
+    
     api_key = args.api_key
     
     print("GPUStack APIテストを開始します...\n")